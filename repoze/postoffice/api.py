@@ -3,22 +3,36 @@ from __future__ import with_statement
 import codecs
 from cStringIO import StringIO
 from ConfigParser import ConfigParser
+from collections import deque
 from contextlib import contextmanager
 import datetime
+from email.generator import Generator
 from email.utils import parsedate
 from mailbox import Maildir
-from mailbox import MaildirMessage
 from mailbox import NoSuchMailboxError
+import math
+from multiprocessing.pool import Pool
 import os
 import re
 import shutil
-import smtplib
+import time
 import transaction
 
 from repoze.postoffice import filters
+from repoze.postoffice.message import LazyMaildirMessage
+from repoze.postoffice.message import LazyStringMessage
+from repoze.postoffice.queue import BOUNCE_WINDOW
+from repoze.postoffice.queue import FREQUENCY_WINDOW
+from repoze.postoffice.queue import NOTICE_FIELDS
 from repoze.postoffice.queue import QueuesFolder
 from repoze.postoffice.queue import Queue
+from repoze.postoffice.queue import ShardedQueue
+from repoze.postoffice.queue import compile_notice_template
+from repoze.postoffice.queue import _is_body_loaded
+from repoze.postoffice.smtp import SMTPSender
+from repoze.postoffice.sqlite import SQLiteQueue
 from repoze.zodbconn.uri import db_from_uri
+from ZODB.POSException import ConflictError
 
 filter_factories = {
     'to_hostname': filters.ToHostnameFilter,
@@ -30,6 +44,20 @@ filter_factories = {
 
 MAIN_SECTION = 'post office'
 _marker = object()
+_unrouted = object()
+
+# Number of times a batch of compaction is retried after a conflict with
+# another process, such as an importer.
+_COMPACT_RETRIES = 3
+
+# Minimum number of seconds between the compactions run after imports.
+_COMPACT_INTERVAL = 60
+
+# Number of messages handed to a worker process at a time.
+_WORKER_CHUNKSIZE = 16
+
+# State of a worker process, see _init_worker.
+_worker = None
 
 try:
     unicode
@@ -46,8 +74,12 @@ class PostOffice(object):
 
     # Overridable for testing
     Maildir = Maildir
-    MaildirMessage = MaildirMessage
+    MaildirMessage = LazyMaildirMessage
     Queue = Queue
+    ShardedQueue = ShardedQueue
+    SQLiteQueue = SQLiteQueue
+    Pool = Pool
+    SMTPSender = SMTPSender
 
     def __init__(self, filename, db_from_uri=db_from_uri, open=open):
         """
@@ -66,6 +98,8 @@ class PostOffice(object):
             self.zodb_uri, db_from_uri, self.zodb_path
         )
         self._init_queues(config)
+        self._compacted = None
+        self._compact_starts = {}
 
     def _init_main_section(self, config):
         if not config.has_section(MAIN_SECTION):
@@ -84,8 +118,45 @@ class PostOffice(object):
             config, MAIN_SECTION, 'ooo_loop_headers', '')
         self.ooo_throttle_period = datetime.timedelta(seconds=_get_opt_int(
             config, MAIN_SECTION, 'ooo_throttle_period', '300'))
+        if self.ooo_loop_frequency:
+            # Frequency data must cover the interval used for the average
+            # frequency, see _check_for_auto_response_and_loops
+            self._frequency_window = int(
+                math.ceil(4 / self.ooo_loop_frequency)) + 1
+        else:
+            self._frequency_window = FREQUENCY_WINDOW
         self.max_message_size = _get_opt_bytes(
             config, MAIN_SECTION, 'max_message_size', '0')
+        self.duplicate_window = _get_opt_int(
+            config, MAIN_SECTION, 'duplicate_window', '86400')
+        self.import_batch_size = _get_opt_int(
+            config, MAIN_SECTION, 'import_batch_size', '1')
+        self.import_batch_interval = _get_opt_float(
+            config, MAIN_SECTION, 'import_batch_interval', '0')
+        self.import_compact_limit = _get_opt_int(
+            config, MAIN_SECTION, 'import_compact_limit', '1000')
+        self.body_scan_limit = _get_opt_bytes(
+            config, MAIN_SECTION, 'body_scan_limit', '0')
+        self.sender = self.SMTPSender(
+            _get_opt(config, MAIN_SECTION, 'smtp_host', 'localhost'),
+            _get_opt_int(config, MAIN_SECTION, 'smtp_port', '25'),
+            _get_opt_float(config, MAIN_SECTION, 'smtp_timeout', '30'),
+            _get_opt_int(config, MAIN_SECTION, 'smtp_pool_size', '1'),
+            _get_opt_float(config, MAIN_SECTION, 'smtp_max_idle', '60'),
+        )
+        self.outbox_max_attempts = _get_opt_int(
+            config, MAIN_SECTION, 'outbox_max_attempts', '5')
+        self.outbox_retry_delay = _get_opt_float(
+            config, MAIN_SECTION, 'outbox_retry_delay', '60')
+        self.notice_templates = templates = {}
+        for kind in NOTICE_FIELDS:
+            path = _get_opt(config, MAIN_SECTION, '%s_template' % kind, None)
+            if path is None:
+                templates[kind] = None
+                continue
+            with codecs.open(path, 'r', 'UTF-8') as f:
+                templates[kind] = text = f.read()
+            compile_notice_template(kind, text)  # Raises ValueError if bad
 
         self.reject_filters = filters = []
         filters_setting = _get_opt(config, MAIN_SECTION, 'reject_filters', None)
@@ -108,12 +179,45 @@ class PostOffice(object):
         section_indices = self._section_indices
         queues.sort(key=lambda q: section_indices[q['section']])
         self.configured_queues = queues
+        self._route = _QueueRouter(queues)
 
     def _init_queue(self, config, section):
         name = section[6:] # len('queue:') == 6
         filters = []
+        partitions = shards = 1
+        sqlite_path = None
+        bounce_limit = None
+        bounce_window = BOUNCE_WINDOW
+        bounce_digest = False
         for option in config.options(section):
-            if option == 'filters':
+            if option == 'shards':
+                shards = config.getint(section, option)
+                if shards < 1:
+                    raise ValueError('Queue must have at least one shard: %s'
+                                     % name)
+            elif option == 'partitions':
+                partitions = config.getint(section, option)
+                if partitions < 1:
+                    raise ValueError('Queue must have at least one '
+                                     'partition: %s' % name)
+            elif option == 'storage':
+                storage = config.get(section, option).strip()
+                if storage != 'zodb':
+                    kind, path = (storage.split(':', 1) + [''])[:2]
+                    if kind != 'sqlite' or not path.strip():
+                        raise ValueError('Unknown storage for queue: %s' %
+                                         storage)
+                    sqlite_path = path.strip()
+            elif option == 'bounce_limit':
+                bounce_limit = config.getint(section, option)
+                if bounce_limit < 1:
+                    raise ValueError('Bounce limit must be at least one: %s'
+                                     % name)
+            elif option == 'bounce_window':
+                bounce_window = config.getint(section, option)
+            elif option == 'bounce_digest':
+                bounce_digest = config.getboolean(section, option)
+            elif option == 'filters':
                 for filter_ in [f.strip() for f in
                                 config.get(section, option)
                                 .strip().split('\n')]:
@@ -124,13 +228,23 @@ class PostOffice(object):
                 raise ValueError('Unknown config parameter for queue: %s' %
                                  option)
 
-        return dict(name=name, filters=filters, section=section)
+        if sqlite_path is not None and shards > 1:
+            raise ValueError('Sharded queue must be stored in the ZODB: %s' %
+                             name)
+
+        return dict(name=name, filters=filters, partitions=partitions,
+                    shards=shards, sqlite_path=sqlite_path,
+                    bounce_limit=(bounce_limit, bounce_window, bounce_digest),
+                    section=section)
 
     def _init_filter(self, filter_):
         name, config = filter_.split(':', 1)
         factory = filter_factories.get(name)
         if factory is None:
             raise ValueError("Unknown filter type: %s" % name)
+        if (self.body_scan_limit and
+            issubclass(factory, filters.BodyRegexpFilter)):
+            return factory(config.strip(), max_bytes=self.body_scan_limit)
         return factory(config.strip())
 
     def reconcile_queues(self, log=None):
@@ -140,7 +254,13 @@ class PostOffice(object):
         added to the database.  If old queues have been removed from the
         configuration, they are removed from the database if they are empty.
         If a queue has been removed from the configuration but still has
-        queued messages a warning is logged and queue is not removed.
+        queued messages a warning is logged and queue is not removed.  If the
+        number of partitions configured for a queue has changed, the queue is
+        repartitioned.  Changes to the bounce limit of a queue and to the
+        notice templates are applied.
+        The number of shards and the storage of an existing queue cannot be
+        changed, so a warning is logged if they differ from the
+        configuration.
         """
         if log is None:
             log = _NullLog()
@@ -151,9 +271,46 @@ class PostOffice(object):
             # Create new queues
             for queue in configured:
                 name = queue['name']
+                partitions = queue['partitions']
+                shards = queue['shards']
+                sqlite_path = queue['sqlite_path']
                 if name not in root:
-                    root[name] = self.Queue()
+                    if sqlite_path is not None:
+                        root[name] = self.SQLiteQueue(sqlite_path, partitions)
+                    elif shards > 1:
+                        root[name] = self.ShardedQueue(shards, partitions)
+                    else:
+                        root[name] = self.Queue(partitions=partitions)
+                    root[name].set_bounce_limit(*queue['bounce_limit'])
+                    self._reconcile_notice_templates(root[name])
                     log.info('Created new postoffice queue: %s' % name)
+                    continue
+
+                existing = root[name]
+                if existing.get_bounce_limit() != queue['bounce_limit']:
+                    existing.set_bounce_limit(*queue['bounce_limit'])
+                    log.info('Changed bounce limit of postoffice queue: %s' %
+                             name)
+                if self._reconcile_notice_templates(existing):
+                    log.info('Changed notice templates of postoffice queue: '
+                             '%s' % name)
+                if existing.count_partitions() != partitions:
+                    existing.repartition(partitions)
+                    log.info('Repartitioned postoffice queue: %s' % name)
+                if isinstance(existing, self.ShardedQueue):
+                    existing_shards = existing.count_shards()
+                else:
+                    existing_shards = 1
+                if existing_shards != shards:
+                    log.warn("Number of shards of existing queue cannot be "
+                             "changed: %s" % name)
+                if isinstance(existing, self.SQLiteQueue):
+                    existing_path = existing.path
+                else:
+                    existing_path = None
+                if existing_path != sqlite_path:
+                    log.warn("Storage of existing queue cannot be changed: "
+                             "%s" % name)
 
             # Remove old queues if empty
             configured_names = set([q['name'] for q in configured])
@@ -168,48 +325,280 @@ class PostOffice(object):
                         log.info('Removed old postoffice queue: %s' % name)
                         del root[name]
 
-    def import_messages(self, log=None):
+    def make_pool(self, workers):
+        """
+        Returns a pool of 'workers' processes which read, parse and route
+        messages for `import_messages`, so that a long running process can
+        use the same pool for every import.  The caller closes the pool once
+        it is done with it.
+        """
+        return self.Pool(workers, _init_worker, (self,))
+
+    def import_messages(self, log=None, workers=1, pool=None):
         """
         Imports messages from an external maildir, matches them to queues and
         either stores or discards each message depending on whether it matches
         a queue definition.  Once a message is imported it is removed from the
         maildir.
+
+        A single database connection is used for the whole run.  Messages are
+        committed in batches of up to 'import_batch_size' messages, or of
+        however many messages were read in 'import_batch_interval' seconds,
+        whichever comes first.  If a batch fails to import, its messages are
+        retried one at a time.  A message is only removed from the maildir
+        once the batch containing it has been committed.
+
+        If 'workers' is greater than one, messages are read, parsed and
+        matched against the reject and queue filters by a pool of that many
+        worker processes.  This process still stores every message and
+        archives it, in the order in which the messages were delivered.
+        'pool', if given, is a pool made by `make_pool` to use instead of
+        starting one for this call, and is left running afterwards.
+
+        Once the messages have been imported, the queues are compacted a
+        little, see `compact_some`.
         """
+        if log is None:
+            log = _NullLog()
+
         factory = _message_factory_factory(self, self.MaildirMessage, log)
         maildir = self.Maildir(self.maildir, factory=factory, create=True)
         keys = list(maildir.keys())
         keys.sort()
-        for key in keys:
-            message = maildir.get_message(key)
-            self._import_message(message, log)
-            self._archive_message(maildir, message, key)
+        batch_size = max(self.import_batch_size, 1)
+        interval = self.import_batch_interval
+        if pool is not None:
+            reader = _PoolReader(self, maildir, pool, workers)
+        elif workers > 1:
+            reader = _PoolReader(self, maildir, self.make_pool(workers),
+                                 workers, True)
+        else:
+            reader = _Reader(maildir)
+        try:
+            with self._get_root.session() as queues:
+                batch = []
+                for key, message, name in reader.read(keys, log):
+                    if not batch:
+                        deadline = time.time() + interval
+                    batch.append((key, message, name))
+                    if (len(batch) >= batch_size or
+                        (interval and time.time() >= deadline)):
+                        self._import_batch(maildir, queues, batch, log,
+                                           reader.reread)
+                        reader.forget()
+                        batch = []
+                if batch:
+                    self._import_batch(maildir, queues, batch, log,
+                                       reader.reread)
+                if self._is_compaction_due():
+                    self._compact_some(queues, log)
+        finally:
+            reader.close()
+
         n = len(keys)
         if n == 1:
             log.info("Processed one message.")
         else:
             log.info("Processed %d messages." % n)
 
-    def _import_message(self, message, log):
+    def _reconcile_notice_templates(self, queue):
+        # Returns boolean indicating whether any template was changed
+        changed = False
+        for kind, text in self.notice_templates.items():
+            if queue.get_notice_template(kind) != text:
+                queue.set_notice_template(kind, text)
+                changed = True
+        return changed
+
+    def compact(self, log=None, batch_size=1000):
+        """
+        Removes expired frequency data, throttles and message ids from every
+        queue, and forgets senders for which nothing is left.  At most
+        'batch_size' entries are visited in each transaction.  A batch which
+        conflicts with another process is retried a few times.
+        Returns a dictionary, keyed by queue name, of dictionaries counting
+        what was removed from each queue.
+        """
+        if log is None:
+            log = _NullLog()
+
+        now = datetime.datetime.now()
+        results = {}
+        with self._get_root.session() as queues:
+            for name in list(queues.keys()):
+                queue = queues[name]
+                totals = {'senders': 0, 'entries': 0, 'throttles': 0,
+                          'message_ids': 0}
+                start = None
+                while True:
+                    reclaimed, start = self._compact_batch(
+                        queue, now, batch_size, start, _COMPACT_RETRIES)
+                    for key, count in reclaimed.items():
+                        totals[key] += count
+                    if start is None:
+                        break
+                results[name] = totals
+                _log_compacted(log, name, totals)
+        return results
+
+    def compact_some(self, log=None):
+        """
+        Compacts each queue a little, visiting at most 'import_compact_limit'
+        entries of each queue in its own transaction, and carrying on from
+        where the last call left off, so that expired data is removed without
+        running `compact`.  Does nothing if queues were compacted this way
+        within the last minute, or if 'import_compact_limit' is zero.  Called
+        after each import, and by the daemon while it is idle.
+        """
+        if not self._is_compaction_due():
+            return
+        if log is None:
+            log = _NullLog()
+        with self._get_root.session() as queues:
+            self._compact_some(queues, log)
+
+    def _is_compaction_due(self):
+        if self.import_compact_limit <= 0:
+            return False
+        compacted = self._compacted
+        return (compacted is None or
+                time.time() >= compacted + _COMPACT_INTERVAL)
+
+    def _compact_some(self, queues, log):
+        now = datetime.datetime.now()
+        starts = self._compact_starts
+        for name in list(queues.keys()):
+            try:
+                reclaimed, starts[name] = self._compact_batch(
+                    queues[name], now, self.import_compact_limit,
+                    starts.get(name), 0)
+            except ConflictError:
+                # Leave it to the next time, rather than hold up imports.
+                log.info("Postponed compacting queue %s after a conflict." %
+                         name)
+                continue
+            if sum(reclaimed.values()):
+                _log_compacted(log, name, reclaimed)
+        self._compacted = time.time()
+
+    def _compact_batch(self, queue, now, limit, start, retries):
+        # Compacts a batch of a queue in its own transaction.  A batch which
+        # conflicts with another process is retried from the same place.
+        conflicts = 0
+        while True:
+            try:
+                result = queue.compact(now, limit, start,
+                                       self.duplicate_window)
+                transaction.commit()
+                return result
+            except ConflictError:
+                transaction.abort()
+                conflicts += 1
+                if conflicts > retries:
+                    raise
+            except:
+                transaction.abort()
+                raise
+
+    def send_outbox(self, log=None, batch_size=100):
+        """
+        Sends the bounces and notices which are due in the outbox of every
+        queue, through `sender`, after adding to the outbox the digests of
+        suppressed bounces which are ready to be sent.  Messages are sent in
+        batches of up to 'batch_size', each committed in its own transaction.
+        Messages which cannot be sent are retried later, up to
+        'outbox_max_attempts' times.  Returns a dictionary, keyed by queue
+        name, of dictionaries counting the messages which were 'sent',
+        rescheduled to be 'retried' and discarded as 'failed'.
+        """
+        if log is None:
+            log = _NullLog()
+
+        now = time.time()
+        results = {}
+        with self._get_root.session() as queues:
+            for name in list(queues.keys()):
+                queue = queues[name]
+                outbox = queue.get_outbox()
+                queue.send_bounce_digests(outbox.send)
+                totals = {'sent': 0, 'retried': 0, 'failed': 0}
+                while True:
+                    try:
+                        counts = outbox.drain(self.sender, now, batch_size,
+                                              self.outbox_max_attempts,
+                                              self.outbox_retry_delay,
+                                              log)
+                        transaction.commit()
+                    except:
+                        transaction.abort()
+                        raise
+                    sent, retried, failed = counts
+                    totals['sent'] += sent
+                    totals['retried'] += retried
+                    totals['failed'] += failed
+                    if sum(counts) < batch_size:
+                        break
+                results[name] = totals
+                if totals['sent'] or totals['retried']:
+                    log.info("Sent %d messages from outbox of queue %s, %d "
+                             "to be retried." %
+                             (totals['sent'], name, totals['retried']))
+                if totals['failed']:
+                    log.warn("Gave up sending %d messages from outbox of "
+                             "queue %s." % (totals['failed'], name))
+        return results
+
+    def _import_batch(self, maildir, queues, batch, log, reread):
+        try:
+            for key, message, name in batch:
+                if name is _unrouted:
+                    name = self._route_message(message, log)
+                if name is not None:
+                    self._queue_message(message, queues[name], name, log)
+            transaction.commit()
+        except:
+            transaction.abort()
+            if len(batch) == 1:
+                raise
+            log.warn("Failed to import batch of %d messages, retrying one "
+                     "at a time." % len(batch))
+            for key, message, name in batch:
+                # Reread message, as failed import may have added headers
+                message, name = reread(key)
+                self._import_batch(maildir, queues, [(key, message, name)],
+                                   log, reread)
+            return
+
+        for key, message, name in batch:
+            self._archive_message(maildir, message, key)
+
+    def _route_message(self, message, log):
+        """
+        Checks a message against the reject filters and finds the queue it
+        belongs in.  Returns the name of the queue, or None if the message is
+        to be discarded.  Only the message itself is consulted, so that this
+        may be done by a worker process.
+        """
         user = message.get('From')
         if user is None:
             log.info("Message discarded: no 'From' header: %s" %
                      _log_message(message))
-            return
+            return None
 
         if user == message.get('To'):
             log.info("Message discarded: 'From' and 'To' headers are "
                      "identical: %s" % _log_message(message))
-            return
+            return None
 
         if not message.get('Message-Id'):
             log.info("Message discarded: no 'Message-Id' header: %s" %
                      _log_message(message))
-            return
+            return None
 
         if message.get('X-Postoffice') == 'Bounced':
             log.info("Message discarded: ricocheted bounce message: %s" %
                      _log_message(message))
-            return
+            return None
 
         # Record the message delivery date, in seconds since the epoch,
         # as a header.
@@ -220,38 +609,30 @@ class PostOffice(object):
             if reason is not None:
                 log.info("Message discarded: rejected by filter: %s: %s" %
                          (reason, _log_message(message)))
-                return
+                return None
 
-        for configured in self.configured_queues:
-            filters = configured['filters']
-            if not filters or not _filters_match(filters, message):
-                continue
+        for configured in self._route(message):
+            if _filters_match(configured['filters'], message):
+                return configured['name']
 
-            # Matches queue
-            with self._get_root() as queues:
-                name = configured['name']
-                queue = queues[name]
+        log.info("Message discarded, no matching queues: %s" %
+                 _log_message(message))
+        return None
 
-                if queue.is_duplicate(message):
-                    log.info("Message discarded: duplicate message: %s" %
-                             _log_message(message))
-                else:
-                    self._check_for_auto_response_and_loops(
-                        self, queue, message, log
-                    )
-                    queue.add(message)
-                    queue.collect_frequency_data(message, self.ooo_loop_headers)
-                    log.info("Message added to queue, %s: %s" %
-                             (name, _log_message(message))
-                         )
-            break
-
-        else:
-            log.info("Message discarded, no matching queues: %s" %
+    def _queue_message(self, message, queue, name, log):
+        if queue.is_duplicate(message, self.duplicate_window):
+            log.info("Message discarded: duplicate message: %s" %
                      _log_message(message))
+            return
+
+        self._check_for_auto_response_and_loops(self, queue, message, log)
+        queue.add(message)
+        queue.collect_frequency_data(message, self.ooo_loop_headers,
+                                     self._frequency_window)
+        log.info("Message added to queue, %s: %s" %
+                 (name, _log_message(message)))
 
     def _archive_message(self, maildir, message, key):
-        # XXX It would be nice to wire into transaction with a data manager
         today = datetime.date.today().timetuple()[:3]
         name = '%4d.%02d.%02d' % today
         try:
@@ -303,7 +684,7 @@ class PostOffice(object):
         headers = dict([(name, message.get(name))
                         for name in self.ooo_loop_headers])
         freq = self.ooo_loop_frequency
-        if queue.is_throttled(user, now, message):
+        if queue.is_throttled(user, now, headers):
             log.info("Message rejected, user throttled: %s" %
                      _log_message(message))
             message['X-Postoffice-Rejected'] = 'Throttled'
@@ -414,6 +795,197 @@ def _filters_match(filters, message):
             return False
     return True
 
+class _QueueRouter(object):
+    """
+    Picks out the configured queues which an incoming message might match,
+    without evaluating the filters of every queue.  A queue with a
+    `to_hostname` filter can only match messages addressed to one of that
+    filter's domains, so such queues are indexed by domain.  Queues without
+    one are candidates for every message.  Queues without filters never match.
+    """
+    def __init__(self, queues):
+        self.queues = queues
+        self._unindexed = unindexed = []
+        # (hostnames, suffixes, suffix lengths) for each distinct set of
+        # headers considered by a to_hostname filter.  Hostnames and suffixes
+        # map a domain to a set of queue indices.
+        self._indexes = indexes = {}
+        for index, queue in enumerate(queues):
+            queue_filters = queue['filters']
+            if not queue_filters:
+                continue
+
+            for filter_ in queue_filters:
+                if isinstance(filter_, filters.ToHostnameFilter):
+                    break
+            else:
+                unindexed.append(index)
+                continue
+
+            hostnames, suffixes, lengths = indexes.setdefault(
+                tuple(filter_.headers), ({}, {}, []))
+            for domain in filter_.domains:
+                if domain.startswith('.'):
+                    suffixes.setdefault(domain[1:], set()).add(index)
+                else:
+                    hostnames.setdefault(domain, set()).add(index)
+        for hostnames, suffixes, lengths in indexes.values():
+            lengths[:] = filters._suffix_lengths(suffixes)
+
+    def __call__(self, message):
+        """
+        Returns the candidate queues for a message, in the order they appear
+        in the configuration file.  The filters of each candidate must still
+        be checked.
+        """
+        candidates = set(self._unindexed)
+        for headers, (hostnames, suffixes, lengths) in self._indexes.items():
+            for addr, hostname in filters._addresses(message, headers):
+                candidates.update(hostnames.get(hostname, ()))
+                for suffix in filters._hostname_suffixes(hostname, lengths):
+                    candidates.update(suffixes.get(suffix, ()))
+        queues = self.queues
+        return [queues[index] for index in sorted(candidates)]
+
+class _Reader(object):
+    """
+    Reads messages from a maildir, leaving them to be routed by the caller.
+    """
+    def __init__(self, maildir):
+        self.maildir = maildir
+
+    def read(self, keys, log):
+        """
+        Yields a tuple of the key, the message and the name of its queue for
+        each key.  The queue is not known yet, so is always `_unrouted`.
+        """
+        for key in keys:
+            yield (key,) + self.reread(key)
+
+    def reread(self, key):
+        return self.maildir.get_message(key), _unrouted
+
+    def forget(self):
+        """
+        Called once the messages read so far have been imported.
+        """
+
+    def close(self):
+        pass
+
+class _PoolReader(_Reader):
+    """
+    Reads, parses and routes messages in a pool of worker processes.  Workers
+    hand back the name of the queue each message belongs in, the flattened
+    message and the messages they logged, in the order the messages were
+    asked for.  The process which owns the database connection only parses
+    the headers of each message again.
+
+    Messages are handed to the pool a slice at a time, with one slice being
+    worked on ahead of the one being imported, so that workers don't read
+    the whole Maildir into memory when the importer falls behind.  The pool
+    is only shut down by `close` if it is 'owned' by the reader.
+    """
+    def __init__(self, po, maildir, pool, workers, owned=False):
+        _Reader.__init__(self, maildir)
+        self.pool = pool
+        self.owned = owned
+        self.slice_size = max(po.import_batch_size,
+                              _WORKER_CHUNKSIZE * workers)
+        self.routed = {}
+
+    def read(self, keys, log):
+        size = self.slice_size
+        pending = deque()
+        for start in xrange(0, len(keys), size):
+            pending.append(self.pool.imap(
+                _route_in_worker, keys[start:start + size], _WORKER_CHUNKSIZE))
+            if len(pending) > 1:
+                for item in self._receive(pending.popleft(), log):
+                    yield item
+        while pending:
+            for item in self._receive(pending.popleft(), log):
+                yield item
+
+    def _receive(self, results, log):
+        routed = self.routed
+        for key, result, records in results:
+            for level, msg in records:
+                getattr(log, level)(msg)
+            if result is None:
+                # The worker failed, so find out why in this process.
+                routed.pop(key, None)
+                yield (key,) + _Reader.reread(self, key)
+            else:
+                routed[key] = result
+                yield (key,) + _load_routed(result)
+
+    def reread(self, key):
+        result = self.routed.get(key)
+        if result is None:
+            return _Reader.reread(self, key)
+        return _load_routed(result)
+
+    def forget(self):
+        self.routed.clear()
+
+    def close(self):
+        if self.owned:
+            self.pool.terminate()
+            self.pool.join()
+
+def _init_worker(po):
+    global _worker
+    log = _BufferedLog()
+    factory = _message_factory_factory(po, po.MaildirMessage, log)
+    maildir = po.Maildir(po.maildir, factory=factory, create=False)
+    _worker = (po, maildir, log)
+
+def _route_in_worker(key):
+    po, maildir, log = _worker
+    log.records = []
+    try:
+        message = maildir.get_message(key)
+        name = po._route_message(message, log)
+        state = (message.get_subdir(), message.get_info(), message.get_date())
+        result = (name, _flatten(message), state)
+    except Exception:
+        # Leave it to the importing process to fail in the usual way.
+        return key, None, ()
+    return key, result, log.records
+
+def _load_routed(result):
+    name, text, (subdir, info, date) = result
+    message = LazyStringMessage(text)
+    message.set_subdir(subdir)
+    message.set_info(info)
+    message.set_date(date)
+    return message, name
+
+def _flatten(message):
+    buf = StringIO()
+    if _is_body_loaded(message):
+        Generator(buf, mangle_from_=False).flatten(message)
+    else:
+        # Copy the original body rather than parsing and re-rendering it.
+        message.write_headers(buf)
+        message.write_body(buf)
+    return buf.getvalue()
+
+class _BufferedLog(object):
+    """
+    Keeps messages logged by a worker process, to be logged by the importing
+    process.
+    """
+    def __init__(self):
+        self.records = []
+
+    def info(self, msg):
+        self.records.append(('info', msg))
+
+    def warn(self, msg):
+        self.records.append(('warn', msg))
+
 def _ascii_dammit(x):
     if isinstance(x, bytes):
         x = x.decode('ascii', 'replace')
@@ -433,6 +1005,12 @@ def _log_message(message):
         info.append('Message-Id: %s' % _ascii_dammit(message['Message-Id']))
     return ' '.join(info)
 
+def _log_compacted(log, name, reclaimed):
+    log.info("Compacted queue %s: removed %d senders, %d frequency entries, "
+             "%d throttles and %d message ids." %
+             (name, reclaimed['senders'], reclaimed['entries'],
+              reclaimed['throttles'], reclaimed['message_ids']))
+
 class _RootContextManagerFactory(object):
     """
     Gets the root postoffice object, an instance of
@@ -449,38 +1027,58 @@ class _RootContextManagerFactory(object):
     def __call__(self, tm=None):
         if tm is None:
             tm = transaction
+        with self._open() as conn:
+            try:
+                yield self._get_folder(conn)
+            except:
+                tm.abort()
+                raise
+            else:
+                tm.commit()
+
+    @contextmanager
+    def session(self):
+        """
+        Same as calling the factory, except that transactions are left to be
+        managed by the caller, which allows several transactions to share one
+        database connection.
+        """
+        with self._open() as conn:
+            yield self._get_folder(conn)
+
+    @contextmanager
+    def _open(self):
         db = self.db_from_uri(self.uri)
         conn = db.open()
-        parent = conn.root()
-        for name in self.path[:-1]:
-            parent = parent[name]
-        name = self.path[-1]
         try:
-            folder = parent.get(name)
-            if folder is None:
-                folder = QueuesFolder()
-                parent[name] = folder
-            yield folder
-        except:
-            tm.abort()
-            raise
-        else:
-            tm.commit()
+            yield conn
         finally:
             conn.close()
             db.close()
 
-def _send_mail(from_addr, to_addrs, message, smtplib=smtplib):
-    """
-    Sends mail message immediately through SMTP server located on localhost.
+    def _get_folder(self, conn):
+        parent = conn.root()
+        for name in self.path[:-1]:
+            parent = parent[name]
+        name = self.path[-1]
+        folder = parent.get(name)
+        if folder is None:
+            folder = QueuesFolder()
+            parent[name] = folder
+        return folder
+
+_default_sender = SMTPSender()
 
-    XXX Add some configuration knobs.
+def _send_mail(from_addr, to_addrs, message, sender=None):
+    """
+    Sends mail message immediately through SMTP server located on localhost,
+    reusing the connection from any previous call.  `PostOffice.sender` is
+    configurable.
     """
-    # smtplib passed in for testing
-    if not isinstance(message, str):
-        message = message.as_string()
-    mta = smtplib.SMTP('localhost')
-    mta.sendmail(from_addr, to_addrs, message)
+    # sender passed in for testing
+    if sender is None:
+        sender = _default_sender
+    sender(from_addr, to_addrs, message)
 
 def _message_factory_factory(po, wrapped, log):
     def factory(fp):
@@ -1,6 +1,8 @@
 from __future__ import with_statement
 
+import binascii
 import codecs
+import quopri
 import re
 
 from repoze.postoffice.message import decode_header
@@ -23,15 +25,73 @@ class ToHostnameFilter(object):
         self.domains = expr.lower().split()
         self.headers = headers
 
+        # Hash domains so that looking up a hostname costs the same no matter
+        # how many domains are configured.  Values are (index, domain) so that
+        # the domain listed first wins when several match.  A domain starting
+        # with a period matches any hostname ending with the rest of it, so
+        # suffixes are looked up by the tail of the hostname of each length.
+        self._hostnames = hostnames = {}
+        self._suffixes = suffixes = {}
+        for index, domain in enumerate(self.domains):
+            if domain.startswith('.'):
+                suffixes.setdefault(domain[1:], (index, domain))
+            else:
+                hostnames.setdefault(domain, (index, domain))
+        self._suffix_lengths = _suffix_lengths(suffixes)
+
     def __call__(self, message):
-        addrs = []
-        for header in self.headers:
-            value = message.get(header)
-            if not value:
-                continue
-            addrs.extend(value.split(','))
+        for addr, hostname in _addresses(message, self.headers):
+            domain = self.match_hostname(hostname)
+            if domain is not None:
+                return 'to_hostname: %s matches %s' % (addr, domain)
+
+        return None
+
+    def match_hostname(self, hostname):
+        """
+        Returns the configured domain which matches the given lower case
+        hostname, or None if no domain matches.
+        """
+        found = self._hostnames.get(hostname)
+        suffixes = self._suffixes
+        if suffixes:
+            for suffix in _hostname_suffixes(hostname, self._suffix_lengths):
+                match = suffixes.get(suffix)
+                if match is not None and (found is None or match < found):
+                    found = match
+        if found is not None:
+            return found[1]
+        return None
+
+
+def _suffix_lengths(suffixes):
+    """
+    Returns the distinct lengths of the given suffixes, in ascending order.
+    """
+    return sorted(set([len(suffix) for suffix in suffixes]))
 
-        for addr in addrs:
+def _hostname_suffixes(hostname, lengths):
+    """
+    Yields the tail of the hostname of each of the given lengths, in
+    ascending order, which the hostname is long enough to have.
+    """
+    size = len(hostname)
+    for length in lengths:
+        if length > size:
+            break
+        yield hostname[size - length:]
+
+def _addresses(message, headers):
+    """
+    Yields the addresses found in the given headers of a message, along with
+    the lower case hostname of each.
+    """
+    for header in headers:
+        value = message.get(header)
+        if not value:
+            continue
+
+        for addr in value.split(','):
             lt = addr.find('<')
             if lt != -1:
                 gt = addr.rfind('>')
@@ -40,15 +100,7 @@ class ToHostnameFilter(object):
                 addr = addr[lt+1:gt]
             if '@' not in addr:
                 continue
-            hostname = addr.split('@')[1].lower()
-
-            for domain in self.domains:
-                if domain.startswith('.') and hostname.endswith(domain[1:]):
-                    return 'to_hostname: %s matches %s' % (addr, domain)
-                if hostname == domain:
-                    return 'to_hostname: %s matches %s' % (addr, domain)
-
-        return None
+            yield addr, addr.split('@')[1].lower()
 
 
 class HeaderRegexpFilter(object):
@@ -58,13 +110,15 @@ class HeaderRegexpFilter(object):
     def __init__(self, *exprs):
         self.regexps = [(expr, re.compile(expr))
                         for expr in exprs]
+        self._combined = _RegexpSet(self.regexps)
 
     def __call__(self, message):
+        match = self._combined.match
         for name in message.keys():
             header = '%s: %s' % (name, decode_header(message.get(name)))
-            for regexp, compiled in self.regexps:
-                if compiled.match(header) is not None:
-                    return 'header_regexp: headers match %s' % repr(regexp)
+            regexp = match(header)
+            if regexp is not None:
+                return 'header_regexp: headers match %s' % repr(regexp)
         return None
 
 
@@ -78,23 +132,32 @@ class HeaderRegexpFileFilter(HeaderRegexpFilter):
             for line in f:
                 expr = line.rstrip('\n').rstrip('\r')
                 regexps.append((expr, re.compile(expr)))
+        self._combined = _RegexpSet(regexps)
 
 
 class BodyRegexpFilter(object):
     """
     Matches a regular expression on the body of an email message (any part).
+    If 'max_bytes' is given, only that many bytes at the start of each part
+    are searched.
     """
-    def __init__(self, *exprs):
+    def __init__(self, *exprs, **kw):
+        self.max_bytes = kw.pop('max_bytes', None)
+        if kw:
+            raise TypeError('Unexpected keyword arguments: %s' %
+                            ', '.join(kw.keys()))
         self.regexps = [(expr, re.compile(expr, re.MULTILINE))
                         for expr in exprs]
+        self._combined = _RegexpSet(self.regexps, re.MULTILINE)
 
     def __call__(self, message):
+        max_bytes = self.max_bytes
         for part in message.walk():
             if not part.get_content_type().startswith('text/'):
                 continue
 
             # Get body for this message part as unicode
-            body = part.get_payload(decode=True)
+            body, truncated = _payload_head(part, max_bytes)
             charset = part.get_charset()
             if charset is None:
                 content_type = part.get('Content-Type')
@@ -113,15 +176,15 @@ class BodyRegexpFilter(object):
             try_charsets = filter(None, [charset, 'UTF-8', 'ISO-8859-1'])
             for charset in try_charsets:
                 try:
-                    body = body.decode(charset)
+                    body = _decode(body, charset, not truncated)
                     break
                 except (LookupError, UnicodeError):
                     pass
 
             # See if we match
-            for regexp, compiled in self.regexps:
-                if compiled.search(body) is not None:
-                    return 'body_regexp: body matches %s' % repr(regexp)
+            regexp = self._combined.search(body)
+            if regexp is not None:
+                return 'body_regexp: body matches %s' % repr(regexp)
 
         return None
 
@@ -129,9 +192,142 @@ class BodyRegexpFileFilter(BodyRegexpFilter):
     """
     Same as BodyRegexpFilter but loads regexps from a file.
     """
-    def __init__(self, path):
+    def __init__(self, path, max_bytes=None):
+        self.max_bytes = max_bytes
         self.regexps = regexps = []
         with codecs.open(path, 'r', 'UTF-8') as f:
             for line in f:
                 expr = line.rstrip('\n').rstrip('\r')
                 regexps.append((expr, re.compile(expr, re.MULTILINE)))
+        self._combined = _RegexpSet(regexps, re.MULTILINE)
+
+def _payload_head(part, max_bytes):
+    """
+    Returns the decoded payload of a message part, cut short at 'max_bytes'
+    if given, and whether it was cut short.  Base64 and quoted-printable
+    payloads are decoded a whole number of lines at a time, only as far as
+    is needed to fill 'max_bytes', rather than decoding the whole part.
+    """
+    if not max_bytes:
+        return part.get_payload(decode=True), False
+    payload = part.get_payload()
+    cte = str(part.get('content-transfer-encoding', '')).lower()
+    decode = _TRANSFER_DECODERS.get(cte)
+    if decode is not None and isinstance(payload, str):
+        # Neither encoding shrinks the text by more than half.
+        size = max_bytes * 2
+        while size < len(payload):
+            end = payload.rfind('\n', 0, size) + 1
+            if end:
+                try:
+                    body = decode(payload[:end])
+                except binascii.Error:
+                    break
+                if len(body) > max_bytes:
+                    return body[:max_bytes], True
+            size *= 2
+    body = part.get_payload(decode=True)
+    if len(body) > max_bytes:
+        return body[:max_bytes], True
+    return body, False
+
+_TRANSFER_DECODERS = {
+    'base64': binascii.a2b_base64,
+    'quoted-printable': quopri.decodestring,
+}
+
+def _decode(body, charset, final):
+    if final:
+        return body.decode(charset)
+    # Body has been cut short, possibly in the middle of a multibyte
+    # character, which the incremental decoder will leave off.
+    return codecs.getincrementaldecoder(charset)().decode(body, False)
+
+# Python 2's re module supports at most this many groups per expression.
+_MAX_GROUPS = 99
+
+# Expressions which refer to their own groups by number, or which set flags
+# for the whole expression, would change meaning if combined with others.
+_UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]+\)')
+
+class _RegexpSet(object):
+    """
+    Matches a list of regular expressions against text in a single pass, by
+    combining them into one alternation in which each expression is wrapped
+    in a named group.  The name of the group which matched tells us which of
+    the original expressions matched.  Where the combined expression would
+    exceed the group limit of the `re` module, the expressions are split into
+    several alternations which are tried in turn.
+    """
+    def __init__(self, regexps, flags=0):
+        self.flags = flags
+        self.matchers = matchers = []
+        chunk = []
+        n_groups = 0
+        for expr, compiled in regexps:
+            if _UNCOMBINABLE.search(expr):
+                self._add_chunk(chunk)
+                chunk, n_groups = [], 0
+                matchers.append((compiled, expr))
+                continue
+
+            if n_groups + compiled.groups + 1 > _MAX_GROUPS:
+                self._add_chunk(chunk)
+                chunk, n_groups = [], 0
+            chunk.append((expr, compiled))
+            n_groups += compiled.groups + 1
+        self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk):
+        if not chunk:
+            return
+        if len(chunk) == 1:
+            expr, compiled = chunk[0]
+            self.matchers.append((compiled, expr))
+            return
+
+        names = {}
+        alternatives = []
+        for i, (expr, compiled) in enumerate(chunk):
+            name = '_%d' % i
+            names[name] = expr
+            alternatives.append('(?P<%s>%s)' % (name, expr))
+        try:
+            combined = re.compile('|'.join(alternatives), self.flags)
+        except (re.error, AssertionError, UnicodeError):
+            # Group names clash, or some other trouble we didn't foresee.
+            for expr, compiled in chunk:
+                self.matchers.append((compiled, expr))
+        else:
+            self.matchers.append((combined, names))
+
+    def match(self, text):
+        """
+        Returns the first of the expressions, in the original order, which
+        matches at the beginning of 'text', or None if none of them match.
+        """
+        for compiled, expr in self.matchers:
+            match = compiled.match(text)
+            if match is not None:
+                return _matched_expr(match, expr)
+        return None
+
+    def search(self, text):
+        """
+        Returns the expression which matches earliest in 'text', or None if
+        none of them match.  Where several expressions match at the same
+        position, the first of them in the original order is returned.  Where
+        the expressions had to be split across several alternations, these
+        are tried in turn, so a match found by an earlier alternation is
+        returned even if a later one would have matched earlier in the text.
+        """
+        for compiled, expr in self.matchers:
+            match = compiled.search(text)
+            if match is not None:
+                return _matched_expr(match, expr)
+        return None
+
+def _matched_expr(match, expr):
+    if isinstance(expr, dict):
+        return expr[match.lastgroup]
+    return expr
@@ -14,11 +14,29 @@ this author's opinion, this is a silly way to do things.  Users of the Message
 class should be able to simply assign and get back unicode values for headers
 without having to know about the underlying transfer encoding.  This version
 of Message makes unicode headers transparent, simplifying the calling code.
+
+This module also provides a Maildir message which defers reading and parsing
+the body of a message until it is needed, since many messages can be dealt
+with by looking at their headers alone.
+
+Lastly, this module provides templates for messages which are sent many
+times over with small differences, such as bounces.
 """
+from __future__ import with_statement
+
+from cStringIO import StringIO
+from email.charset import Charset
 from email.header import decode_header as stdlib_decode_header
 from email.header import Header
 from email.message import Message as StdlibMessage
 from email.mime.multipart import MIMEMultipart as StdlibMIMEMultipart
+from email.parser import Parser
+from mailbox import MaildirMessage
+import shutil
+from string import Formatter
+import tempfile
+
+_UTF8 = Charset('UTF-8')
 
 class Message(StdlibMessage):
     def __setitem__(self, name, value):
@@ -36,6 +54,298 @@ class MIMEMultipart(StdlibMIMEMultipart):
         value = StdlibMIMEMultipart.__getitem__(self, name)
         return decode_header(value)
 
+class _LazyBody:
+    """
+    Mixin for messages which only parse their headers up front.  The body is
+    read from the message's source and parsed the first time the payload is
+    needed.  The source is any object whose 'open' method returns a file open
+    on the full text of the message, such as a blob, and is passed to
+    '_parse_header_block' along with a file already open on it.
+
+    The standard library message classes are old style classes which access
+    '_payload' directly, so it is left unset until it is needed and supplied
+    by '__getattr__'.
+    """
+    _part_class = StdlibMessage  # class of parsed body parts
+    _source = None
+    _body_offset = 0
+
+    def __getattr__(self, name):
+        if name == '_payload' and self.__dict__.get('_source') is not None:
+            self._load_body()
+            return self._payload
+        raise AttributeError(name)
+
+    def _parse_header_block(self, fp, source):
+        headers = Parser(StdlibMessage).parsestr(_read_header_block(fp),
+                                                 headersonly=True)
+        self._headers = headers._headers
+        self._unixfrom = headers._unixfrom
+        self._body_offset = fp.tell()
+        self._source = source
+        self.__dict__.pop('_payload', None)
+
+    def _open_source(self):
+        return self._source.open('r')
+
+    def is_body_loaded(self):
+        return '_payload' in self.__dict__
+
+    def open_body(self):
+        """
+        Returns a file open on the unparsed body of the message, as it appears
+        in the message's source.
+        """
+        assert self._source is not None, "Message has no source."
+        fp = self._open_source()
+        fp.seek(self._body_offset)
+        return fp
+
+    def write_headers(self, outfp):
+        """
+        Writes the headers of the message, as they now stand, to the file-like
+        object 'outfp', followed by the blank line which ends them.  Headers
+        are written as they are stored, without folding them again, so that
+        headers read from the message's source are copied unchanged.
+        """
+        for name, value in self.items():
+            if isinstance(value, Header):
+                value = value.encode()
+            outfp.write('%s: %s\n' % (name, value))
+        outfp.write('\n')
+
+    def write_body(self, outfp):
+        """
+        Copies the body of a message whose body has not been loaded, as it
+        appears in the message's source, to the file-like object 'outfp'.
+        """
+        assert not self.is_body_loaded(), "Body already loaded."
+        fp = self.open_body()
+        try:
+            shutil.copyfileobj(fp, outfp)
+        finally:
+            fp.close()
+
+    def detach(self):
+        """
+        Copies the message's source to a temporary file, so that the body can
+        still be loaded once the source has gone away, such as the blob of a
+        message which has been removed from a queue.  The file is removed
+        once the message no longer uses it.
+        """
+        if (self._source is not None and
+            not isinstance(self._source, (_Text, _TemporaryFile))):
+            fp = self._open_source()
+            try:
+                self._source = _TemporaryFile(fp)
+            finally:
+                fp.close()
+
+    def release(self):
+        """
+        Discards the parsed body of the message, freeing the memory it uses.
+        The body will be read again from the message's source if it is needed
+        later.  Any changes made to the body are lost.
+        """
+        if self._source is not None:
+            self.__dict__.pop('_payload', None)
+            self.preamble = self.epilogue = None
+            self.defects = []
+
+    def _load_body(self):
+        fp = self._open_source()
+        try:
+            parsed = Parser(self._part_class).parse(fp)
+        finally:
+            fp.close()
+        # Headers may have been changed since they were read, so keep ours.
+        # A payload set in the meantime takes precedence over the source's.
+        self.__dict__.setdefault('_payload', parsed._payload)
+        for name in ('preamble', 'epilogue', 'defects'):
+            self.__dict__[name] = parsed.__dict__[name]
+
+class LazyMaildirMessage(_LazyBody, MaildirMessage):
+    """
+    A Maildir message which, when read from a file, only parses the headers
+    of the message up front.  The body is read and parsed from the file the
+    first time the payload is needed, for instance by a body filter or when
+    the message is stored.  Until then the file must not be removed.
+    """
+
+    def __init__(self, message=None):
+        path = getattr(message, 'name', None)
+        if path is None or not hasattr(message, 'readline'):
+            MaildirMessage.__init__(self, message)
+            return
+
+        MaildirMessage.__init__(self)
+        self._parse_header_block(message, _File(path))
+
+class LazyStringMessage(_LazyBody, MaildirMessage):
+    """
+    A Maildir message read from a string, for which only the headers are
+    parsed up front.  Messages read and filtered by worker processes are
+    handed back to the importing process in this form.
+    """
+
+    def __init__(self, text=None):
+        MaildirMessage.__init__(self)
+        if text is not None:
+            self._parse_header_block(StringIO(text), _Text(text))
+
+class LazyBlobMessage(_LazyBody, Message):
+    """
+    A message stored in a blob, for which only the headers are parsed up
+    front.  The body is parsed from the blob when it is needed, and may be
+    discarded again using 'release'.
+    """
+    _part_class = Message
+
+    def __init__(self, blob=None):
+        Message.__init__(self)
+        if blob is not None:
+            fp = blob.open('r')
+            try:
+                self._parse_header_block(fp, blob)
+            finally:
+                fp.close()
+
+class _File(object):
+    # The source of a message read from a file
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, mode='r'):
+        return open(self.path, mode)
+
+class _Text(object):
+    # The source of a message held in memory, which opens like a blob
+    def __init__(self, text):
+        self.text = text
+
+    def open(self, mode='r'):
+        return StringIO(self.text)
+
+class _TemporaryFile(object):
+    # The source of a message copied from a file, which is removed along
+    # with this object
+    def __init__(self, fp):
+        self.file = tempfile.NamedTemporaryFile(prefix='postoffice')
+        shutil.copyfileobj(fp, self.file)
+        self.file.flush()
+
+    def open(self, mode='r'):
+        return open(self.file.name, mode)
+
+class NoticeTemplate(object):
+    """
+    A plain text message which is prepared once and then filled in for each
+    recipient.  'text' is the unicode text of the message: any header lines,
+    such as 'Subject', then a blank line, then the body.  Fields to be filled
+    in are named in braces, eg '{reason}', and literal braces are doubled.
+    'fields', if specified, lists the names of the fields which may be used.
+    'headers' is a sequence of (name, value) pairs of headers to add to every
+    message after the template's own.
+
+    Headers without fields are encoded, and the body is broken into encoded
+    fragments, when the template is created, so that rendering a message only
+    encodes the fields.
+    """
+
+    def __init__(self, text, fields=None, headers=()):
+        self.text = text
+        text = text.replace(u'\r\n', u'\n')
+        if text.startswith(u'\n'):
+            head, body = u'', text[1:]
+        elif u'\n\n' in text:
+            head, body = text.split(u'\n\n', 1)
+        else:
+            raise ValueError('Template has no blank line after its headers.')
+
+        self._headers = compiled = []
+        for name, value in _split_headers(head):
+            parts = _compile(value, fields)
+            if len(parts) == 1 and parts[0][1] is None:
+                compiled.append((name, encode_header(name, value), None))
+            else:
+                compiled.append((name, None, parts))
+        self._trailer = [
+            ('MIME-Version', '1.0'),
+            ('Content-Type', 'text/plain; charset="%s"' %
+             _UTF8.get_output_charset()),
+            ('Content-Transfer-Encoding', 'base64'),
+        ] + [(name, encode_header(name, value)) for name, value in headers]
+        self._body = [(literal.encode('UTF-8'), field)
+                      for literal, field in _compile(body, fields)]
+
+    def render(self, from_addr, to_addr, fields):
+        """
+        Returns a new message from 'from_addr' to 'to_addr', with the fields
+        filled in from the 'fields' dictionary.
+        """
+        headers = []
+        for name, encoded, parts in self._headers:
+            if encoded is None:
+                value = u''.join([literal + _field_text(fields, field)
+                                  for literal, field in parts])
+                encoded = encode_header(name, value)
+            headers.append((name, encoded))
+        headers.append(('From', encode_header('From', from_addr)))
+        headers.append(('To', encode_header('To', to_addr)))
+        headers.extend(self._trailer)
+        body = ''.join([
+            literal + _field_text(fields, field).encode('UTF-8')
+            for literal, field in self._body])
+
+        message = Message()
+        message._headers = headers
+        message._payload = _UTF8.body_encode(body)
+        message._charset = _UTF8
+        return message
+
+def _split_headers(head):
+    headers = []
+    for line in head.split(u'\n'):
+        if line[:1] in (u' ', u'\t') and headers:
+            # Continuation line
+            name, value = headers[-1]
+            headers[-1] = (name, value + u' ' + line.strip())
+        elif line.strip():
+            if u':' not in line:
+                raise ValueError('Malformed header in template: %s' % line)
+            name, value = line.split(u':', 1)
+            headers.append((name.strip().encode('ascii'), value.strip()))
+    return headers
+
+def _compile(text, fields):
+    # Splits text into (literal, field) pairs, where field may be None
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(text):
+        if field is not None and fields is not None and field not in fields:
+            raise ValueError('Unknown field in template: %s' % field)
+        parts.append((literal, field))
+    return parts or [(u'', None)]
+
+def _field_text(fields, field):
+    if field is None:
+        return u''
+    value = fields[field]
+    if isinstance(value, str):
+        return value.decode('UTF-8', 'replace')
+    return unicode(value)
+
+def _read_header_block(fp):
+    """
+    Reads lines from a file up to and including the blank line which ends the
+    headers of a message.
+    """
+    lines = []
+    for line in iter(fp.readline, ''):
+        lines.append(line)
+        if not line.rstrip('\r\n'):
+            break
+    return ''.join(lines)
+
 def encode_header(name, value):
     if value is None:
         return None
@@ -1,19 +1,81 @@
 from datetime import datetime
+from datetime import timedelta
+from email import message_from_string
 from email.generator import Generator
 from email.message import Message as StdlibMessage
-from email.parser import Parser
+from email.utils import parseaddr
 from email.utils import parsedate
+from bisect import bisect_left
+import heapq
+from itertools import imap
+from itertools import islice
+import math
+from operator import itemgetter
+from random import SystemRandom
 from time import time
+import weakref
+from zlib import crc32
 
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import intersection
 from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from BTrees.LOBTree import LOBTree
 from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
 from persistent import Persistent
-from persistent.dict import PersistentDict
-from persistent.list import PersistentList
 from repoze.zodbconn.uri import db_from_uri
 from ZODB.blob import Blob
+from ZODB.POSException import ConflictError
 
+from .message import LazyBlobMessage
 from .message import Message
+from .message import NoticeTemplate
+
+# Number of random bits in the low end of message keys.
+_RANDOM_BITS = 20
+_RANDOM_MASK = (1 << _RANDOM_BITS) - 1
+_random = SystemRandom()
+_last_key = 0
+
+# Number of messages in a bucket of a queue partition, after which producers
+# start a new bucket, see _Partition.
+_BUCKET_SIZE = 100
+
+# Largest id of a quarantined message, the largest key of an IOBTree.
+_MAX_ID = (1 << 31) - 1
+
+# Default number of minutes for which message frequencies are kept.
+FREQUENCY_WINDOW = 60
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Default period, in seconds, during which a Message-Id is remembered for the
+# purpose of duplicate detection.
+DUPLICATE_WINDOW = 24 * 60 * 60
+
+# Default period, in seconds, over which bounces to a recipient are limited.
+BOUNCE_WINDOW = 60 * 60
+
+# Bounces sent to a user are counted and throttled under these headers, apart
+# from messages received from the user.
+_BOUNCE_HEADERS = {'X-Postoffice': 'Bounced'}
+_BOUNCE_ITEM = ('X-Postoffice', 'Bounced')
+
+# Number of distinct bounce reasons listed in a digest.
+_MAX_DIGEST_REASONS = 10
+
+# Kinds of notices sent by queues, with the fields which their templates may
+# use, see compile_notice_template.
+NOTICE_FIELDS = {
+    'bounce': ('date', 'to', 'reason'),
+    'quarantine_notice': ('date', 'to'),
+    'bounce_digest': ('count', 'first', 'last', 'reasons'),
+}
+
+# Headers added to every notice, so that notices which find their way back
+# to the post office are recognized.
+_NOTICE_HEADERS = (('X-Postoffice', 'Bounced'),)
 
 
 def open_queue(db_or_uri, queue_name, path='postoffice'):
@@ -28,6 +90,18 @@ def open_queue(db_or_uri, queue_name, path='postoffice'):
     return find_queue(conn.root(), queue_name, path), closer
 
 
+def compile_notice_template(kind, text):
+    """
+    Returns a `NoticeTemplate` made from 'text' for notices of the given
+    'kind', one of the keys of `NOTICE_FIELDS`.  Raises ValueError if the
+    template uses a field which notices of that kind do not have.
+    """
+    fields = NOTICE_FIELDS.get(kind)
+    if fields is None:
+        raise ValueError('Unknown kind of notice: %s' % kind)
+    return NoticeTemplate(text, fields, _NOTICE_HEADERS)
+
+
 def find_queue(dbroot, queue_name, path='postoffice'):
     queues = dbroot
     for name in path.strip('/').split('/'):
@@ -61,25 +135,73 @@ class QueuesFolder(OOBTree):
 class Queue(Persistent):
     """
     Implements a first in first out (FIFO) message queue.
+
+    Messages are stored in one or more partitions.  Messages are added to
+    partitions at random, and are retrieved from all partitions in FIFO order
+    unless a consumer asks for a particular partition.  Producers do not
+    conflict with each other, nor with a consumer, however few messages are
+    queued, see `_Partition`.  Using several partitions allows several
+    consumers to consume the queue concurrently without conflicting with one
+    another.
     """
-    def __init__(self):
+    _message_id_times = None  # BBB persistence, built lazily
+    _partitions = None  # BBB persistence, see _get_partitions
+    _message_count = None  # BBB persistence, see _get_message_count
+    _quarantine_count = None  # BBB persistence, see _get_quarantine_count
+    _quarantine_index = None  # BBB persistence, see _get_quarantine_index
+    _throttles = None  # BBB persistence, see _get_throttles
+    _throttle_times = None  # BBB persistence, see _get_throttle_times
+    _unmigrated_throttles = False  # BBB persistence, see _migrate_throttles
+    _outbox = None  # Created when first needed, see get_outbox
+    _bounce_digests = None  # Created when first needed, see _suppress_bounce
+    _suppressed_bounce_count = None  # Likewise
+    _notice_templates = None  # Defaults, see set_notice_template
+    _v_notice_templates = None  # Prepared templates, see _get_notice_template
+    bounce_limit = None  # See set_bounce_limit
+    bounce_window = BOUNCE_WINDOW
+    bounce_digest = False
+
+    def __init__(self, partitions=1):
         self._quarantine = IOBTree()
-        self._messages = IOBTree()
+        self._quarantine_count = Length()
+        self._quarantine_index = _QuarantineIndex()
+        self._partitions = tuple([_Partition() for i in xrange(partitions)])
+        self._message_count = Length()
         self._freq_data = OOBTree()
         self._message_ids = OOBTree()
+        self._message_id_times = OOTreeSet()
+        self._throttles = OOBTree()
+        self._throttle_times = OOTreeSet()
 
     def add(self, message):
         """
         Add a message to the queue.
         """
-        id = message['Message-Id']
+        message_id = message['Message-Id']
         orig_to = message['X-Original-To']
-        self._message_ids[message['Message-Id']] = (time(), orig_to)
+        timestamp = time()
+        self._message_ids[message_id] = (timestamp, orig_to)
+        self._index_message_id(message_id, timestamp)
         message = _QueuedMessage(message)
-        id = _new_id(self._messages)
-        self._messages[id] = message
-
-    def is_duplicate(self, message):
+        count = self._get_message_count()
+        partitions = self._get_partitions()
+        key = _new_key()
+        messages = partitions[key % len(partitions)]
+        last = messages.max_key()
+        while last is not None and key <= last:
+            # Another producer's clock is ahead of ours
+            key = _new_key(last)
+            messages = partitions[key % len(partitions)]
+            last = messages.max_key()
+        messages.add(key, message)
+        count.change(1)
+
+    def is_duplicate(self, message, window=DUPLICATE_WINDOW):
+        """
+        Returns boolean indicating whether a message with the same
+        'Message-Id' and 'X-Original-To' headers has been added to this queue
+        within the last 'window' seconds.
+        """
         try:
             message_ids = self._message_ids
         except AttributeError:
@@ -87,30 +209,77 @@ class Queue(Persistent):
             self._message_ids = message_ids = OOBTree()
             return False
 
-        # Don't grow message_ids forever--prune entries old than 24 hours
-        cutoff = time() - 24 * 60 * 60
-        for id, timestamp_orig_to in message_ids.items():
-            try:
-               timestamp, orig_to = timestamp_orig_to
-            except TypeError: #BBB
-               timestamp = timestamp_orig_to
-            if timestamp < cutoff:
-                del message_ids[id]
-
+        # Entries older than the window are removed by compact
+        cutoff = time() - window
         timestamp_orig_to = message_ids.get(message['Message-Id'])
         if timestamp_orig_to is None:
             return False
-        try:
-           _, orig_to = timestamp_orig_to
-        except TypeError: # BBB
-           orig_to = None
+        timestamp, orig_to = _split_message_id_entry(timestamp_orig_to)
+        if timestamp < cutoff:
+            # Expired, but not yet removed
+            return False
         return orig_to == message.get('X-Original-To')
 
-    def collect_frequency_data(self, message, headers=None):
+    def _get_message_id_times(self):
+        """
+        Returns the index of message ids, a set of (timestamp, message id)
+        pairs in the order in which the message ids were added.  Queues
+        created before the index existed have it built from the message ids
+        on first use, which is by `compact`, so that producers never write to
+        the queue itself.
+        """
+        index = self._message_id_times
+        if not isinstance(index, OOTreeSet):
+            # BBB persistence, also replaces an index of per minute buckets
+            self._message_id_times = index = OOTreeSet()
+            for message_id, entry in self._message_ids.items():
+                timestamp, _ = _split_message_id_entry(entry)
+                index.insert((timestamp, message_id))
+        return index
+
+    def _index_message_id(self, message_id, timestamp):
+        # Each message id gets its own key, so concurrent producers only
+        # insert distinct keys, which BTree conflict resolution can merge.
+        index = self._message_id_times
+        if isinstance(index, OOTreeSet):
+            index.insert((timestamp, message_id))
+        # Otherwise the index is built from _message_ids when first needed.
+
+    def _prune_message_ids(self, cutoff, limit=None):
+        """
+        Forgets message ids added before 'cutoff', a time in seconds since the
+        epoch.  Only expired entries of the index are visited, so the cost
+        is proportional to the number of expired entries rather than to the
+        number of remembered ones.  If 'limit' is specified, at most that many
+        entries are visited.  Returns a tuple of the number of message ids
+        forgotten and the number of entries visited.
+        """
+        message_ids = self._message_ids
+        index = self._get_message_id_times()
+        # (timestamp, message_id) sorts before (cutoff,) if timestamp < cutoff
+        expired = list(islice(index.keys(max=(cutoff,)), limit))
+        removed = 0
+        for entry in expired:
+            index.remove(entry)
+            timestamp, message_id = entry
+            current = message_ids.get(message_id)
+            if current is None:
+                continue
+            timestamp, _ = _split_message_id_entry(current)
+            # A message id added again later is indexed again, later.
+            if timestamp < cutoff:
+                del message_ids[message_id]
+                removed += 1
+        return removed, len(expired)
+
+    def collect_frequency_data(self, message, headers=None,
+                               window=FREQUENCY_WINDOW):
         """
         Store data about frequency of message submission from sender of this
         message.  'headers', if specified, is a list of header names to store
-        along with times, for use as discriminators.
+        along with times, for use as discriminators.  Messages are counted
+        per minute for the last 'window' minutes, which should cover the
+        longest interval passed to `get_average_frequency`.
         """
         user = message['From']
 
@@ -127,22 +296,123 @@ class Queue(Persistent):
         else:
             headers = dict([(name, message[name]) for name in headers])
 
-        times = self._freq_data.get(user)
-        if times is None:
-            times = _FreqData()
-            self._freq_data[user] = times
-        times.append((date,headers))
+        freq_data = self._freq_data.get(user)
+        if freq_data is None:
+            freq_data = _FreqData()
+            self._freq_data[user] = freq_data
+        freq_data.record(date, headers, window)
 
-    def pop_next(self):
+    def pop_next(self, partition=None):
         """
         Retrieve the next message in the queue, removing it from the queue.
+
+        'partition', if specified, is the index of a partition of the queue
+        from which to retrieve the message.  Consumers which each use a
+        different partition can consume a queue concurrently without
+        conflicting with each other.
+        """
+        key, message, messages, queue = self._iter_messages(partition).next()
+        return _take_message(queue._remove(messages, key))
+
+    def pop_many(self, n, partition=None):
+        """
+        Retrieve up to 'n' messages from the front of the queue, removing them
+        from the queue.  Returns an iterator over the messages in FIFO order.
+        'partition' is as for `pop_next`.
+
+        The messages are removed from the queue at once, but each is only
+        loaded as the iterator reaches it.
+        """
+        keys = list(islice(self._iter_messages(partition), n))
+        # The count of each queue, or shard, is changed once for the batch.
+        # A bucket is only written once per transaction however many of its
+        # messages are removed.
+        counts = {}
+        popped = []
+        for key, message, messages, queue in keys:
+            popped.append(messages.pop(key))
+            counts[queue] = counts.get(queue, 0) + 1
+        for queue, count in counts.items():
+            queue._get_message_count().change(-count)
+        return imap(_take_message, popped)
+
+    def get_messages(self):
+        """
+        Returns an iterator over the messages in the queue, in FIFO order,
+        without removing them from the queue.
         """
-        key = iter(self._messages.keys()).next()
-        message = self._messages.pop(key)
-        return message.get()
+        for key, message, messages, queue in self._iter_messages(None):
+            yield message.open()
+
+    def count_partitions(self):
+        """
+        Returns the number of partitions in which messages are stored.
+        """
+        return len(self._get_partitions())
+
+    def repartition(self, partitions):
+        """
+        Changes the number of partitions in which messages are stored.  Queued
+        messages are moved to their new partitions, keeping their order.
+        Consumers should be stopped while the queue is repartitioned.
+        """
+        old = self._get_partitions()
+        if len(old) == partitions:
+            return
+        new = tuple([_Partition() for i in xrange(partitions)])
+        for key, message in heapq.merge(*[messages.items()
+                                          for messages in old]):
+            new[key % partitions].add(key, message)
+        self._partitions = new
+
+    def _get_partitions(self):
+        partitions = self._partitions
+        if partitions is None:
+            # BBB persistence, queues used to keep a single tree of
+            # sequentially numbered messages.  The old keys sort before any
+            # new ones.
+            messages = _Partition()
+            for key, message in self._messages.items():
+                messages.add(key, message)
+            self._partitions = partitions = (messages,)
+            del self._messages
+        return partitions
+
+    def _iter_messages(self, partition):
+        # Iterates over (key, message, partition, queue) tuples in FIFO order
+        partitions = self._get_partitions()
+        if partition is not None:
+            partitions = (partitions[partition],)
+        if len(partitions) == 1:
+            return _iter_partition(partitions[0], self)
+        return heapq.merge(*[_iter_partition(messages, self)
+                             for messages in partitions])
+
+    def _remove(self, messages, key):
+        self._get_message_count().change(-1)
+        return messages.pop(key)
+
+    def _get_message_count(self):
+        count = self._message_count
+        if count is None:
+            # BBB persistence, count the messages once
+            self._message_count = count = Length(self._count_messages())
+        return count
+
+    def _count_messages(self):
+        # Visits every bucket of every partition
+        partitions = self._partitions
+        if partitions is None:
+            # BBB persistence
+            return self._messages.__len__()
+        return sum([len(messages) for messages in partitions])
 
     def __len__(self):
-        return self._messages.__len__()
+        count = self._message_count
+        if count is None:
+            # BBB persistence
+            return self._count_messages()
+        return count()
 
     def bounce(self, message, send,
                bounce_from_addr,
@@ -167,32 +437,199 @@ class Queue(Persistent):
         Implementations can be found in `repoze.sendmail`.  See
         `repoze.sendmail.delivery.QueuedMailDelivery.send` or
         `repoze.sendmail.delivery.DirectMailDelivery.send`.
+
+        If the number of bounces sent to the sender is limited, see
+        `set_bounce_limit`, the bounce may be suppressed instead.  Returns
+        boolean indicating whether the bounce was sent.
         """
         if bounce_reason is not None and bounce_message is not None:
             raise ValueError(
                 "May only specify one of either 'bounce_reason' or "
                 "'bounce_message'."
             )
+        if bounce_message is None and bounce_reason is None:
+            bounce_reason = u'Email message is invalid.'
+
+        if self.bounce_limit is not None:
+            if bounce_message is not None:
+                reason = bounce_message.get('Subject', u'')
+            else:
+                reason = bounce_reason
+            if not self._limit_bounce(message['From'], bounce_from_addr,
+                                      reason):
+                return False
 
         toaddrs = [message['From'],]
         if bounce_message is None:
-            if bounce_reason is None:
-                bounce_reason = u'Email message is invalid.'
             if 'Date' in message:
                 date = message['Date']
             else:
                 date = datetime.now().ctime()
-            bounce_to = message['To']
-            subject = 'Your message to %s has bounced.' % bounce_to
-            bounce_message = Message()
-            bounce_message['Subject'] = subject
-            bounce_message['From'] = bounce_from_addr
-            bounce_message['To'] = message['From']
-            body = _default_bounce_body % (date, bounce_to, bounce_reason)
-            bounce_message.set_payload(body.encode('UTF-8'), 'UTF-8')
-
-        bounce_message['X-Postoffice'] = 'Bounced'
+            fields = {'date': date, 'to': message['To'],
+                      'reason': bounce_reason}
+            bounce_message = self._get_notice_template('bounce').render(
+                bounce_from_addr, message['From'], fields)
+        else:
+            bounce_message['X-Postoffice'] = 'Bounced'
+
         send(bounce_from_addr, toaddrs, bounce_message)
+        return True
+
+    def set_notice_template(self, kind, text):
+        """
+        Sets the template used for notices of the given 'kind': 'bounce' for
+        messages sent by `bounce`, 'quarantine_notice' for those sent by
+        `quarantine` and 'bounce_digest' for those sent by
+        `send_bounce_digests`.  'text' is the unicode text of the template,
+        see `compile_notice_template`, which raises ValueError if it is not
+        valid.  If 'text' is None, the default template is used.
+
+        Only the text is stored with the queue.  The template is prepared
+        again from it the first time it is used after the queue is loaded.
+        """
+        if kind not in NOTICE_FIELDS:
+            raise ValueError('Unknown kind of notice: %s' % kind)
+        templates = dict(self._notice_templates or {})
+        if text is None:
+            templates.pop(kind, None)
+        else:
+            compile_notice_template(kind, text)
+            templates[kind] = text
+        self._notice_templates = templates or None
+
+    def get_notice_template(self, kind):
+        """
+        Returns the text of the template set for notices of the given 'kind',
+        or None if the default template is used.
+        """
+        return (self._notice_templates or {}).get(kind)
+
+    def _get_notice_template(self, kind):
+        text = self.get_notice_template(kind)
+        if text is None:
+            return _DEFAULT_NOTICE_TEMPLATES[kind]
+        cache = self._v_notice_templates
+        if cache is None:
+            cache = self._v_notice_templates = {}
+        template = cache.get(kind)
+        if template is None or template.text != text:
+            template = cache[kind] = compile_notice_template(kind, text)
+        return template
+
+    def set_bounce_limit(self, limit, window=BOUNCE_WINDOW, digest=False):
+        """
+        Limits the number of bounces sent by `bounce` to any one recipient to
+        'limit' in 'window' seconds.  Once the limit is reached, further
+        bounces to the recipient are suppressed for 'window' seconds.  If
+        'digest' is true, suppressed bounces are summarized in a single
+        message sent to the recipient by `send_bounce_digests` once the
+        recipient is no longer being limited.  A 'limit' of None removes the
+        limit.
+        """
+        if limit is not None and limit < 1:
+            raise ValueError("Bounce limit must be at least 1.")
+        self.bounce_limit = limit
+        self.bounce_window = window
+        self.bounce_digest = digest
+
+    def get_bounce_limit(self):
+        """
+        Returns a tuple of the 'limit', 'window' and 'digest' set by
+        `set_bounce_limit`.
+        """
+        return self.bounce_limit, self.bounce_window, self.bounce_digest
+
+    def count_suppressed_bounces(self):
+        """
+        Returns the number of bounces which have been suppressed because of
+        the bounce limit.
+        """
+        count = self._suppressed_bounce_count
+        if count is None:
+            return 0
+        return count()
+
+    def send_bounce_digests(self, send, now=None):
+        """
+        Sends a digest of the bounces which were suppressed to each recipient
+        which is no longer being limited at 'now', an instance of
+        datetime.datetime, using 'send', as for `bounce`.  Returns the number
+        of digests sent.
+        """
+        if now is None:
+            now = datetime.now()
+        return self._send_bounce_digests(
+            send, now, self._get_notice_template('bounce_digest'))
+
+    def _send_bounce_digests(self, send, now, template):
+        digests = self._bounce_digests
+        if not digests:
+            return 0
+        sent = 0
+        for recipient in list(digests.keys()):
+            if self.is_throttled(recipient, now, _BOUNCE_HEADERS):
+                continue
+            digest = digests.pop(recipient)
+            send(digest.from_addr, [recipient,],
+                 digest.make_message(recipient, template))
+            sent += 1
+        return sent
+
+    def _limit_bounce(self, recipient, from_addr, reason):
+        """
+        Counts a bounce to 'recipient', throttling further bounces once the
+        bounce limit is reached.  Returns boolean indicating whether the
+        bounce may be sent.
+        """
+        now = datetime.now()
+        if self.is_throttled(recipient, now, _BOUNCE_HEADERS):
+            self._suppress_bounce(recipient, from_addr, reason, now,
+                                  self.bounce_digest)
+            return False
+        window = self.bounce_window
+        if self._record_bounce(recipient, now, window) >= self.bounce_limit:
+            self.throttle(recipient, now + timedelta(seconds=window),
+                          _BOUNCE_HEADERS)
+        return True
+
+    def _record_bounce(self, recipient, now, window):
+        """
+        Records a bounce in the recipient's frequency data, apart from the
+        messages received from the recipient.  Returns the number of bounces
+        sent to the recipient in the last 'window' seconds.
+        """
+        freq_data = self._freq_data.get(recipient)
+        if freq_data is None:
+            freq_data = _FreqData()
+            self._freq_data[recipient] = freq_data
+        freq_data.record(now, _BOUNCE_HEADERS,
+                         int(math.ceil(window / 60.0)) + 1)
+        # Count the current minute in full
+        start = _datetime_as_seconds(now) - window
+        end = (_minute(now) + 1) * 60
+        count = 0.0
+        for ring in freq_data.matching(_BOUNCE_HEADERS):
+            count += ring.count(start, end)
+        return count
+
+    def _suppress_bounce(self, recipient, from_addr, reason, now, digest):
+        """
+        Counts a bounce to 'recipient' which was suppressed, and adds it to
+        the digest of suppressed bounces if 'digest' is true.
+        """
+        count = self._suppressed_bounce_count
+        if count is None:
+            self._suppressed_bounce_count = count = Length()
+        count.change(1)
+        if not digest:
+            return
+        digests = self._bounce_digests
+        if digests is None:
+            self._bounce_digests = digests = OOBTree()
+        digest = digests.get(recipient)
+        if digest is None:
+            digests[recipient] = digest = _BounceDigest(from_addr, now)
+        digest.add(reason, now)
 
     def quarantine(self, message, error, send=None, notice_from=None):
         """
@@ -224,41 +661,114 @@ class Queue(Persistent):
                              "notice.")
 
         quarantine = self._quarantine
+        # Get the count and index before adding the message, so that they
+        # don't include it already on queues which have them built lazily.
+        count = self._get_quarantine_count()
+        index = self._get_quarantine_index()
         id = _new_id(quarantine)
         message['X-Postoffice-Id'] = str(id)
+        count.change(1)
         quarantine[id] = (_QueuedMessage(message), error)
+        index.index(id, _quarantine_summary(message, error))
 
         if send is not None:
-            notice = Message()
-            notice['Subject'] = ('An error has occurred while processing your '
-                                 'email to %s' % message['To'])
-            notice['From'] = notice_from
-            notice['To'] = message['From']
-            if 'Date' in message:
-                date = message['Date']
-            else:
-                date = datetime.now().ctime()
-            notice['X-Postoffice'] = 'Bounced'
-            body = _quarantine_notice_body % (date, message['To'])
-            notice.set_payload(body.encode('UTF-8'), 'UTF-8')
-            send(notice_from, [message['From'],], notice)
+            self._send_quarantine_notice(message, send, notice_from)
+
+    def _send_quarantine_notice(self, message, send, notice_from):
+        if 'Date' in message:
+            date = message['Date']
+        else:
+            date = datetime.now().ctime()
+        fields = {'date': date, 'to': message['To']}
+        notice = self._get_notice_template('quarantine_notice').render(
+            notice_from, message['From'], fields)
+        send(notice_from, [message['From'],], notice)
+
+    def get_outbox(self):
+        """
+        Returns the queue's `Outbox`, whose `send` method may be passed as the
+        'send' argument to `bounce` and `quarantine`, so that bounces and
+        notices are sent later, once the current transaction has been
+        committed.
+        """
+        outbox = self._outbox
+        if outbox is None:
+            self._outbox = outbox = Outbox()
+        return outbox
 
     def get_quarantined_messages(self):
         """
         Returns an iterator over the messages currently in the quarantine.
+        Each message is read afresh from the database and is not kept in
+        memory once it is no longer used.
         """
         for message, error in self._quarantine.values():
-            yield message.get(), error
+            yield message.open(), error
 
     def get_quarantined_message(self, id):
         id = int(id)
-        return self._quarantine[id][0].get()
+        return self._quarantine[id][0].open()
+
+    def find_quarantined_messages(self, error_type=None, sender=None,
+                                  since=None, until=None):
+        """
+        Returns a list of the messages in the quarantine which match all of
+        the given criteria, in the order in which they were quarantined,
+        without loading the messages themselves.  'error_type' is the name of
+        the exception class, eg 'KeyError', in the exception info passed to
+        `quarantine`.  'sender' is the email address of the sender of the
+        message.  'since' and 'until' are instances of datetime.datetime
+        between which the message was quarantined.
+
+        Each item of the list is a tuple of the id of the message, which may
+        be passed to `get_quarantined_message`, and a dictionary summarizing
+        the message: its 'from', 'to', 'subject', 'date' and 'message_id'
+        headers, the 'error_type' and the time it was 'quarantined'.
+        """
+        found = self._get_quarantine_index().find(
+            error_type, sender, since, until)
+        return [(str(id), summary) for id, summary in found]
+
+    def count_quarantined_errors(self):
+        """
+        Returns a dictionary mapping the names of the types of error for which
+        messages are in the quarantine to the number of such messages.
+        """
+        return self._get_quarantine_index().count_errors()
+
+    def _get_quarantine_index(self):
+        """
+        Returns the summaries and indexes of the messages in the quarantine.
+        Queues created before the index existed have it built from the
+        quarantined messages on first use.
+        """
+        index = self._quarantine_index
+        if index is None:
+            # BBB persistence, the time each message was quarantined is
+            # not known, so the message's own date is used instead.
+            self._quarantine_index = index = _QuarantineIndex()
+            for id, (message, error) in self._quarantine.items():
+                message = message.open()
+                index.index(id, _quarantine_summary(
+                    message, error, _parse_date(message.get('Date'))))
+        return index
 
     def count_quarantined_messages(self):
         """
         Returns the number of messages in the quarantine.
         """
-        return len(self._quarantine)
+        count = self._quarantine_count
+        if count is None:
+            # BBB persistence
+            return len(self._quarantine)
+        return count()
+
+    def _get_quarantine_count(self):
+        count = self._quarantine_count
+        if count is None:
+            # BBB persistence, count the messages once
+            self._quarantine_count = count = Length(len(self._quarantine))
+        return count
 
     def remove_from_quarantine(self, message):
         """
@@ -270,6 +780,8 @@ class Queue(Persistent):
         id = int(id)
         if id not in self._quarantine:
             raise ValueError("Message is not in the quarantine.")
+        self._get_quarantine_count().change(-1)
+        self._get_quarantine_index().unindex(id)
         del self._quarantine[id]
         del message['X-Postoffice-Id']
 
@@ -298,12 +810,12 @@ class Queue(Persistent):
         if headers is None:
             headers = {}
         freq_data = self._freq_data.get(user)
-        if not freq_data:
+        if freq_data is None:
             return 0.0
-        times = self._filter_freq_data(freq_data, headers)
+        times = [ring.last for ring in freq_data.matching(headers)]
         if not times:
             return 0.0
-        delta = _timedelta_as_seconds(now - times[-1])
+        delta = _timedelta_as_seconds(now - max(times))
         if delta == 0.0:
             return float('inf')
         return 60.0 / delta
@@ -319,21 +831,20 @@ class Queue(Persistent):
         instance of `datetime.timedelta`. 'headers', if specified, is a
         dictionary of header names and values that will be use to filter
         results. Only messages for which matching header data has ben stored
-        will be included in the anaylysis. Frequency data for messages
-        received prior to the interval of interest will be deleted.
+        will be included in the anaylysis.  Messages are counted per minute,
+        so minutes which are partly inside the interval contribute in
+        proportion.
         """
         if headers is None:
             headers = {}
         freq_data = self._freq_data.get(user)
-        start = now - interval
-        while freq_data and freq_data[0][0] < start:
-            del freq_data[0]
-        if not freq_data:
+        if freq_data is None:
             return 0.0
-        count = 0
-        for timestamp in self._filter_freq_data(freq_data, headers):
-            if timestamp < now:
-                count += 1
+        start = _datetime_as_seconds(now - interval)
+        end = _datetime_as_seconds(now)
+        count = 0.0
+        for ring in freq_data.matching(headers):
+            count += ring.count(start, end)
         return 60.0 * count / _timedelta_as_seconds(interval)
 
     def throttle(self, user, until, headers=None):
@@ -344,17 +855,11 @@ class Queue(Persistent):
         names and values.  Only incoming messages which match these headers
         will be throttled.
         """
-        freq_data = self._freq_data.get(user)
-        if freq_data is None:
-            freq_data = _FreqData()
-            self._freq_data[user] = freq_data
-
-        if headers is None:
-            key = ()
-        else:
-            key = tuple(sorted(headers.items()))
-
-        freq_data.throttles[key] = until
+        key = (user, _throttle_key(headers))
+        throttles = self._get_throttles()
+        self._migrate_throttles(user)
+        throttles[key] = until
+        self._index_throttle(key, until)
 
     def is_throttled(self, user, now, headers=None):
         """
@@ -363,35 +868,619 @@ class Queue(Persistent):
         specified, is a dictionary of header names and values. Only incoming
         messages which match these headers are throttled.
         """
+        throttles = self._get_throttles()
+        self._migrate_throttles(user)
+        until = throttles.get((user, _throttle_key(headers)))
+        # Expired throttles are removed by compact
+        return until is not None and until >= now
 
+    def get_throttles(self, now):
+        """
+        Returns a list of the throttles in effect at 'now', an instance of
+        datetime.datetime, ordered by the time they expire.  Each throttle is
+        a tuple of the user, the dictionary of headers it applies to and the
+        time at which it expires.
+        """
+        throttles = self._get_throttles()
+        index = self._throttle_times
+        found = []
+        if isinstance(index, OOTreeSet):
+            # (until, key) sorts after (now,) if until >= now
+            for until, key in index.keys(min=(now,)):
+                if throttles.get(key) != until:
+                    # Renewed, and indexed again under its new time
+                    continue
+                user, headers = key
+                found.append((until, user, dict(headers)))
+        else:
+            # BBB persistence, the index is built by compact
+            for (user, headers), until in throttles.items():
+                if until >= now:
+                    found.append((until, user, dict(headers)))
+        if self._unmigrated_throttles:
+            for user, freq_data in self._freq_data.items():
+                old = freq_data.__dict__.get('throttles')
+                if old is None:
+                    continue
+                for headers, until in old.items():
+                    if until >= now and (user, headers) not in throttles:
+                        found.append((until, user, dict(headers)))
+        found.sort()
+        return [(user, headers, until) for until, user, headers in found]
+
+    def _get_throttles(self):
+        """
+        Returns the throttles keyed by user and the sorted header names and
+        values they apply to.  Queues created before throttles were kept here
+        have them moved from each sender's frequency data a sender at a time,
+        see `_migrate_throttles`.
+        """
+        throttles = self._throttles
+        if throttles is None:
+            # BBB persistence
+            self._throttles = throttles = OOBTree()
+            self._throttle_times = OOTreeSet()
+            self._unmigrated_throttles = True
+        return throttles
+
+    def _migrate_throttles(self, user):
+        """
+        Moves the throttles of 'user' which an old queue kept in the sender's
+        frequency data.  Senders are migrated when they are next seen, or
+        when compact visits them, so that no single transaction has to move
+        every sender's throttles.
+        """
+        if not self._unmigrated_throttles:
+            return
         freq_data = self._freq_data.get(user)
         if freq_data is None:
-            return False
+            return
+        old = freq_data.__dict__.get('throttles')
+        if old is None:
+            return
+        throttles = self._throttles
+        for headers, until in old.items():
+            key = (user, headers)
+            if key not in throttles:
+                throttles[key] = until
+                self._index_throttle(key, until)
+        del freq_data.throttles
+
+    def _get_throttle_times(self):
+        """
+        Returns the index of throttles, a set of (until, key) pairs in the
+        order in which the throttles expire.  Queues created before the index
+        existed have it built from the throttles on first use, which is by
+        `compact`, so that producers never write to the queue itself.
+        """
+        index = self._throttle_times
+        if not isinstance(index, OOTreeSet):
+            # BBB persistence, also replaces an index of per minute buckets
+            self._throttle_times = index = OOTreeSet()
+            for key, until in self._get_throttles().items():
+                index.insert((until, key))
+        return index
+
+    def _index_throttle(self, key, until):
+        # Each throttle gets its own key, so concurrent producers only insert
+        # distinct keys, which BTree conflict resolution can merge.
+        index = self._throttle_times
+        if isinstance(index, OOTreeSet):
+            index.insert((until, key))
+        # Otherwise the index is built from _throttles when first needed.
+
+    def _expire_throttles(self, now, limit=None):
+        """
+        Removes throttles which have expired at 'now'.  Only expired entries
+        of the index are visited, so the cost is proportional to the number
+        of expired throttles rather than to the number of throttles.  If
+        'limit' is specified, at most that many entries are visited.  Returns
+        a tuple of the number of throttles removed and the number of entries
+        visited.
+        """
+        throttles = self._get_throttles()
+        index = self._get_throttle_times()
+        # (until, key) sorts before (now,) if until < now
+        expired = list(islice(index.keys(max=(now,)), limit))
+        removed = 0
+        for entry in expired:
+            index.remove(entry)
+            until, key = entry
+            current = throttles.get(key)
+            # A throttle renewed later is indexed again, later.
+            if current is not None and current < now:
+                del throttles[key]
+                removed += 1
+        return removed, len(expired)
+
+    def compact(self, now, limit=None, start=None,
+                duplicate_window=DUPLICATE_WINDOW):
+        """
+        Removes frequency data and throttles which have expired at 'now', an
+        instance of datetime.datetime, and forgets senders for which nothing
+        is left.  Message ids remembered for longer than 'duplicate_window'
+        seconds, see `is_duplicate`, are forgotten.
+
+        Expired throttles are swept first, then expired message ids, then
+        senders.  If 'limit' is specified, at most that many entries are
+        visited in all, starting from 'start', so that a large queue may be
+        compacted in several transactions.  Returns a tuple of a dictionary
+        counting the 'senders', frequency 'entries', 'throttles' and
+        'message_ids' removed, and the value of 'start' with which to
+        continue, which is None once everything has been visited.
+        """
+        reclaimed = {'senders': 0, 'entries': 0, 'throttles': 0,
+                     'message_ids': 0}
+        # 'start' is a tuple of the sweep and, for senders, the last sender
+        # visited.  Expired throttles and message ids are removed as they are
+        # visited, so those sweeps simply start again from the beginning.
+        sweep, user = start or ('throttles', None)
+
+        if sweep == 'throttles':
+            removed, visited = self._expire_throttles(now, limit)
+            reclaimed['throttles'] = removed
+            if limit is not None:
+                limit -= visited
+                if limit <= 0:
+                    return reclaimed, ('throttles', None)
+            sweep = 'message_ids'
+
+        if sweep == 'message_ids':
+            removed, visited = self._prune_message_ids(
+                time() - duplicate_window, limit)
+            reclaimed['message_ids'] = removed
+            if limit is not None:
+                limit -= visited
+                if limit <= 0:
+                    return reclaimed, ('message_ids', None)
+
+        freq_data = self._freq_data
+        if user is None:
+            users = freq_data.keys()
+        else:
+            users = freq_data.keys(min=user, excludemin=True)
+        users = list(islice(users, limit))
+
+        for user in users:
+            self._migrate_throttles(user)
+            data = freq_data[user]
+            reclaimed['entries'] += data.compact(now)
+            if data.is_empty():
+                del freq_data[user]
+                reclaimed['senders'] += 1
+
+        if limit is not None and len(users) == limit:
+            return reclaimed, ('senders', users[-1])
+        if self._unmigrated_throttles:
+            # Every sender has been visited
+            self._unmigrated_throttles = False
+        return reclaimed, None
+
+class ShardedQueue(Queue):
+    """
+    A queue which spreads its messages and bookkeeping over several
+    sub-queues, or shards, so that concurrent writers modify different
+    persistent objects.  Messages are assigned to shards by a hash of their
+    'Message-Id' header, and frequency and throttling data by a hash of the
+    user.  Messages are retrieved from all shards in FIFO order.
+
+    The bounce limit, notice templates and outbox are those of the sharded
+    queue itself, as for `Queue`.  Bounces counted towards the limit,
+    including suppressed bounces and their digests, are kept by the shard of
+    the recipient.
+    """
 
-        if headers is None:
-            key = ()
+    def __init__(self, shards, partitions=1):
+        # Everything but the settings and the outbox is kept by the shards,
+        # so none of the structures made by Queue.__init__ are needed.
+        self._shards = tuple([Queue(partitions) for i in xrange(shards)])
+
+    def count_shards(self):
+        """
+        Returns the number of shards.
+        """
+        return len(self._shards)
+
+    def _shard_index(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('UTF-8')
+        return (crc32(value or '') & 0xffffffff) % len(self._shards)
+
+    def _shard(self, value):
+        return self._shards[self._shard_index(value)]
+
+    def add(self, message):
+        self._shard(message['Message-Id']).add(message)
+
+    def is_duplicate(self, message, window=DUPLICATE_WINDOW):
+        return self._shard(message['Message-Id']).is_duplicate(message, window)
+
+    def collect_frequency_data(self, message, headers=None,
+                               window=FREQUENCY_WINDOW):
+        self._shard(message['From']).collect_frequency_data(
+            message, headers, window)
+
+    def count_partitions(self):
+        return self._shards[0].count_partitions()
+
+    def repartition(self, partitions):
+        for shard in self._shards:
+            shard.repartition(partitions)
+
+    def _iter_messages(self, partition):
+        return heapq.merge(*[shard._iter_messages(partition)
+                             for shard in self._shards])
+
+    def __len__(self):
+        return sum([len(shard) for shard in self._shards])
+
+    def quarantine(self, message, error, send=None, notice_from=None):
+        if send is not None and notice_from is None:
+            raise ValueError("Must specify 'notice_from' in order to send "
+                             "notice.")
+        index = self._shard_index(message['Message-Id'])
+        self._shards[index].quarantine(message, error)
+        message.replace_header('X-Postoffice-Id', '%d-%s' % (
+            index, message['X-Postoffice-Id']))
+        if send is not None:
+            # Use this queue's notice template, rather than the shard's
+            self._send_quarantine_notice(message, send, notice_from)
+
+    def get_quarantined_messages(self):
+        for index, shard in enumerate(self._shards):
+            for id, (message, error) in shard._quarantine.items():
+                message = message.open()
+                message.replace_header('X-Postoffice-Id',
+                                       '%d-%d' % (index, id))
+                yield message, error
+
+    def get_quarantined_message(self, id):
+        index, id = _split_sharded_id(id)
+        message = self._shards[index].get_quarantined_message(id)
+        message.replace_header('X-Postoffice-Id', '%d-%d' % (index, id))
+        return message
+
+    def find_quarantined_messages(self, error_type=None, sender=None,
+                                  since=None, until=None):
+        found = []
+        for index, shard in enumerate(self._shards):
+            for id, summary in shard.find_quarantined_messages(
+                    error_type, sender, since, until):
+                found.append((summary['quarantined'], index, int(id),
+                              summary))
+        found.sort()
+        return [('%d-%d' % (index, id), summary)
+                for quarantined, index, id, summary in found]
+
+    def count_quarantined_errors(self):
+        counts = {}
+        for shard in self._shards:
+            for error_type, count in shard.count_quarantined_errors().items():
+                counts[error_type] = counts.get(error_type, 0) + count
+        return counts
+
+    def count_quarantined_messages(self):
+        return sum([shard.count_quarantined_messages()
+                    for shard in self._shards])
+
+    def remove_from_quarantine(self, message):
+        id = message.get('X-Postoffice-Id')
+        if id is None:
+            raise ValueError("Message is not in the quarantine.")
+        index, id = _split_sharded_id(id)
+        message.replace_header('X-Postoffice-Id', str(id))
+        self._shards[index].remove_from_quarantine(message)
+
+    def get_instantaneous_frequency(self, user, now, headers=None):
+        return self._shard(user).get_instantaneous_frequency(
+            user, now, headers)
+
+    def get_average_frequency(self, user, now, interval, headers=None):
+        return self._shard(user).get_average_frequency(
+            user, now, interval, headers)
+
+    def throttle(self, user, until, headers=None):
+        self._shard(user).throttle(user, until, headers)
+
+    def is_throttled(self, user, now, headers=None):
+        return self._shard(user).is_throttled(user, now, headers)
+
+    def _record_bounce(self, recipient, now, window):
+        return self._shard(recipient)._record_bounce(recipient, now, window)
+
+    def _suppress_bounce(self, recipient, from_addr, reason, now, digest):
+        self._shard(recipient)._suppress_bounce(
+            recipient, from_addr, reason, now, digest)
+
+    def count_suppressed_bounces(self):
+        return sum([shard.count_suppressed_bounces()
+                    for shard in self._shards])
+
+    def send_bounce_digests(self, send, now=None):
+        if now is None:
+            now = datetime.now()
+        # Use this queue's notice template, rather than the shards'
+        template = self._get_notice_template('bounce_digest')
+        return sum([shard._send_bounce_digests(send, now, template)
+                    for shard in self._shards])
+
+    def get_throttles(self, now):
+        throttles = []
+        for shard in self._shards:
+            throttles.extend(shard.get_throttles(now))
+        throttles.sort(key=lambda throttle: throttle[2])
+        return throttles
+
+    def compact(self, now, limit=None, start=None,
+                duplicate_window=DUPLICATE_WINDOW):
+        # 'start' is a tuple of a shard index and where to continue in that
+        # shard
+        index, shard_start = start or (0, None)
+        reclaimed, shard_start = self._shards[index].compact(
+            now, limit, shard_start, duplicate_window)
+        if shard_start is not None:
+            return reclaimed, (index, shard_start)
+        if index + 1 < len(self._shards):
+            return reclaimed, (index + 1, None)
+        return reclaimed, None
+
+class Outbox(Persistent):
+    """
+    A durable queue of outgoing messages, such as bounces and quarantine
+    notices.  Messages given to `send` are only stored, and so only sent,
+    if the transaction in which they were generated is committed.  They are
+    actually sent, later and by another process, by `drain`, so that a slow
+    mail server does not hold up the consumer of a queue.
+
+    Messages are kept in order of when they are next due to be sent, under
+    keys made from that time and some random bits, see `_new_key`.
+    """
+
+    def __init__(self):
+        self._messages = LOBTree()
+        self._count = Length()
+
+    def send(self, fromaddr, toaddrs, message):
+        """
+        Adds a message to the outbox.  Has the same signature as the 'send'
+        argument to `Queue.bounce` and `Queue.quarantine`.
+        """
+        if isinstance(message, basestring):
+            message = message_from_string(message, Message)
+        messages = self._messages
+        key = _time_key(time())
+        try:
+            last = messages.maxKey(key | _RANDOM_MASK)
+        except ValueError:
+            last = 0
+        if key <= last:
+            # Keep messages sent in the same millisecond in order
+            key = last + 1 + _random.getrandbits(_RANDOM_BITS // 2)
+        while key in messages:
+            key += 1
+        messages[key] = _OutgoingMessage(fromaddr, toaddrs, message)
+        self._count.change(1)
+
+    def drain(self, send, now=None, limit=None, max_attempts=5,
+              retry_delay=60, log=None):
+        """
+        Sends the messages which are due at 'now', in seconds since the epoch,
+        using 'send', a callable with the same signature as `send`.  If
+        'limit' is specified, at most that many messages are sent.
+
+        A message which cannot be sent is tried again after 'retry_delay'
+        seconds, the delay doubling after each further failure, until it has
+        failed 'max_attempts' times, at which point it is discarded.  Returns
+        a tuple of the numbers of messages sent, rescheduled and discarded.
+        If 'log' is specified, the reason for each failure is logged to it.
+
+        Messages are removed from the outbox as they are sent, but if the
+        transaction is then aborted they will be sent again.  Committing after
+        every few messages limits the number of duplicates.
+        """
+        if now is None:
+            now = time()
+        messages = self._messages
+        due = list(islice(messages.keys(max=_time_key(now, _RANDOM_MASK)),
+                          limit))
+        sent = retried = failed = 0
+        for key in due:
+            outgoing = messages.pop(key)
+            try:
+                send(outgoing.fromaddr, list(outgoing.toaddrs),
+                     outgoing.open())
+            except Exception as e:
+                outgoing.attempts += 1
+                error = '%s: %s' % (type(e).__name__, e)
+                recipients = ', '.join(outgoing.toaddrs)
+                if outgoing.attempts >= max_attempts:
+                    if log is not None:
+                        log.warn("Gave up sending message to %s after %d "
+                                 "attempts: %s" %
+                                 (recipients, outgoing.attempts, error))
+                    self._count.change(-1)
+                    failed += 1
+                    continue
+                delay = retry_delay * 2 ** (outgoing.attempts - 1)
+                if log is not None:
+                    log.warn("Unable to send message to %s, retrying in %d "
+                             "seconds: %s" % (recipients, delay, error))
+                key = _time_key(now + delay)
+                while key in messages:
+                    key = _time_key(now + delay)
+                messages[key] = outgoing
+                retried += 1
+            else:
+                self._count.change(-1)
+                sent += 1
+        return sent, retried, failed
+
+    def __len__(self):
+        return self._count()
+
+class _Partition(Persistent):
+    """
+    The messages in one partition of a queue, in FIFO order, kept in a chain
+    of `_MessageBucket`s.  Producers add messages to the last bucket,
+    starting a new one when it is full, and consumers remove them from the
+    first, dropping it from the chain once it is empty.  The last bucket is
+    never dropped.
+
+    A BTree cannot merge the removal of the first key of a bucket with any
+    other change to that bucket, so a producer and a consumer of a BTree
+    holding few messages always conflict.  Instead, the buckets and the
+    chain resolve conflicts themselves: buckets added by producers and
+    dropped by consumers are merged, as are messages added to and removed
+    from the same bucket.  Only two consumers removing the same message
+    conflict.
+    """
+
+    def __init__(self):
+        self._buckets = (_MessageBucket(),)
+
+    def add(self, key, message):
+        buckets = self._buckets
+        bucket = buckets[-1]
+        if len(bucket) >= _BUCKET_SIZE:
+            bucket = _MessageBucket()
+            self._buckets = buckets + (bucket,)
+        bucket.add(key, message)
+
+    def pop(self, key):
+        buckets = self._buckets
+        for bucket in buckets:
+            message = bucket.pop(key)
+            if message is not None:
+                break
         else:
-            key = tuple(sorted(headers.items()))
+            raise KeyError(key)
 
-        throttles = freq_data.throttles
-        if key not in throttles:
-            return False
+        dropped = 0
+        while dropped < len(buckets) - 1 and not len(buckets[dropped]):
+            buckets[dropped].close()
+            dropped += 1
+        if dropped:
+            self._buckets = buckets[dropped:]
+        return message
 
-        if throttles[key] < now:
-            del throttles[key]
-            return False
+    def max_key(self):
+        """
+        Returns the key of the last message added, or None if the last
+        bucket is empty.
+        """
+        return self._buckets[-1].max_key()
 
-        return True
+    def items(self):
+        """
+        Yields (key, message) pairs in FIFO order, only loading each bucket
+        as it is reached.
+        """
+        for bucket in self._buckets:
+            for item in bucket.items():
+                yield item
 
-    @staticmethod
-    def _filter_freq_data(freq_data, match_headers):
-        def _match(headers):
-            for k, v in match_headers.items():
-                if headers.get(k) != v:
-                    return False
-            return True
+    def keys(self):
+        for key, message in self.items():
+            yield key
 
-        return [ts for ts, header_values in freq_data if _match(header_values)]
+    def __len__(self):
+        # Visits every bucket
+        return sum([len(bucket) for bucket in self._buckets])
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Each side may drop buckets from the front of the chain and add new
+        # ones to its end.
+        old_buckets = old['_buckets']
+        dropped1, added1 = _chain_changes(old_buckets, committed['_buckets'])
+        dropped2, added2 = _chain_changes(old_buckets, new['_buckets'])
+        resolved = dict(old)
+        resolved['_buckets'] = (tuple(old_buckets[max(dropped1, dropped2):]) +
+                                added1 + added2)
+        return resolved
+
+class _MessageBucket(Persistent):
+    """
+    Some of the messages of a `_Partition`, as a list of (key, message)
+    pairs ordered by key.  A consumer which empties a bucket before dropping
+    it from the chain closes it, so that a message added by a producer
+    which has yet to see the bucket dropped conflicts, rather than being
+    lost.
+    """
+    _closed = False
+
+    def __init__(self):
+        self._items = []
+
+    def add(self, key, message):
+        items = self._items
+        if items and key < items[-1][0]:
+            items.insert(bisect_left([k for k, m in items], key),
+                         (key, message))
+        else:
+            items.append((key, message))
+        self._p_changed = True
+
+    def pop(self, key):
+        """
+        Removes and returns the message with the given key, or returns None
+        if it isn't in this bucket.
+        """
+        items = self._items
+        if not items or key < items[0][0] or key > items[-1][0]:
+            return None
+        index = bisect_left([k for k, m in items], key)
+        if index == len(items) or items[index][0] != key:
+            return None
+        key, message = items.pop(index)
+        self._p_changed = True
+        return message
+
+    def close(self):
+        self._closed = True
+
+    def max_key(self):
+        if self._items:
+            return self._items[-1][0]
+        return None
+
+    def items(self):
+        return list(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Producers add messages and consumers remove them.  The changes of
+        # both sides are merged unless both removed, or both added, the same
+        # message, or one side closed the bucket while the other added to it.
+        old_items = old['_items']
+        old_keys = set([key for key, message in old_items])
+        changes = []
+        for state in (committed, new):
+            keys = set([key for key, message in state['_items']])
+            added = [item for item in state['_items']
+                     if item[0] not in old_keys]
+            changes.append((old_keys - keys, added,
+                            state.get('_closed', False)))
+        (removed1, added1, closed1), (removed2, added2, closed2) = changes
+        if (removed1 & removed2 or (closed1 and added2) or
+            (closed2 and added1)):
+            raise ConflictError
+        added_keys = set([key for key, message in added1])
+        for key, message in added2:
+            if key in added_keys:
+                raise ConflictError
+
+        removed = removed1 | removed2
+        items = [item for item in old_items if item[0] not in removed]
+        items.extend(added1)
+        items.extend(added2)
+        items.sort(key=itemgetter(0))
+        resolved = dict(old)
+        resolved['_items'] = items
+        if closed1 or closed2:
+            resolved['_closed'] = True
+        return resolved
 
 class _QueuedMessage(Persistent):
     """
@@ -402,22 +1491,452 @@ class _QueuedMessage(Persistent):
 
     def __init__(self, message):
         assert isinstance(message, StdlibMessage), "Not a message."
-        self._v_message = message   # transient attribute
         self._blob_file = blob = Blob()
         outfp = blob.open('w')
-        Generator(outfp).flatten(message)
+        if _is_body_loaded(message):
+            self._v_message = message   # transient attribute
+        # Otherwise the message isn't cached, since its source may go away.
+        _write_message(message, outfp)
         outfp.close()
 
     def get(self):
+        """
+        Returns the stored message, which is kept in memory until 'release'
+        is called.
+        """
         if self._v_message is None:
-            parser = Parser(Message)
-            self._v_message = parser.parse(self._blob_file.open())
+            self._v_message = self.open()
         return self._v_message
 
-class _FreqData(PersistentList):
+    def open(self):
+        """
+        Returns a new copy of the stored message, which is not kept by this
+        object.  Only the headers are parsed; the body is parsed from the
+        blob when it is first needed.
+        """
+        return LazyBlobMessage(self._blob_file)
+
+    def release(self):
+        """
+        Forgets the message kept in memory by 'get'.
+        """
+        self._v_message = None
+
+class _OutgoingMessage(_QueuedMessage):
+    """
+    A message in an outbox, along with its envelope and the number of failed
+    attempts to send it.
+    """
+    attempts = 0
+
+    def __init__(self, fromaddr, toaddrs, message):
+        super(_OutgoingMessage, self).__init__(message)
+        self.fromaddr = fromaddr
+        self.toaddrs = tuple(toaddrs)
+
+class _BounceDigest(Persistent):
+    """
+    Bounces to a single recipient which have been suppressed, to be sent as
+    one message.
+    """
+
+    def __init__(self, from_addr, now):
+        self.from_addr = from_addr
+        self.count = 0
+        self.first = self.last = now
+        self.reasons = ()
+
+    def add(self, reason, now):
+        self.count += 1
+        self.last = now
+        reasons = self.reasons
+        if reason not in reasons and len(reasons) < _MAX_DIGEST_REASONS:
+            self.reasons = reasons + (reason,)
+
+    def make_message(self, recipient, template):
+        reasons = u''.join([u'\t%s\n' % reason for reason in self.reasons])
+        fields = {'count': self.count, 'first': self.first.ctime(),
+                  'last': self.last.ctime(), 'reasons': reasons}
+        return template.render(self.from_addr, recipient, fields)
+
+class _QuarantineIndex(Persistent):
+    """
+    Summaries of the messages in a quarantine, keyed by id, with indexes of
+    the ids by error type, by sender and by the minute in which the message
+    was quarantined.  Each index is a single set of (key, id) pairs, rather
+    than a set of ids for each key, so that concurrent quarantines only ever
+    insert distinct entries, which resolve without conflict.
+    """
+
     def __init__(self):
-        super(_FreqData, self).__init__()
-        self.throttles = PersistentDict()
+        self.summaries = IOBTree()
+        self.error_types = OOTreeSet()
+        self.senders = OOTreeSet()
+        self.minutes = OOTreeSet()
+
+    def index(self, id, summary):
+        self.summaries[id] = summary
+        _index_id(self.error_types, summary['error_type'], id)
+        _index_id(self.senders, _sender_key(summary['from']), id)
+        _index_id(self.minutes, _minute(summary['quarantined']), id)
+
+    def unindex(self, id):
+        summary = self.summaries.pop(id, None)
+        if summary is None:
+            return
+        _unindex_id(self.error_types, summary['error_type'], id)
+        _unindex_id(self.senders, _sender_key(summary['from']), id)
+        _unindex_id(self.minutes, _minute(summary['quarantined']), id)
+
+    def find(self, error_type=None, sender=None, since=None, until=None):
+        """
+        Returns a list of tuples of id and summary of the messages matching
+        the given criteria, see `Queue.find_quarantined_messages`.
+        """
+        sets = []
+        if error_type is not None:
+            sets.append(_indexed_ids(self.error_types, error_type, error_type))
+        if sender is not None:
+            key = _sender_key(sender)
+            sets.append(_indexed_ids(self.senders, key, key))
+        if since is not None or until is not None:
+            first = last = None
+            if since is not None:
+                first = _minute(since)
+            if until is not None:
+                last = _minute(until)
+            sets.append(_indexed_ids(self.minutes, first, last))
+        if sets:
+            sets.sort(key=len)
+            ids = reduce(intersection, sets)
+        else:
+            ids = self.summaries.keys()
+
+        found = []
+        for id in ids:
+            summary = self.summaries[id]
+            quarantined = summary['quarantined']
+            if since is not None and quarantined < since:
+                continue
+            if until is not None and quarantined >= until:
+                continue
+            found.append((id, dict(summary)))
+        return found
+
+    def count_errors(self):
+        counts = {}
+        for error_type, id in self.error_types.keys():
+            counts[error_type] = counts.get(error_type, 0) + 1
+        return counts
+
+class _FreqData(Persistent):
+    """
+    Frequency data for a single user.  For each combination of discriminating
+    header values seen, keeps a ring of per-minute message counts and the
+    time of the latest message.  Rings are keyed by the sorted header names
+    and values, and indexed by each header name and value, so that queries
+    only visit matching rings.
+    """
+    data = None  # BBB persistence, see _migrate
+
+    def __init__(self):
+        self.rings = {}
+        self.index = {}
+
+    def record(self, date, headers, window=FREQUENCY_WINDOW):
+        self._migrate()
+        rings = self.rings
+        key = tuple(sorted(headers.items()))
+        ring = rings.get(key)
+        if ring is None:
+            rings[key] = ring = _FreqRing(headers, window)
+            for item in key:
+                self.index.setdefault(item, set()).add(key)
+            self._p_changed = True
+        else:
+            ring.resize(window)
+        # Only the ring is changed, so only it is written again.  Rings which
+        # haven't been seen recently are forgotten by compact.
+        ring.record(date)
+
+    def compact(self, now):
+        """
+        Removes rings which have not counted a message within their window
+        at 'now'.  Returns the number of rings removed.
+        """
+        self._migrate()
+        expired_rings = [key for key, ring in self.rings.items()
+                         if ring.last + timedelta(minutes=len(ring.minutes))
+                         < now]
+        for key in expired_rings:
+            self._remove_ring(key)
+        if expired_rings:
+            self._p_changed = True
+        return len(expired_rings)
+
+    def is_empty(self):
+        return not self.rings
+
+    def _remove_ring(self, key):
+        del self.rings[key]
+        for item in key:
+            keys = self.index[item]
+            keys.discard(key)
+            if not keys:
+                del self.index[item]
+
+    def matching(self, match_headers):
+        """
+        Returns the rings for header values which match 'match_headers'.
+        """
+        self._migrate()
+        if not match_headers:
+            # Bounces sent to the user aren't messages from the user
+            return [ring for key, ring in self.rings.items()
+                    if _BOUNCE_ITEM not in key]
+        index = self.index
+        found = []
+        for item in match_headers.items():
+            keys = index.get(item)
+            if not keys:
+                return []
+            found.append(keys)
+        found.sort(key=len)
+        keys = found[0].intersection(*found[1:])
+        return [self.rings[key] for key in keys]
+
+    def _migrate(self):
+        data = self.data
+        if data is not None:
+            # BBB persistence, used to be a list of (date, headers) tuples
+            self.rings = {}
+            self.index = {}
+            del self.data
+            for date, headers in data:
+                self.record(date, headers)
+
+class _FreqRing(Persistent):
+    """
+    Counts of messages per minute, for the last 'size' minutes.  Each slot of
+    the ring holds the count for a minute, and the minute it is for.  Each
+    ring is stored separately from the sender's other rings.
+    """
+    last = None
+
+    def __init__(self, headers, size):
+        self.headers = headers
+        self.minutes = [0] * size
+        self.counts = [0] * size
+
+    def resize(self, size):
+        if size <= len(self.minutes):
+            return
+        old = sorted(zip(self.minutes, self.counts))
+        self.minutes = [0] * size
+        self.counts = [0] * size
+        for minute, count in old:
+            slot = minute % size
+            self.minutes[slot] = minute
+            self.counts[slot] = count
+
+    def record(self, date):
+        minute = int(_datetime_as_seconds(date) // 60)
+        slot = minute % len(self.minutes)
+        if self.minutes[slot] != minute:
+            if self.minutes[slot] > minute:
+                # Too old to be counted
+                return
+            self.minutes[slot] = minute
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+        self._p_changed = True
+        if self.last is None or date > self.last:
+            self.last = date
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Messages counted concurrently for the same sender are added up,
+        # minute by minute.  A minute pushed out of its slot by a later one
+        # on either side is dropped, as it would have been by 'record'.
+        old_counts = _minute_counts(old)
+        counts = _minute_counts(committed)
+        for minute, count in _minute_counts(new).items():
+            count -= old_counts.get(minute, 0)
+            if count:
+                counts[minute] = counts.get(minute, 0) + count
+        size = max(len(committed['minutes']), len(new['minutes']))
+        minutes = [0] * size
+        slots = [0] * size
+        for minute, count in sorted(counts.items()):
+            slot = minute % size
+            minutes[slot] = minute
+            slots[slot] = count
+        resolved = dict(committed)
+        resolved['minutes'] = minutes
+        resolved['counts'] = slots
+        last = [state['last'] for state in (committed, new)
+                if state.get('last') is not None]
+        if last:
+            resolved['last'] = max(last)
+        return resolved
+
+    def count(self, start, end):
+        """
+        Returns the number of messages between 'start' and 'end', in seconds
+        since the epoch.  Messages are assumed to be spread evenly over their
+        minute, or over the part of it before 'end'.
+        """
+        total = 0.0
+        for minute, count in zip(self.minutes, self.counts):
+            begin = minute * 60
+            finish = min(begin + 60, end)
+            overlap = finish - max(begin, start)
+            if count and overlap > 0:
+                total += count * overlap / (finish - begin)
+        return total
+
+def _minute_counts(state):
+    # Maps each minute counted in the state of a _FreqRing to its count
+    return dict([(minute, count) for minute, count
+                 in zip(state['minutes'], state['counts']) if count])
+
+def _take_message(queued):
+    # Don't leave the message pinned in memory by the removed wrapper.  The
+    # message may read its body from the wrapper's blob until the removal is
+    # committed, after which the blob may go away, so a message still in use
+    # by then is detached from it.
+    message = queued.get()
+    queued.release()
+    jar = queued._p_jar
+    if isinstance(message, LazyBlobMessage) and jar is not None:
+        jar.transaction_manager.get().addBeforeCommitHook(
+            _detach_message, (weakref.ref(message),))
+    return message
+
+def _detach_message(ref):
+    message = ref()
+    if message is not None:
+        message.detach()
+
+def _write_message(message, outfp):
+    if _is_body_loaded(message):
+        Generator(outfp).flatten(message)
+    else:
+        # Copy the original body rather than parsing and re-rendering it.
+        message.write_headers(outfp)
+        message.write_body(outfp)
+
+def _is_body_loaded(message):
+    # Only messages read lazily from a Maildir may have unloaded bodies.
+    is_body_loaded = getattr(message, 'is_body_loaded', None)
+    return is_body_loaded is None or is_body_loaded()
+
+def _split_message_id_entry(entry):
+    try:
+        timestamp, orig_to = entry
+    except TypeError: # BBB
+        timestamp, orig_to = entry, None
+    return timestamp, orig_to
+
+def _new_key(after=0):
+    # Keys are the time in milliseconds followed by random bits, which keeps
+    # messages in FIFO order while making it unlikely that concurrent
+    # producers pick the same key, which would be an unresolvable conflict.
+    # The random bits also choose the partition in which a message is stored.
+    # Keys issued by a process always increase, in case the clock goes back
+    # or several messages are added in the same millisecond.
+    global _last_key
+    key = (int(time() * 1000) << _RANDOM_BITS) | _random.getrandbits(
+        _RANDOM_BITS)
+    after = max(after, _last_key)
+    if key <= after:
+        key = after + 1 + _random.getrandbits(_RANDOM_BITS)
+    _last_key = key
+    return key
+
+def _time_key(seconds, bits=None):
+    # Key for an outbox message due at the given time, see _new_key
+    if bits is None:
+        bits = _random.getrandbits(_RANDOM_BITS)
+    return (int(seconds * 1000) << _RANDOM_BITS) | bits
+
+def _chain_changes(old, buckets):
+    """
+    Returns the number of buckets dropped from the front of the 'old' chain
+    of a `_Partition` to make 'buckets', and a tuple of the buckets added to
+    its end.  Buckets are persistent references, compared by oid.  Raises
+    ConflictError if the chain was changed in any other way.
+    """
+    old = [bucket.oid for bucket in old]
+    oids = [bucket.oid for bucket in buckets]
+    for dropped in xrange(len(old) + 1):
+        kept = len(old) - dropped
+        if oids[:kept] == old[dropped:]:
+            return dropped, tuple(buckets[kept:])
+    raise ConflictError
+
+def _iter_partition(messages, queue):
+    for key, message in messages.items():
+        yield key, message, messages, queue
+
+def _quarantine_summary(message, error, quarantined=None):
+    if quarantined is None:
+        quarantined = datetime.now()
+    return {
+        'from': message.get('From'),
+        'to': message.get('To'),
+        'subject': message.get('Subject'),
+        'date': message.get('Date'),
+        'message_id': message.get('Message-Id'),
+        'error_type': _error_type(error),
+        'quarantined': quarantined,
+    }
+
+def _error_type(error):
+    # Name of the exception class in exception info, as from sys.exc_info()
+    try:
+        error_type = error[0]
+    except (TypeError, LookupError):
+        return None
+    if error_type is None or isinstance(error_type, basestring):
+        return error_type
+    return getattr(error_type, '__name__', None) or str(error_type)
+
+def _sender_key(sender):
+    # Senders are looked up by email address, ignoring case
+    if not sender:
+        return None
+    return (parseaddr(sender)[1] or sender).lower()
+
+def _parse_date(value):
+    parsed = value and parsedate(value)
+    if not parsed:
+        return datetime.now()
+    return datetime(*parsed[:6])
+
+def _index_id(index, key, id):
+    if key is not None:
+        index.insert((key, id))
+
+def _unindex_id(index, key, id):
+    if key is not None and (key, id) in index:
+        index.remove((key, id))
+
+def _indexed_ids(index, first, last):
+    # Returns the set of ids indexed under keys from 'first' to 'last'
+    # inclusive, where None leaves that end of the range open.
+    min = max = None
+    if first is not None:
+        min = (first,)
+    if last is not None:
+        max = (last, _MAX_ID)
+    return IITreeSet([id for key, id in index.keys(min, max)])
+
+def _split_sharded_id(id):
+    try:
+        index, id = map(int, str(id).split('-'))
+    except ValueError:
+        raise ValueError("Message is not in the quarantine.")
+    return index, id
 
 def _new_id(container):
     # Use numeric incrementally increasing ids to preserve FIFO order
@@ -425,24 +1944,60 @@ def _new_id(container):
         return max(container.keys()) + 1
     return 0
 
+def _throttle_key(headers):
+    if headers is None:
+        return ()
+    return tuple(sorted(headers.items()))
+
+def _minute(dt):
+    return int(_datetime_as_seconds(dt) // 60)
+
+def _datetime_as_seconds(dt):
+    return _timedelta_as_seconds(dt - _EPOCH)
+
 def _timedelta_as_seconds(td):
     return (24.0 * 60.0 * 60.0 * td.days +
             td.seconds +
             td.microseconds / 1000000)
 
-_default_bounce_body = u"""
-Your email, sent on %s to %s has bounced for the following reason:
+_default_bounce_template = u"""
+Subject: Your message to {to} has bounced.
+
+Your email, sent on {date} to {to} has bounced for the following reason:
 
-\t%s
+\t{reason}
 
 If you feel you are receiving this message in error please contact your system
 administrator.
 """.lstrip()
 
-_quarantine_notice_body = u"""
-An error has occurred while processing your email, sent on %s to %s.
+_default_bounce_digest_template = u"""
+Subject: {count} of your messages have bounced.
+
+{count} further emails you sent have bounced, between {first} and {last}.
+Rather than notify you of each one, we have combined them into this message.
+The reasons given were:
+
+{reasons}
+If you feel you are receiving this message in error please contact your system
+administrator.
+""".lstrip()
+
+_default_quarantine_notice_template = u"""
+Subject: An error has occurred while processing your email to {to}
+
+An error has occurred while processing your email, sent on {date} to {to}.
 
 System administrators have been informed and will take corrective action
 shortly. Your message has been stored in a quarantine and will be retried once
 the error is addressed. We apologize for the inconvenience.
 """.lstrip()
+
+# Prepared once, rather than for every notice
+_DEFAULT_NOTICE_TEMPLATES = {
+    'bounce': compile_notice_template('bounce', _default_bounce_template),
+    'quarantine_notice': compile_notice_template(
+        'quarantine_notice', _default_quarantine_notice_template),
+    'bounce_digest': compile_notice_template(
+        'bounce_digest', _default_bounce_digest_template),
+}
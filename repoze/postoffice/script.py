@@ -3,9 +3,13 @@ from __future__ import with_statement
 from code import interact
 from optparse import OptionParser
 from repoze.postoffice.api import PostOffice
+from repoze.postoffice.watch import make_watcher
+from repoze.postoffice.watch import maildir_paths
 import logging
 import os
+import signal
 import sys
+import time
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s %(name)s: %(message)s')
@@ -24,10 +28,38 @@ class ConsoleScript(object):
         parser.add_option('-v', '--verbose', dest='verbose', default=False,
                           action='store_true',
                           help='Print info level log messages')
+        parser.add_option('--daemon', dest='daemon', default=False,
+                          action='store_true',
+                          help='Keep running, importing messages as they '
+                               'arrive.  Send SIGHUP to reload configuration.')
+        parser.add_option('--poll-interval', dest='poll_interval',
+                          type='float', default=1.0,
+                          help='Seconds between checks for new messages when '
+                               'running as a daemon without pyinotify.',
+                          metavar='SECONDS')
+        parser.add_option('--workers', dest='workers', type='int',
+                          default=1,
+                          help='Number of processes with which to parse and '
+                               'filter incoming messages.',
+                          metavar='N')
+        parser.add_option('--compact', dest='compact', default=False,
+                          action='store_true',
+                          help='Remove all expired frequency data, throttles '
+                               'and message ids from queues, instead of '
+                               'importing messages.  Imports also remove '
+                               'some each time, see import_compact_limit.')
+        parser.add_option('--send-outbox', dest='send_outbox', default=False,
+                          action='store_true',
+                          help='Send the bounces and notices waiting in the '
+                               'outboxes of queues, instead of importing '
+                               'messages.  With --daemon, keep sending them '
+                               'as they become due.')
 
         options, args = parser.parse_args(argv)
         if args:
             parser.error('Extra arguments given.')
+        if options.workers < 1:
+            parser.error('Number of workers must be at least one.')
 
         config = options.config
         if config is None:
@@ -41,11 +73,120 @@ class ConsoleScript(object):
         self.log = logging.getLogger('repoze.postoffice')
         self.log.setLevel(log_level)
         self.config = config
+        self.daemon = options.daemon
+        self.poll_interval = options.poll_interval
+        self.workers = options.workers
+        self.compact = options.compact
+        self.send_outbox = options.send_outbox
 
     def __call__(self):
+        if self.daemon:
+            if self.send_outbox:
+                return self.run_outbox_daemon()
+            return self.run_daemon()
         po = PostOffice(self.config)
+        if self.compact:
+            po.compact(self.log)
+            return
+        if self.send_outbox:
+            po.send_outbox(self.log)
+            return
         po.reconcile_queues(self.log)
-        po.import_messages(self.log)
+        po.import_messages(self.log, self.workers)
+
+    def run_daemon(self):
+        """
+        Keeps a post office resident, importing messages as soon as they are
+        delivered to the Maildir.  On SIGHUP the configuration is reloaded and
+        queues are reconciled.  SIGTERM and SIGINT stop the daemon once the
+        current import has finished.
+        """
+        state = _handle_signals()
+        log = self.log
+        po = PostOffice(self.config)
+        po.reconcile_queues(log)
+        watcher = pool = None
+        try:
+            while state['running']:
+                if state['reload']:
+                    state['reload'] = False
+                    log.info('Reloading configuration: %s' % self.config)
+                    try:
+                        new_po = PostOffice(self.config)
+                        new_po.reconcile_queues(log)
+                    except Exception:
+                        log.exception('Unable to reload configuration.')
+                    else:
+                        if new_po.maildir != po.maildir and watcher:
+                            watcher.close()
+                            watcher = None
+                        if pool is not None:
+                            # Workers are set up with the old configuration
+                            _close_pool(pool)
+                            pool = None
+                        po.sender.close()
+                        po = new_po
+
+                if pool is None and self.workers > 1:
+                    pool = po.make_pool(self.workers)
+                try:
+                    po.import_messages(log, self.workers, pool)
+                except Exception:
+                    log.exception('Error importing messages.')
+
+                if watcher is None:
+                    # Maildir is created by first import, if need be.  A
+                    # message delivered since that import would not wake the
+                    # new watcher, so import again before waiting.
+                    watcher = make_watcher(maildir_paths(po.maildir),
+                                           self.poll_interval)
+                    continue
+                while (state['running'] and not state['reload'] and
+                       not watcher.wait(self.poll_interval)):
+                    # Keep compacting queues while no messages arrive.
+                    try:
+                        po.compact_some(log)
+                    except Exception:
+                        log.exception('Error compacting queues.')
+        finally:
+            if watcher is not None:
+                watcher.close()
+            if pool is not None:
+                _close_pool(pool)
+            po.sender.close()
+
+    def run_outbox_daemon(self):
+        """
+        Keeps sending the bounces and notices in the outboxes of queues,
+        checking for messages which are due every poll interval.  On SIGHUP
+        the configuration is reloaded.  SIGTERM and SIGINT stop the daemon
+        once the current batch has been sent.
+        """
+        state = _handle_signals()
+        log = self.log
+        po = PostOffice(self.config)
+        try:
+            while state['running']:
+                if state['reload']:
+                    state['reload'] = False
+                    log.info('Reloading configuration: %s' % self.config)
+                    try:
+                        new_po = PostOffice(self.config)
+                    except Exception:
+                        log.exception('Unable to reload configuration.')
+                    else:
+                        po.sender.close()
+                        po = new_po
+
+                try:
+                    po.send_outbox(log)
+                except Exception:
+                    log.exception('Error sending messages from outboxes.')
+
+                if state['running'] and not state['reload']:
+                    time.sleep(self.poll_interval)
+        finally:
+            po.sender.close()
 
     def debug(self):
         po = PostOffice(self.config)
@@ -53,6 +194,24 @@ class ConsoleScript(object):
         with po._get_root() as root:
             interact(banner, local={'root':root})
 
+def _handle_signals():
+    # SIGHUP asks a daemon to reload its configuration, SIGTERM and SIGINT to
+    # stop.
+    state = {'reload': False, 'running': True}
+    def reload(signum, frame):
+        state['reload'] = True
+    def stop(signum, frame):
+        state['running'] = False
+    signal.signal(signal.SIGHUP, reload)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    return state
+
+def _close_pool(pool):
+    # Lets the workers finish what they were doing and exit.
+    pool.close()
+    pool.join()
+
 def _find_config():
     path = os.path.abspath('postoffice.ini')
     if os.path.exists(path):
@@ -0,0 +1,116 @@
+"""
+Delivery of outgoing messages, such as bounces and quarantine notices,
+through an SMTP server.  Connections to the server are kept open and reused
+between messages, rather than set up and torn down for every message.
+"""
+from __future__ import with_statement
+
+import smtplib
+import socket
+import threading
+import time
+
+# Errors after which a connection can no longer be trusted.
+_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+class SMTPSender(object):
+    """
+    Sends messages through the SMTP server at 'host' and 'port'.  Instances
+    are callables with the signature of the 'send' argument to
+    `Queue.bounce` and `Queue.quarantine`.
+
+    Up to 'pool_size' idle connections are kept open for reuse.  A connection
+    which has sat idle for longer than 'max_idle' seconds is closed rather
+    than reused, since the server will probably have dropped it by then.
+    'timeout' is the timeout, in seconds, for connecting to and talking to
+    the server.  Instances may be shared between threads.
+    """
+    def __init__(self, host='localhost', port=25, timeout=30.0, pool_size=1,
+                 max_idle=60.0, smtplib=smtplib, clock=time.time):
+        # smtplib and clock passed in for unittesting
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self._smtplib = smtplib
+        self._clock = clock
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __call__(self, fromaddr, toaddrs, message):
+        """
+        Sends an email message.
+        """
+        if not isinstance(message, str):
+            message = message.as_string()
+        mta = self._checkout()
+        try:
+            mta.sendmail(fromaddr, toaddrs, message)
+        except (smtplib.SMTPResponseException,
+                smtplib.SMTPRecipientsRefused):
+            # The server refused the message, but the connection may be used
+            # again.
+            self._checkin(mta)
+            raise
+        except:
+            _close(mta)
+            raise
+        self._checkin(mta)
+
+    def close(self):
+        """
+        Closes any idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for mta, last_used in idle:
+            _quit(mta)
+
+    def _checkout(self):
+        """
+        Returns an idle connection if there is one which is still usable, or
+        else a new connection.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                mta, last_used = self._idle.pop()
+            if self._clock() - last_used > self.max_idle:
+                _quit(mta)
+                continue
+            # Start a fresh session, which also checks that the server hasn't
+            # dropped the connection in the meantime.  A server which is
+            # closing the connection replies 421 rather than failing.
+            try:
+                code, msg = mta.rset()
+            except _CONNECTION_ERRORS + (smtplib.SMTPException,):
+                _close(mta)
+                continue
+            if code != 250:
+                _close(mta)
+                continue
+            return mta
+        return self._smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+    def _checkin(self, mta):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                # Most recently used connections are reused first
+                self._idle.append((mta, self._clock()))
+                return
+        _quit(mta)
+
+def _quit(mta):
+    try:
+        mta.quit()
+    except _CONNECTION_ERRORS + (smtplib.SMTPException,):
+        _close(mta)
+
+def _close(mta):
+    try:
+        mta.close()
+    except socket.error:
+        pass
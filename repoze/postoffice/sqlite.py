@@ -0,0 +1,425 @@
+"""
+A queue which keeps its messages in a local SQLite database, rather than in
+the ZODB.  Appending a message to, or popping one from, a SQLite table is
+cheaper than updating BTrees and blobs, which suits queues with a high volume
+of messages.
+
+The queue object itself is still stored in the ZODB, along with the frequency
+data and throttles used for out of office loop detection.  Messages, the
+quarantine and the message ids used for duplicate detection are kept in the
+SQLite database, which is opened in WAL mode so that readers do not block the
+writer.  Changes to the SQLite database are committed along with the ZODB
+transaction.
+"""
+from cPickle import dumps
+from cPickle import loads
+from cStringIO import StringIO
+from random import SystemRandom
+import sqlite3
+import threading
+from time import time
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+import transaction
+
+from .message import LazyBlobMessage
+from .message import _Text
+from .queue import DUPLICATE_WINDOW
+from .queue import Queue
+from .queue import _datetime_as_seconds
+from .queue import _quarantine_summary
+from .queue import _sender_key
+from .queue import _write_message
+
+_random = SystemRandom()
+
+# Seconds to wait for another process to release a lock on the database.
+_TIMEOUT = 30
+
+# Connections are kept here rather than on the queues, which forget their
+# volatile attributes whenever they are ghosted.  A connection in a write
+# transaction belongs to the data manager which ends it, registered under the
+# database's path and the transaction it has joined, so that every queue
+# using that database in that transaction writes through it.  Other
+# connections are kept per thread, since SQLite connections may only be used
+# by the thread which opened them.
+_data_managers = {}
+_idle = threading.local()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    partition INTEGER NOT NULL,
+    message BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS messages_partition ON messages (partition, id);
+CREATE TABLE IF NOT EXISTS quarantine (
+    id INTEGER PRIMARY KEY,
+    message BLOB NOT NULL,
+    error BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS quarantine_index (
+    id INTEGER PRIMARY KEY,
+    error_type TEXT,
+    sender TEXT,
+    quarantined REAL NOT NULL,
+    summary BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS quarantine_index_error_type
+    ON quarantine_index (error_type, id);
+CREATE INDEX IF NOT EXISTS quarantine_index_sender
+    ON quarantine_index (sender, id);
+CREATE INDEX IF NOT EXISTS quarantine_index_quarantined
+    ON quarantine_index (quarantined);
+CREATE TABLE IF NOT EXISTS message_ids (
+    message_id TEXT PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    orig_to TEXT);
+CREATE INDEX IF NOT EXISTS message_ids_timestamp ON message_ids (timestamp);
+"""
+
+
+class SQLiteQueue(Queue):
+    """
+    A first in first out (FIFO) message queue which keeps its messages in
+    the SQLite database at 'path'.  The database is created if need be.
+
+    Partitions are supported for compatibility with `Queue`, but since SQLite
+    allows only one writer at a time, consumers of different partitions do
+    not run concurrently.
+    """
+
+    def __init__(self, path, partitions=1):
+        self.path = path
+        self._partition_count = partitions
+        self._freq_data = OOBTree()
+        self._throttles = OOBTree()
+        self._throttle_times = OOTreeSet()
+
+    def add(self, message):
+        """
+        Add a message to the queue.
+        """
+        cursor = self._write()
+        message_id = _text(message['Message-Id'])
+        orig_to = _text(message['X-Original-To'])
+        cursor.execute("INSERT OR REPLACE INTO message_ids "
+                       "(message_id, timestamp, orig_to) VALUES (?, ?, ?)",
+                       (message_id, time(), orig_to))
+        partition = _random.randrange(self._partition_count)
+        cursor.execute("INSERT INTO messages (partition, message) "
+                       "VALUES (?, ?)", (partition, _flatten(message)))
+
+    def is_duplicate(self, message, window=DUPLICATE_WINDOW):
+        """
+        Returns boolean indicating whether a message with the same
+        'Message-Id' and 'X-Original-To' headers has been added to this queue
+        within the last 'window' seconds.
+        """
+        # Entries older than the window are removed by compact
+        cursor = self._read()
+        cursor.execute("SELECT timestamp, orig_to FROM message_ids "
+                       "WHERE message_id = ?", (_text(message['Message-Id']),))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        timestamp, orig_to = row
+        if timestamp < time() - window:
+            # Expired, but not yet removed
+            return False
+        return orig_to == _text(message.get('X-Original-To'))
+
+    def _prune_message_ids(self, cutoff, limit=None):
+        # Only expired rows are visited, oldest first, and each is removed.
+        cursor = self._write()
+        if limit is None:
+            cursor.execute("DELETE FROM message_ids WHERE timestamp < ?",
+                           (cutoff,))
+        else:
+            cursor.execute("DELETE FROM message_ids WHERE message_id IN "
+                           "(SELECT message_id FROM message_ids "
+                           "WHERE timestamp < ? ORDER BY timestamp LIMIT ?)",
+                           (cutoff, limit))
+        return cursor.rowcount, cursor.rowcount
+
+    def pop_next(self, partition=None):
+        """
+        Retrieve the next message in the queue, removing it from the queue.
+        'partition', if specified, is the index of a partition of the queue
+        from which to retrieve the message.
+        """
+        return self.pop_many(1, partition).next()
+
+    def pop_many(self, n, partition=None):
+        """
+        Retrieve up to 'n' messages from the front of the queue, removing them
+        from the queue.  Returns an iterator over the messages in FIFO order.
+        'partition' is as for `pop_next`.
+        """
+        cursor = self._write()
+        if partition is None:
+            cursor.execute("SELECT id, message FROM messages "
+                           "ORDER BY id LIMIT ?", (n,))
+        else:
+            cursor.execute("SELECT id, message FROM messages "
+                           "WHERE partition = ? ORDER BY id LIMIT ?",
+                           (partition, n))
+        rows = cursor.fetchall()
+        cursor.executemany("DELETE FROM messages WHERE id = ?",
+                           [(id,) for id, data in rows])
+        return (_load(data) for id, data in rows)
+
+    def get_messages(self):
+        """
+        Returns an iterator over the messages in the queue, in FIFO order,
+        without removing them from the queue.
+        """
+        cursor = self._read()
+        cursor.execute("SELECT message FROM messages ORDER BY id")
+        for data, in cursor:
+            yield _load(data)
+
+    def count_partitions(self):
+        """
+        Returns the number of partitions in which messages are stored.
+        """
+        return self._partition_count
+
+    def repartition(self, partitions):
+        """
+        Changes the number of partitions in which messages are stored.  Queued
+        messages keep their order.
+        """
+        if partitions == self._partition_count:
+            return
+        self._write().execute("UPDATE messages SET partition = id % ?",
+                              (partitions,))
+        self._partition_count = partitions
+
+    def __len__(self):
+        return self._count('messages')
+
+    def quarantine(self, message, error, send=None, notice_from=None):
+        """
+        Adds a message and corresponding exception info to the 'quarantine'.
+        See `Queue.quarantine`.
+        """
+        if send is not None and notice_from is None:
+            raise ValueError("Must specify 'notice_from' in order to send "
+                             "notice.")
+
+        cursor = self._write()
+        cursor.execute("SELECT IFNULL(MAX(id) + 1, 0) FROM quarantine")
+        id, = cursor.fetchone()
+        message['X-Postoffice-Id'] = str(id)
+        cursor.execute("INSERT INTO quarantine (id, message, error) "
+                       "VALUES (?, ?, ?)",
+                       (id, _flatten(message), sqlite3.Binary(dumps(error))))
+        summary = _quarantine_summary(message, error)
+        cursor.execute("INSERT OR REPLACE INTO quarantine_index "
+                       "(id, error_type, sender, quarantined, summary) "
+                       "VALUES (?, ?, ?, ?, ?)",
+                       (id, _text(summary['error_type']),
+                        _text(_sender_key(summary['from'])),
+                        _datetime_as_seconds(summary['quarantined']),
+                        sqlite3.Binary(dumps(summary))))
+
+        if send is not None:
+            self._send_quarantine_notice(message, send, notice_from)
+
+    def get_quarantined_messages(self):
+        """
+        Returns an iterator over the messages currently in the quarantine.
+        """
+        cursor = self._read()
+        cursor.execute("SELECT message, error FROM quarantine ORDER BY id")
+        for data, error in cursor.fetchall():
+            yield _load(data), loads(str(error))
+
+    def get_quarantined_message(self, id):
+        cursor = self._read()
+        cursor.execute("SELECT message FROM quarantine WHERE id = ?",
+                       (int(id),))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(id)
+        return _load(row[0])
+
+    def find_quarantined_messages(self, error_type=None, sender=None,
+                                  since=None, until=None):
+        """
+        Returns a list of summaries of the messages in the quarantine which
+        match the given criteria.  See `Queue.find_quarantined_messages`.
+        """
+        where = []
+        params = []
+        if error_type is not None:
+            where.append("error_type = ?")
+            params.append(_text(error_type))
+        if sender is not None:
+            where.append("sender = ?")
+            params.append(_text(_sender_key(sender)))
+        if since is not None:
+            where.append("quarantined >= ?")
+            params.append(_datetime_as_seconds(since))
+        if until is not None:
+            where.append("quarantined < ?")
+            params.append(_datetime_as_seconds(until))
+        query = "SELECT id, summary FROM quarantine_index"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        cursor = self._read()
+        cursor.execute(query + " ORDER BY id", params)
+        return [(str(id), loads(str(summary))) for id, summary in cursor]
+
+    def count_quarantined_errors(self):
+        """
+        Returns a dictionary mapping the names of the types of error for which
+        messages are in the quarantine to the number of such messages.
+        """
+        cursor = self._read()
+        cursor.execute("SELECT error_type, COUNT(*) FROM quarantine_index "
+                       "WHERE error_type IS NOT NULL GROUP BY error_type")
+        return dict(cursor.fetchall())
+
+    def count_quarantined_messages(self):
+        """
+        Returns the number of messages in the quarantine.
+        """
+        return self._count('quarantine')
+
+    def remove_from_quarantine(self, message):
+        """
+        Removes the given message from the quarantine.
+        """
+        id = message.get('X-Postoffice-Id')
+        if id is None:
+            raise ValueError("Message is not in the quarantine.")
+        cursor = self._write()
+        cursor.execute("DELETE FROM quarantine WHERE id = ?", (int(id),))
+        if not cursor.rowcount:
+            raise ValueError("Message is not in the quarantine.")
+        cursor.execute("DELETE FROM quarantine_index WHERE id = ?",
+                       (int(id),))
+        del message['X-Postoffice-Id']
+
+    def _count(self, table):
+        cursor = self._read()
+        cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        return cursor.fetchone()[0]
+
+    def _read(self):
+        """
+        Returns a cursor on the database, within the current transaction if
+        the database has been written to in it.
+        """
+        data_manager = _data_managers.get(
+            (self.path, self._transaction_manager().get()))
+        if data_manager is not None:
+            return data_manager.connection.cursor()
+        connections = _idle_connections(self.path)
+        if not connections:
+            connections.append(_connect(self.path))
+        return connections[-1].cursor()
+
+    def _write(self):
+        """
+        Returns a cursor on the database within a write transaction, which is
+        committed or aborted along with the current transaction.
+        """
+        transaction_manager = self._transaction_manager()
+        txn = transaction_manager.get()
+        data_manager = _data_managers.get((self.path, txn))
+        if data_manager is None:
+            connections = _idle_connections(self.path)
+            if connections:
+                connection = connections.pop()
+            else:
+                connection = _connect(self.path)
+            # Take the write lock up front, so that consumers popping
+            # messages can't both read the same message.
+            connection.execute("BEGIN IMMEDIATE")
+            data_manager = _SQLiteDataManager(
+                connection, self.path, transaction_manager, txn)
+            txn.join(data_manager)
+        return data_manager.connection.cursor()
+
+    def _transaction_manager(self):
+        # The transaction manager of the ZODB connection the queue was loaded
+        # from, which need not be the default one.
+        jar = self._p_jar
+        if jar is None:
+            return transaction.manager
+        return jar.transaction_manager
+
+
+class _SQLiteDataManager(object):
+    """
+    Commits or rolls back a SQLite transaction along with the transaction it
+    has joined.  The SQLite transaction is committed once the other data
+    managers, such as the ZODB's, have voted, so that a conflict in the ZODB
+    aborts both.
+    """
+
+    def __init__(self, connection, path, transaction_manager, txn):
+        self.connection = connection
+        self.path = path
+        self.transaction_manager = transaction_manager
+        self.txn = txn
+        _data_managers[(path, txn)] = self
+
+    def abort(self, txn):
+        self._rollback()
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        self.connection.execute("COMMIT")
+        self._release()
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        self._rollback()
+
+    def sortKey(self):
+        # Vote after the ZODB
+        return '~repoze.postoffice.sqlite:%s' % self.path
+
+    def _rollback(self):
+        if self.connection is not None:
+            self.connection.execute("ROLLBACK")
+            self._release()
+
+    def _release(self):
+        _data_managers.pop((self.path, self.txn), None)
+        _idle_connections(self.path).append(self.connection)
+        self.connection = self.txn = None
+
+
+def _connect(path):
+    # Transactions are begun explicitly, see SQLiteQueue._write.
+    connection = sqlite3.connect(path, timeout=_TIMEOUT, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(_SCHEMA)
+    return connection
+
+def _idle_connections(path):
+    connections = _idle.__dict__.setdefault('connections', {})
+    return connections.setdefault(path, [])
+
+def _flatten(message):
+    buf = StringIO()
+    _write_message(message, buf)
+    return sqlite3.Binary(buf.getvalue())
+
+def _load(data):
+    return LazyBlobMessage(_Text(str(data)))
+
+def _text(value):
+    if isinstance(value, str):
+        value = value.decode('UTF-8', 'replace')
+    return value
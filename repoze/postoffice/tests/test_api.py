@@ -15,7 +15,9 @@ class TestAPI(unittest.TestCase):
 
     def tearDown(self):
         import shutil
+        from repoze.postoffice import api
         shutil.rmtree(self.tempfolder)
+        api._worker = None
 
     def _make_one(self, fp, queues=None, db_path='/postoffice', messages=None):
         from repoze.postoffice.api import PostOffice
@@ -27,6 +29,10 @@ class TestAPI(unittest.TestCase):
         po = PostOffice('postoffice.ini', DummyDB(self.root, queues, db_path),
                         dummy_open)
         po.Queue = DummyQueue
+        po.ShardedQueue = DummyShardedQueue
+        po.SQLiteQueue = DummySQLiteQueue
+        # Tests of compaction after imports enable it themselves
+        po.import_compact_limit = 0
         if messages:
             def mk_message(msg):
                 fd, fname = tempfile.mkstemp(dir=self.tempfolder)
@@ -53,6 +59,17 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(po.ooo_loop_headers, [])
         self.assertEqual(po.ooo_throttle_period, timedelta(minutes=5))
         self.assertEqual(po.max_message_size, 0)
+        self.assertEqual(po.duplicate_window, 24 * 60 * 60)
+        self.assertEqual(po.body_scan_limit, 0)
+        self.assertEqual(po._frequency_window, 60)
+        sender = po.sender
+        self.assertEqual(sender.host, 'localhost')
+        self.assertEqual(sender.port, 25)
+        self.assertEqual(sender.timeout, 30)
+        self.assertEqual(sender.pool_size, 1)
+        self.assertEqual(sender.max_idle, 60)
+        self.assertEqual(po.outbox_max_attempts, 5)
+        self.assertEqual(po.outbox_retry_delay, 60)
 
     def test_ctor_main_everything(self):
         from datetime import timedelta
@@ -65,6 +82,7 @@ class TestAPI(unittest.TestCase):
             "ooo_loop_headers = A, B\n"
             "ooo_throttle_period = 500\n"
             "max_message_size = 500mb\n"
+            "duplicate_window = 3600\n"
         ))
         self.assertEqual(po.zodb_uri, 'filestorage:test.db')
         self.assertEqual(po.maildir, 'test/Maildir')
@@ -73,6 +91,17 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(po.ooo_loop_headers, ['A', 'B'])
         self.assertEqual(po.ooo_throttle_period, timedelta(seconds=500))
         self.assertEqual(po.max_message_size, 500 * 1<<20)
+        self.assertEqual(po.duplicate_window, 3600)
+        self.assertEqual(po._frequency_window, 2)
+
+    def test_ctor_frequency_window(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "ooo_loop_frequency = 0.25\n"
+        ))
+        self.assertEqual(po._frequency_window, 17)
 
     def test_ctor_missing_main_section(self):
         self.assertRaises(
@@ -159,6 +188,87 @@ class TestAPI(unittest.TestCase):
         _compare_re(filters[4].regexps[1][1],
                     re.compile(u'You are nice', re.MULTILINE))
 
+    def test_ctor_smtp(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "smtp_host = mail.example.com\n"
+            "smtp_port = 2525\n"
+            "smtp_timeout = 2.5\n"
+            "smtp_pool_size = 4\n"
+            "smtp_max_idle = 10\n"
+        ))
+        sender = po.sender
+        self.assertEqual(sender.host, 'mail.example.com')
+        self.assertEqual(sender.port, 2525)
+        self.assertEqual(sender.timeout, 2.5)
+        self.assertEqual(sender.pool_size, 4)
+        self.assertEqual(sender.max_idle, 10)
+
+    def test_ctor_outbox(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "outbox_max_attempts = 3\n"
+            "outbox_retry_delay = 300\n"
+        ))
+        self.assertEqual(po.outbox_max_attempts, 3)
+        self.assertEqual(po.outbox_retry_delay, 300)
+
+    def test_ctor_notice_templates(self):
+        import codecs
+        import os
+        path = os.path.join(self.tempfolder, 'bounce.txt')
+        with codecs.open(path, 'w', 'UTF-8') as f:
+            f.write(u"Subject: Bounced\n\nCaf\xe9: {reason}\n")
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "bounce_template = %s\n" % path
+        ))
+        self.assertEqual(po.notice_templates['bounce'],
+                         u"Subject: Bounced\n\nCaf\xe9: {reason}\n")
+        self.assertEqual(po.notice_templates['quarantine_notice'], None)
+        self.assertEqual(po.notice_templates['bounce_digest'], None)
+
+    def test_ctor_notice_template_bad_field(self):
+        import os
+        path = os.path.join(self.tempfolder, 'notice.txt')
+        with open(path, 'w') as f:
+            f.write("Subject: Oops\n\n{reason}\n")
+        self.assertRaises(ValueError, self._make_one, StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "quarantine_notice_template = %s\n" % path
+        ))
+
+    def test_ctor_smtp_bad_port(self):
+        self.assertRaises(ValueError, self._make_one, StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "smtp_port = smtp\n"
+        ))
+
+    def test_ctor_body_scan_limit(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "body_scan_limit = 1m\n"
+            "reject_filters =\n"
+            "\theader_regexp: Subject: You are nice\n"
+            "\tbody_regexp: I like you\n"
+        ))
+        self.assertEqual(po.body_scan_limit, 1<<20)
+        filters = po.reject_filters
+        self.failIf(hasattr(filters[0], 'max_bytes'))
+        self.assertEqual(filters[1].max_bytes, 1<<20)
+
     def test_ctor_global_reject_filters(self):
         import pkg_resources
         import re
@@ -220,6 +330,112 @@ class TestAPI(unittest.TestCase):
             "\tfoo:exampleA.com\n"
         ))
 
+    def test_ctor_queue_partitions(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "partitions = 4\n"
+            "[queue:B]\n"
+        ))
+        queues = po.configured_queues
+        self.assertEqual(queues[0]['partitions'], 4)
+        self.assertEqual(queues[1]['partitions'], 1)
+
+    def test_ctor_queue_shards(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "shards = 4\n"
+            "[queue:B]\n"
+        ))
+        queues = po.configured_queues
+        self.assertEqual(queues[0]['shards'], 4)
+        self.assertEqual(queues[1]['shards'], 1)
+
+    def test_ctor_queue_bad_shards(self):
+        self.assertRaises(ValueError, self._make_one, StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "shards = 0\n"
+        ))
+
+    def test_ctor_queue_storage(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "storage = sqlite:%(here)s/var/A.db\n"
+            "[queue:B]\n"
+            "storage = zodb\n"
+            "[queue:C]\n"
+        ))
+        import os
+        queues = po.configured_queues
+        self.assertEqual(queues[0]['sqlite_path'],
+                         os.path.join(os.getcwd(), 'var', 'A.db'))
+        self.assertEqual(queues[1]['sqlite_path'], None)
+        self.assertEqual(queues[2]['sqlite_path'], None)
+
+    def test_ctor_queue_bad_storage(self):
+        for storage in ('mysql:foo', 'sqlite', 'sqlite: '):
+            self.assertRaises(ValueError, self._make_one, StringIO(
+                "[post office]\n"
+                "zodb_uri = filestorage:test.db\n"
+                "maildir = test/Maildir\n"
+                "[queue:A]\n"
+                "storage = %s\n" % storage
+            ))
+
+    def test_ctor_queue_sharded_sqlite(self):
+        self.assertRaises(ValueError, self._make_one, StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "shards = 2\n"
+            "storage = sqlite:A.db\n"
+        ))
+
+    def test_ctor_queue_bounce_limit(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "bounce_limit = 5\n"
+            "bounce_window = 600\n"
+            "bounce_digest = true\n"
+            "[queue:B]\n"
+        ))
+        queues = po.configured_queues
+        self.assertEqual(queues[0]['bounce_limit'], (5, 600, True))
+        self.assertEqual(queues[1]['bounce_limit'], (None, 3600, False))
+
+    def test_ctor_queue_bad_bounce_limit(self):
+        self.assertRaises(ValueError, self._make_one, StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "bounce_limit = 0\n"
+        ))
+
+    def test_ctor_queue_bad_partitions(self):
+        self.assertRaises(ValueError, self._make_one, StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "partitions = 0\n"
+        ))
+
     def test_ctor_malformed_section(self):
         po = self._make_one(StringIO(
             "[post office]\n"
@@ -290,6 +506,319 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(len(log.infos), 1)
         self.failUnless(self.tx.committed)
 
+    def test_reconcile_queues_partitions(self):
+        log = DummyLogger()
+        queues = {'B': DummyQueue(), 'C': DummyQueue(partitions=3)}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "partitions = 2\n"
+            "[queue:B]\n"
+            "partitions = 3\n"
+            "[queue:C]\n"
+            "partitions = 3\n"
+        ), queues)
+        po.reconcile_queues(log)
+        self.assertEqual(queues['A'].partitions, 2)
+        self.assertEqual(queues['B'].partitions, 3)
+        self.assertEqual(queues['C'].partitions, 3)
+        self.assertEqual(len(log.infos), 2)
+
+    def test_reconcile_queues_shards(self):
+        log = DummyLogger()
+        queues = {'B': DummyQueue(), 'C': DummyShardedQueue(2)}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "shards = 2\n"
+            "partitions = 3\n"
+            "[queue:B]\n"
+            "shards = 2\n"
+            "[queue:C]\n"
+            "shards = 2\n"
+        ), queues)
+        po.reconcile_queues(log)
+        self.failUnless(isinstance(queues['A'], DummyShardedQueue))
+        self.assertEqual(queues['A'].shards, 2)
+        self.assertEqual(queues['A'].partitions, 3)
+        self.failIf(isinstance(queues['B'], DummyShardedQueue))
+        self.assertEqual(len(log.infos), 1)
+        self.assertEqual(len(log.warnings), 1)
+
+    def test_compact(self):
+        log = DummyLogger()
+        queues = {'A': DummyQueue(), 'B': DummyQueue()}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        results = po.compact(log, batch_size=2)
+        self.assertEqual(results, {
+            'A': {'senders': 3, 'entries': 3, 'throttles': 0,
+                  'message_ids': 0},
+            'B': {'senders': 3, 'entries': 3, 'throttles': 0,
+                  'message_ids': 0},
+        })
+        self.assertEqual(self.tx.commits, 4)
+        self.failUnless(queues['A'].compacted)
+        self.assertEqual(queues['A'].duplicate_window, 86400)
+        self.assertEqual(len(log.infos), 2)
+
+    def test_compact_aborts_on_error(self):
+        queues = {'A': DummyQueue()}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        self.tx.fail_commits = 1
+        self.assertRaises(ValueError, po.compact)
+        self.failUnless(self.tx.aborted)
+
+    def test_compact_retries_conflicts(self):
+        from ZODB.POSException import ConflictError
+        queues = {'A': DummyQueue()}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        self.tx.fail_commits = 2
+        self.tx.fail_error = ConflictError
+        results = po.compact(batch_size=2)
+        self.assertEqual(results['A']['senders'], 3)
+        self.assertEqual(self.tx.commits, 2)
+        self.failUnless(self.tx.aborted)
+
+    def test_compact_gives_up_after_conflicts(self):
+        from ZODB.POSException import ConflictError
+        queues = {'A': DummyQueue()}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        self.tx.fail_commits = 4
+        self.tx.fail_error = ConflictError
+        self.assertRaises(ConflictError, po.compact)
+        self.assertEqual(self.tx.commits, 0)
+
+    def test_ctor_import_compact_limit_default(self):
+        from repoze.postoffice.api import PostOffice
+        def dummy_open(fname):
+            return StringIO(
+                "[post office]\n"
+                "zodb_uri = filestorage:test.db\n"
+                "maildir = test/Maildir\n")
+        po = PostOffice('postoffice.ini', DummyDB(self.root, None,
+                                                  '/postoffice'), dummy_open)
+        self.assertEqual(po.import_compact_limit, 1000)
+
+    def test_import_messages_compacts_some(self):
+        log = DummyLogger()
+        po, A = self._make_batched(self._make_batch_messages('one'))
+        po.import_compact_limit = 2
+        po.import_messages(log)
+        self.assertEqual(len(A), 1)
+        self.assertEqual(self.tx.commits, 2)
+        self.assertEqual(A.duplicate_window, 86400)
+        self.assertEqual(po._compact_starts, {'A': 2})
+        self.failUnless(log.infos[1].startswith('Compacted queue A: removed '
+                                                '2 senders'), log.infos)
+
+        # Not due again yet
+        po.import_messages(log)
+        self.assertEqual(self.tx.commits, 2)
+
+        # Carries on where it left off
+        po._compacted -= 60
+        po.import_messages(log)
+        self.assertEqual(self.tx.commits, 3)
+        self.assertEqual(po._compact_starts, {'A': None})
+
+    def test_import_messages_compaction_conflict(self):
+        from ZODB.POSException import ConflictError
+        log = DummyLogger()
+        po, A = self._make_batched(self._make_batch_messages('one'))
+        po.import_compact_limit = 2
+        def compact(*args):
+            raise ConflictError
+        A.compact = compact
+        po.import_messages(log)
+        self.assertEqual(len(A), 1)
+        self.assertEqual(self.tx.commits, 1)
+        self.failUnless(self.tx.aborted)
+        self.assertEqual(po._compact_starts, {})
+        self.assertEqual(log.infos[1],
+                         'Postponed compacting queue A after a conflict.')
+        self.failIf(po._is_compaction_due())
+
+    def test_compact_some(self):
+        queues = {'A': DummyQueue()}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        po.compact_some()
+        self.failIf(hasattr(queues['A'], 'compacted'))
+        po.import_compact_limit = 5
+        po.compact_some()
+        self.failUnless(queues['A'].compacted)
+        self.assertEqual(self.tx.commits, 1)
+        self.assertEqual(po._compact_starts, {'A': None})
+        po.compact_some()
+        self.assertEqual(self.tx.commits, 1)
+
+    def test_send_outbox(self):
+        log = DummyLogger()
+        queues = {'A': DummyQueue(), 'B': DummyQueue()}
+        queues['A'].outbox.extend(['one', 'two', 'three'])
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "outbox_max_attempts = 3\n"
+            "outbox_retry_delay = 300\n"
+        ), queues)
+        sent = []
+        po.sender = lambda fromaddr, toaddrs, message: sent.append(message)
+        results = po.send_outbox(log, batch_size=2)
+        self.assertEqual(results, {
+            'A': {'sent': 3, 'retried': 0, 'failed': 0},
+            'B': {'sent': 0, 'retried': 0, 'failed': 0},
+        })
+        self.assertEqual(sent, ['one', 'two', 'three'])
+        self.assertEqual(queues['A'].outbox.drained, [(2, 3, 300)] * 2)
+        self.assertEqual(self.tx.commits, 3)
+        self.assertEqual(len(log.infos), 1)
+        self.assertEqual(len(log.warnings), 0)
+
+    def test_send_outbox_failures(self):
+        log = DummyLogger()
+        queues = {'A': DummyQueue()}
+        queues['A'].outbox.extend(['one', 'two', 'three'])
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        def send(fromaddr, toaddrs, message):
+            raise IOError('Connection refused')
+        po.sender = send
+        queues['A'].outbox.give_up = ['two']
+        results = po.send_outbox(log)
+        self.assertEqual(results, {
+            'A': {'sent': 0, 'retried': 2, 'failed': 1},
+        })
+        self.failUnless(queues['A'].outbox.log is log)
+        self.assertEqual(len(log.infos), 1)
+        self.assertEqual(len(log.warnings), 1)
+
+    def test_send_outbox_aborts_on_error(self):
+        queues = {'A': DummyQueue()}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        self.tx.fail_commits = 1
+        self.assertRaises(ValueError, po.send_outbox)
+        self.failUnless(self.tx.aborted)
+
+    def test_send_outbox_bounce_digests(self):
+        queues = {'A': DummyQueue()}
+        queues['A'].digests = 2
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ), queues)
+        sent = []
+        po.sender = lambda fromaddr, toaddrs, message: sent.append(message)
+        results = po.send_outbox()
+        self.assertEqual(results['A']['sent'], 2)
+        self.assertEqual(sent, ['digest', 'digest'])
+
+    def test_reconcile_queues_bounce_limit(self):
+        log = DummyLogger()
+        queues = {'A': DummyQueue(), 'B': DummyQueue()}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "bounce_limit = 5\n"
+            "[queue:B]\n"
+            "[queue:C]\n"
+            "bounce_limit = 2\n"
+            "bounce_digest = yes\n"
+        ), queues)
+        po.reconcile_queues(log)
+        self.assertEqual(queues['A'].get_bounce_limit(), (5, 3600, False))
+        self.assertEqual(queues['B'].get_bounce_limit(), (None, 3600, False))
+        self.assertEqual(queues['C'].get_bounce_limit(), (2, 3600, True))
+        self.assertEqual(len(log.infos), 2)
+
+    def test_reconcile_queues_notice_templates(self):
+        import os
+        path = os.path.join(self.tempfolder, 'bounce.txt')
+        with open(path, 'w') as f:
+            f.write("Subject: Bounced\n\n{reason}\n")
+        log = DummyLogger()
+        queues = {'A': DummyQueue(), 'B': DummyQueue()}
+        queues['B'].set_notice_template('bounce', 'old')
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "bounce_template = %s\n"
+            "[queue:A]\n"
+            "[queue:B]\n"
+            "[queue:C]\n" % path
+        ), queues)
+        po.reconcile_queues(log)
+        for name in 'ABC':
+            queue = queues[name]
+            self.assertEqual(queue.get_notice_template('bounce'),
+                             u"Subject: Bounced\n\n{reason}\n")
+            self.assertEqual(queue.get_notice_template('bounce_digest'), None)
+        self.assertEqual(len(log.infos), 3)
+
+        log = DummyLogger()
+        po.reconcile_queues(log)
+        self.assertEqual(log.infos, [])
+
+    def test_reconcile_queues_storage(self):
+        log = DummyLogger()
+        queues = {'B': DummyQueue(), 'C': DummySQLiteQueue('C.db'),
+                  'D': DummySQLiteQueue('D.db')}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "[queue:A]\n"
+            "storage = sqlite:A.db\n"
+            "partitions = 2\n"
+            "[queue:B]\n"
+            "storage = sqlite:B.db\n"
+            "[queue:C]\n"
+            "storage = sqlite:C.db\n"
+            "[queue:D]\n"
+        ), queues)
+        po.reconcile_queues(log)
+        self.failUnless(isinstance(queues['A'], DummySQLiteQueue))
+        self.assertEqual(queues['A'].path, 'A.db')
+        self.assertEqual(queues['A'].partitions, 2)
+        self.failIf(isinstance(queues['B'], DummySQLiteQueue))
+        self.assertEqual(len(log.infos), 1)
+        self.assertEqual(len(log.warnings), 2)
+
     def test_reconcile_queues_custom_db_path(self):
         queues = {}
         po = self._make_one(StringIO(
@@ -361,6 +890,7 @@ class TestAPI(unittest.TestCase):
         m = A.pop_next()
         self.assertEqual(m, 'one')
         self.assertTrue(int(m['X-Postoffice-Date']))
+        self.assertEqual(A.frequency_window, 60)
         B = queues['B']
         self.assertEqual(len(B), 2)
         self.assertEqual(B.pop_next(), 'three')
@@ -481,6 +1011,7 @@ class TestAPI(unittest.TestCase):
         A.duplicate = True
         po.import_messages(log)
         self.assertEqual(len(A), 0)
+        self.assertEqual(A.duplicate_window, 24 * 60 * 60)
         self.assertEqual(len(log.infos), 2)
 
     def test_import_message_malformed_date(self):
@@ -733,6 +1264,7 @@ class TestAPI(unittest.TestCase):
         A = queues['A']
         po.import_messages(log)
         self.assertEqual(A.match_headers, {'A': 'foo', 'B': 'bar'})
+        self.assertEqual(A.throttle_headers, {'A': 'foo', 'B': 'bar'})
 
     def test_missing_from(self):
         log = DummyLogger()
@@ -866,6 +1398,173 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(len(A), 0)
         self.assertEqual(len(log.infos), 2)
 
+    def _make_batched(self, messages, batch_size=1, batch_interval=0):
+        queues = {}
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+            "import_batch_size = %d\n"
+            "import_batch_interval = %s\n"
+            "[queue:A]\n"
+            "filters =\n"
+            "\tto_hostname:exampleA.com\n" % (batch_size, batch_interval)
+            ),
+            queues=queues,
+            messages=messages,
+            )
+        po.reconcile_queues()
+        self.tx.commits = 0
+        return po, queues['A']
+
+    def _make_batch_messages(self, *bodies):
+        messages = []
+        for body in bodies:
+            message = DummyMessage(body)
+            message['To'] = 'dummy@exampleA.com'
+            messages.append(message)
+        return messages
+
+    def test_ctor_import_batch_defaults(self):
+        po = self._make_one(StringIO(
+            "[post office]\n"
+            "zodb_uri = filestorage:test.db\n"
+            "maildir = test/Maildir\n"
+        ))
+        self.assertEqual(po.import_batch_size, 1)
+        self.assertEqual(po.import_batch_interval, 0)
+
+    def test_import_messages_one_transaction_per_message(self):
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'two', 'three'))
+        po.import_messages(DummyLogger())
+        self.assertEqual(self.tx.commits, 3)
+        self.assertEqual(len(A), 3)
+        self.assertEqual(len(self.messages), 0)
+
+    def test_import_messages_batch_size(self):
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'two', 'three'), batch_size=2)
+        po.import_messages(DummyLogger())
+        self.assertEqual(self.tx.commits, 2)
+        self.assertEqual(list(A), ['one', 'two', 'three'])
+        self.assertEqual(len(self.messages), 0)
+
+    def test_import_messages_batch_interval(self):
+        from repoze.postoffice import api
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'two', 'three', 'four'),
+            batch_size=100, batch_interval=1.5)
+        save_time, api.time = api.time, DummyClock()
+        try:
+            po.import_messages(DummyLogger())
+        finally:
+            api.time = save_time
+        # Clock advances one second per reading, so a batch is flushed after
+        # every second message.
+        self.assertEqual(self.tx.commits, 2)
+        self.assertEqual(len(A), 4)
+        self.assertEqual(len(self.messages), 0)
+
+    def test_import_messages_failed_commit_retries_one_at_a_time(self):
+        log = DummyLogger()
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'two', 'three'), batch_size=3)
+        self.tx.fail_commits = 1
+        po.import_messages(log)
+        self.assertEqual(self.tx.commits, 3)
+        self.failUnless(self.tx.aborted)
+        self.assertEqual(len(log.warnings), 1)
+        self.assertEqual(len(self.messages), 0)
+
+    def test_import_messages_failed_batch_archives_only_committed(self):
+        class BadQueue(DummyQueue):
+            def add(self, message):
+                if message == 'bad':
+                    raise ValueError('bad')
+                DummyQueue.add(self, message)
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'bad', 'three'), batch_size=3)
+        queues = self.root['postoffice']
+        queues['A'] = BadQueue()
+        self.assertRaises(ValueError, po.import_messages, DummyLogger())
+        self.assertEqual(self.tx.commits, 1)
+        self.assertEqual(sorted(self.messages.keys()), [1, 2])
+
+    def test_import_messages_workers(self):
+        log = DummyLogger()
+        messages = self._make_batch_messages('one', 'two', 'three')
+        del messages[1]['From']
+        po, A = self._make_batched(messages, batch_size=2)
+        po.Pool = DummyPool
+        po.import_messages(log, workers=4)
+        pool = DummyPool.instance
+        self.assertEqual(pool.processes, 4)
+        self.failUnless(pool.terminated)
+        self.failUnless(pool.joined)
+        self.assertEqual([m.get_payload() for m in A], ['one', 'three'])
+        self.failUnless(int(A[0]['X-Postoffice-Date']))
+        self.assertEqual(self.tx.commits, 2)
+        self.assertEqual(len(self.messages), 0)
+        self.assertEqual(len(log.infos), 4)
+        # Workers log as messages are read, ahead of the batch being stored
+        self.failUnless(log.infos[0].startswith(
+            "Message discarded: no 'From' header"))
+
+    def test_import_messages_workers_failed_commit_retries_one_at_a_time(self):
+        log = DummyLogger()
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'two', 'three'), batch_size=3)
+        po.Pool = DummyPool
+        self.tx.fail_commits = 1
+        po.import_messages(log, workers=2)
+        self.assertEqual(self.tx.commits, 3)
+        self.assertEqual(len(log.warnings), 1)
+        # Messages added by the failed batch aren't rolled back by dummies
+        self.assertEqual([m.get_payload() for m in A[-3:]],
+                         ['one', 'two', 'three'])
+        self.assertEqual(len(self.messages), 0)
+
+    def test_import_messages_workers_error_raised_by_importer(self):
+        def bad_filter(message):
+            if message.get_payload() == 'bad':
+                raise ValueError('bad')
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'bad', 'three'), batch_size=3)
+        po.Pool = DummyPool
+        po.reject_filters.append(bad_filter)
+        self.assertRaises(ValueError, po.import_messages, DummyLogger(), 2)
+        self.failUnless(DummyPool.instance.terminated)
+        self.assertEqual(self.tx.commits, 1)
+        self.assertEqual(A[-1].get_payload(), 'one')
+        self.assertEqual(sorted(self.messages.keys()), [1, 2])
+
+    def test_import_messages_workers_slices(self):
+        from repoze.postoffice import api
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'two', 'three'), batch_size=2)
+        po.Pool = DummyPool
+        save_chunksize, api._WORKER_CHUNKSIZE = api._WORKER_CHUNKSIZE, 1
+        try:
+            po.import_messages(DummyLogger(), workers=2)
+        finally:
+            api._WORKER_CHUNKSIZE = save_chunksize
+        self.assertEqual([len(keys) for keys in DummyPool.instance.slices],
+                         [2, 1])
+        self.assertEqual([m.get_payload() for m in A],
+                         ['one', 'two', 'three'])
+
+    def test_import_messages_given_pool(self):
+        po, A = self._make_batched(
+            self._make_batch_messages('one', 'two'), batch_size=2)
+        po.Pool = DummyPool
+        pool = po.make_pool(2)
+        self.assertEqual(pool.processes, 2)
+        po.import_messages(DummyLogger(), 2, pool)
+        self.failUnless(DummyPool.instance is pool)
+        self.failIf(pool.terminated or pool.closed)
+        self.assertEqual([m.get_payload() for m in A], ['one', 'two'])
+        self.assertEqual(len(self.messages), 0)
 
 _marker = object()
 
@@ -1064,6 +1763,78 @@ class Test_filters_match(unittest.TestCase):
         self.assertFalse(self._call_fut(FILTERS, MESSAGE))
         self.assertEqual(_called, [MESSAGE, MESSAGE])
 
+class Test_QueueRouter(unittest.TestCase):
+
+    def _make_one(self, *queues):
+        from repoze.postoffice.api import _QueueRouter
+        return _QueueRouter([dict(name=name, filters=filters)
+                             for name, filters in queues])
+
+    def _names(self, router, message):
+        return [queue['name'] for queue in router(message)]
+
+    def test_empty(self):
+        router = self._make_one()
+        self.assertEqual(self._names(router, {'To': 'a@example.com'}), [])
+
+    def test_queue_without_filters_never_matches(self):
+        router = self._make_one(('A', []))
+        self.assertEqual(self._names(router, {'To': 'a@example.com'}), [])
+
+    def test_indexed_by_domain(self):
+        from repoze.postoffice.filters import ToHostnameFilter
+        router = self._make_one(
+            ('A', [ToHostnameFilter('example.com')]),
+            ('B', [ToHostnameFilter('.example.org example.net')]),
+            ('C', [ToHostnameFilter('example.net')]),
+        )
+        self.assertEqual(self._names(router, {'To': 'a@example.com'}), ['A'])
+        self.assertEqual(self._names(router, {'To': 'a@foo.example.org'}),
+                         ['B'])
+        self.assertEqual(self._names(router, {'To': 'a@example.net'}),
+                         ['B', 'C'])
+        self.assertEqual(self._names(router, {'To': 'a@foo.example.com'}),
+                         [])
+        self.assertEqual(self._names(router, {'To': 'a@example.com',
+                                              'Cc': 'b@example.net'}),
+                         ['A', 'B', 'C'])
+
+    def test_suffix_matches_end_of_hostname(self):
+        from repoze.postoffice.filters import ToHostnameFilter
+        router = self._make_one(
+            ('A', [ToHostnameFilter('.example.com')]),
+            ('B', [ToHostnameFilter('.com')]),
+        )
+        self.assertEqual(self._names(router, {'To': 'a@badexample.com'}),
+                         ['A', 'B'])
+        self.assertEqual(self._names(router, {'To': 'a@example.org'}), [])
+        self.assertEqual(self._names(router, {'To': 'a@om'}), [])
+
+    def test_respects_filter_headers(self):
+        from repoze.postoffice.filters import ToHostnameFilter
+        router = self._make_one(
+            ('A', [ToHostnameFilter('example.com;headers=X-Original-To')]),
+            ('B', [ToHostnameFilter('example.com')]),
+        )
+        self.assertEqual(self._names(router, {'To': 'a@example.com'}), ['B'])
+        self.assertEqual(
+            self._names(router, {'X-Original-To': 'a@example.com'}),
+            ['A', 'B'])
+
+    def test_unindexed_queues_keep_their_place(self):
+        from repoze.postoffice.filters import HeaderRegexpFilter
+        from repoze.postoffice.filters import ToHostnameFilter
+        router = self._make_one(
+            ('A', [ToHostnameFilter('example.com')]),
+            ('B', [HeaderRegexpFilter('Subject: Party')]),
+            ('C', [HeaderRegexpFilter('Subject: Party'),
+                   ToHostnameFilter('example.com')]),
+        )
+        self.assertEqual(self._names(router, {'To': 'a@example.com'}),
+                         ['A', 'B', 'C'])
+        self.assertEqual(self._names(router, {'To': 'a@example.org'}), ['B'])
+
+
 class Test_ascii_dammit(unittest.TestCase):
 
     def _call_fut(self, value):
@@ -1237,12 +2008,15 @@ class Test_send_mail(unittest.TestCase):
 
     def _call_fut(self, from_addr, to_addrs, message, smtplib):
         from repoze.postoffice.api import _send_mail
-        return _send_mail(from_addr, to_addrs, message, smtplib)
+        from repoze.postoffice.smtp import SMTPSender
+        sender = SMTPSender(smtplib=smtplib)
+        return _send_mail(from_addr, to_addrs, message, sender)
 
     def test_string_message(self):
         smtp = DummySMTPLib()
         self._call_fut('me', ['you', 'them'], 'Hello', smtplib=smtp)
         self.assertEqual(smtp.sent, [('me', ['you', 'them'], 'Hello'),])
+        self.assertEqual(smtp.connected, [('localhost', 25)])
 
     def test_message_object(self):
         smtp = DummySMTPLib()
@@ -1251,6 +2025,12 @@ class Test_send_mail(unittest.TestCase):
         self.assertEqual(smtp.sent, [('me', ['you', 'them'],
                                       message.as_string()),])
 
+    def test_default_sender(self):
+        from repoze.postoffice import api
+        from repoze.postoffice.smtp import SMTPSender
+        self.failUnless(isinstance(api._default_sender, SMTPSender))
+        self.assertEqual(api._default_sender.host, 'localhost')
+
 class Test_message_factory_factory(unittest.TestCase):
 
     def _call_fut(self, po, wrapped, log):
@@ -1381,8 +2161,10 @@ class Test_NullLog(unittest.TestCase):
 class DummySMTPLib(object):
     def __init__(self):
         self.sent = []
+        self.connected = []
 
-    def SMTP(self, host):
+    def SMTP(self, host, port, timeout):
+        self.connected.append((host, port))
         return self
 
     def sendmail(self, from_addr, to_addrs, msg):
@@ -1435,16 +2217,84 @@ class DummyLogger(object):
     def info(self, msg):
         self.infos.append(msg)
 
+class DummyOutbox(list):
+    give_up = ()
+
+    def __init__(self):
+        list.__init__(self)
+        self.drained = []
+
+    def send(self, fromaddr, toaddrs, message):
+        self.append(message)
+
+    def drain(self, send, now, limit, max_attempts, retry_delay, log):
+        self.drained.append((limit, max_attempts, retry_delay))
+        self.log = log
+        sent = retried = failed = 0
+        for message in self[:limit]:
+            self.remove(message)
+            try:
+                send('me', ['you'], message)
+                sent += 1
+            except IOError:
+                if message in self.give_up:
+                    failed += 1
+                else:
+                    retried += 1
+        return sent, retried, failed
+
 class DummyTransaction(object):
     committed = False
     aborted = False
+    commits = 0
+    fail_commits = 0
+    fail_error = ValueError
 
     def commit(self):
+        if self.fail_commits:
+            self.fail_commits -= 1
+            raise self.fail_error('Commit failed')
         self.committed = True
+        self.commits += 1
 
     def abort(self):
         self.aborted = True
 
+class DummyPool(object):
+    # Runs tasks in this process, in order
+    instance = None
+
+    def __init__(self, processes, initializer, initargs):
+        DummyPool.instance = self
+        self.processes = processes
+        self.terminated = self.joined = self.closed = False
+        self.slices = []
+        initializer(*initargs)
+
+    def imap(self, func, iterable, chunksize):
+        self.slices.append(list(iterable))
+        return self._imap(func, self.slices[-1])
+
+    def _imap(self, func, iterable):
+        for item in iterable:
+            yield func(item)
+
+    def close(self):
+        self.closed = True
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self):
+        self.joined = True
+
+class DummyClock(object):
+    now = 0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
 def DummyMaildirFactory(messages):
     messages = dict(zip(xrange(len(messages)), messages))
 
@@ -1459,7 +2309,9 @@ def DummyMaildirFactory(messages):
             return range(len(messages))
 
         def get_message(self, key):
-            return self.factory(messages[key])
+            fp = messages[key]
+            fp.seek(0)
+            return self.factory(fp)
 
         def remove(self, key):
             del messages[key]
@@ -1494,7 +2346,52 @@ class DummyMessage(MaildirMessage):
     def __hash__(self):
         return hash(self.get_payload())
 
-class DummyQueue(list):
+class DummyBounceLimit(object):
+    bounce_limit = (None, 3600, False)
+    digests = 0
+    notice_templates = {}
+
+    def get_notice_template(self, kind):
+        return self.notice_templates.get(kind)
+
+    def set_notice_template(self, kind, template):
+        self.notice_templates = dict(self.notice_templates)
+        self.notice_templates[kind] = template
+
+    def get_bounce_limit(self):
+        return self.bounce_limit
+
+    def set_bounce_limit(self, limit, window, digest):
+        self.bounce_limit = (limit, window, digest)
+
+    def send_bounce_digests(self, send):
+        for i in xrange(self.digests):
+            send('me', ['you'], 'digest')
+
+class DummyShardedQueue(DummyBounceLimit, list):
+
+    def __init__(self, shards, partitions=1):
+        list.__init__(self)
+        self.shards = shards
+        self.partitions = partitions
+
+    def count_shards(self):
+        return self.shards
+
+    def count_partitions(self):
+        return self.partitions
+
+class DummySQLiteQueue(DummyBounceLimit, list):
+
+    def __init__(self, path, partitions=1):
+        list.__init__(self)
+        self.path = path
+        self.partitions = partitions
+
+    def count_partitions(self):
+        return self.partitions
+
+class DummyQueue(DummyBounceLimit, list):
     throttled = False
     instant_freq = 0
     average_freq = 0
@@ -1502,9 +2399,36 @@ class DummyQueue(list):
     match_headers = None
     duplicate = False
 
+    def __init__(self, partitions=1):
+        list.__init__(self)
+        self.partitions = partitions
+        self.outbox = DummyOutbox()
+
+    def get_outbox(self):
+        return self.outbox
+
     def add(self, message):
         self.append(message)
 
+    def count_partitions(self):
+        return self.partitions
+
+    def repartition(self, partitions):
+        self.partitions = partitions
+
+    def compact(self, now, limit=None, start=None, duplicate_window=None):
+        # Pretend there are three senders, each with an expired entry
+        self.compacted = now
+        self.duplicate_window = duplicate_window
+        if start is None:
+            start = 0
+        end = min(start + limit, 3)
+        reclaimed = {'senders': end - start, 'entries': end - start,
+                     'throttles': 0, 'message_ids': 0}
+        if end < 3:
+            return reclaimed, end
+        return reclaimed, None
+
     def pop_next(self):
         return self.pop(0)
 
@@ -1512,6 +2436,7 @@ class DummyQueue(list):
         self.throttled = until
 
     def is_throttled(self, user, now, headers):
+        self.throttle_headers = headers
         return self.throttled
 
     def get_instantaneous_frequency(self, user, now, headers):
@@ -1523,8 +2448,9 @@ class DummyQueue(list):
         self.match_headers = headers
         return self.average_freq
 
-    def collect_frequency_data(self, message, headers):
-        pass
+    def collect_frequency_data(self, message, headers, window):
+        self.frequency_window = window
 
-    def is_duplicate(self, message):
+    def is_duplicate(self, message, window):
+        self.duplicate_window = window
         return self.duplicate
@@ -181,6 +181,44 @@ class TestToHostnameFilter(unittest.TestCase):
         self.assertEqual(fut({'To': 'chris@example1.com'}),
             'to_hostname: chris@example1.com matches example1.com')
 
+    def test_relative_matches_partial_label(self):
+        fut = self._make_one('.example.com')
+        self.assertEqual(fut({'To': 'chris@badexample.com'}),
+            'to_hostname: chris@badexample.com matches .example.com')
+        self.assertEqual(fut({'To': 'chris@foo.badexample.com'}),
+            'to_hostname: chris@foo.badexample.com matches .example.com')
+        self.assertEqual(fut({'To': 'chris@example.co'}), None)
+        self.assertEqual(fut({'To': 'chris@xample.com'}), None)
+
+    def test_multiple_hosts_first_listed_wins(self):
+        fut = self._make_one('.example.com foo.example.com')
+        self.assertEqual(fut({'To': 'chris@foo.example.com'}),
+            'to_hostname: chris@foo.example.com matches .example.com')
+        fut = self._make_one('foo.example.com .example.com')
+        self.assertEqual(fut({'To': 'chris@foo.example.com'}),
+            'to_hostname: chris@foo.example.com matches foo.example.com')
+        fut = self._make_one('.example.com .foo.example.com')
+        self.assertEqual(fut({'To': 'chris@bar.foo.example.com'}),
+            'to_hostname: chris@bar.foo.example.com matches .example.com')
+
+    def test_many_hosts(self):
+        fut = self._make_one(' '.join(['example%d.com .sub%d.example.com' %
+                                       (i, i) for i in range(5000)]))
+        self.assertEqual(fut({'To': 'chris@example4999.com'}),
+            'to_hostname: chris@example4999.com matches example4999.com')
+        self.assertEqual(fut({'To': 'chris@a.b.sub4999.example.com'}),
+            'to_hostname: chris@a.b.sub4999.example.com matches '
+            '.sub4999.example.com')
+        self.assertEqual(fut({'To': 'chris@example5000.com'}), None)
+
+    def test_match_hostname(self):
+        fut = self._make_one('example.com .example.org')
+        self.assertEqual(fut.match_hostname('example.com'), 'example.com')
+        self.assertEqual(fut.match_hostname('foo.example.com'), None)
+        self.assertEqual(fut.match_hostname('foo.example.org'), '.example.org')
+        self.assertEqual(fut.match_hostname('example.org'), '.example.org')
+        self.assertEqual(fut.match_hostname('org'), None)
+
     def test_multiple_addrs(self):
         fut = self._make_one('example.com')
         self.assertEqual(fut({
@@ -225,6 +263,73 @@ class TestHeaderRegexpFilter(unittest.TestCase):
         self.assertEqual(fut(msg),
                          'header_regexp: headers match %s' % repr(regexp))
 
+    def test_reports_first_matching_regexp(self):
+        fut = self._make_one('Subject:.+Time', 'Subject:.+Party Time')
+        msg = {'Subject': "It's that time!  Party Time!"}
+        self.assertEqual(fut(msg),
+                         "header_regexp: headers match 'Subject:.+Time'")
+
+    def test_many_regexps(self):
+        exprs = ['Subject: (spam|ham)%d$' % i for i in range(500)]
+        fut = self._make_one(*exprs)
+        self.failUnless(len(fut._combined.matchers) > 1)
+        msg = {'Subject': 'ham345'}
+        self.assertEqual(fut(msg),
+                "header_regexp: headers match 'Subject: (spam|ham)345$'")
+        self.assertEqual(fut({'Subject': 'ham500'}), None)
+
+
+class TestRegexpSet(unittest.TestCase):
+
+    def _make_one(self, *exprs):
+        import re
+        from repoze.postoffice.filters import _RegexpSet
+        return _RegexpSet([(expr, re.compile(expr)) for expr in exprs])
+
+    def test_empty(self):
+        regexps = self._make_one()
+        self.assertEqual(regexps.matchers, [])
+        self.assertEqual(regexps.match('foo'), None)
+
+    def test_single(self):
+        regexps = self._make_one('fo+')
+        self.assertEqual(len(regexps.matchers), 1)
+        self.assertEqual(regexps.match('foo'), 'fo+')
+        self.assertEqual(regexps.match('bar'), None)
+
+    def test_combined(self):
+        regexps = self._make_one('a(?P<x>b)', 'c', 'a')
+        self.assertEqual(len(regexps.matchers), 1)
+        self.assertEqual(regexps.match('ab'), 'a(?P<x>b)')
+        self.assertEqual(regexps.match('ac'), 'a')
+        self.assertEqual(regexps.match('cc'), 'c')
+        self.assertEqual(regexps.match('bc'), None)
+
+    def test_chunked_by_group_limit(self):
+        regexps = self._make_one(*['(a)(b)%d$' % i for i in range(100)])
+        self.assertEqual(len(regexps.matchers), 4)
+        self.assertEqual(regexps.match('ab99'), '(a)(b)99$')
+        self.assertEqual(regexps.match('ab0'), '(a)(b)0$')
+
+    def test_backreference_not_combined(self):
+        regexps = self._make_one('x', '(a)\\1', '(?P<b>b)(?P=b)', 'y')
+        self.assertEqual(len(regexps.matchers), 4)
+        self.assertEqual(regexps.match('aa'), '(a)\\1')
+        self.assertEqual(regexps.match('ab'), None)
+        self.assertEqual(regexps.match('bb'), '(?P<b>b)(?P=b)')
+        self.assertEqual(regexps.match('y'), 'y')
+
+    def test_global_flags_not_combined(self):
+        regexps = self._make_one('(?i)abc', 'def')
+        self.assertEqual(len(regexps.matchers), 2)
+        self.assertEqual(regexps.match('ABC'), '(?i)abc')
+        self.assertEqual(regexps.match('DEF'), None)
+
+    def test_clashing_group_names(self):
+        regexps = self._make_one('(?P<x>a)', '(?P<x>b)')
+        self.assertEqual(len(regexps.matchers), 2)
+        self.assertEqual(regexps.match('b'), '(?P<x>b)')
+
 
 class TestHeaderRegexpFileFilter(unittest.TestCase):
 
@@ -280,9 +385,9 @@ class TestHeaderRegexpFileFilter(unittest.TestCase):
 
 class TestBodyRegexpFilter(unittest.TestCase):
 
-    def _make_one(self, *exprs):
+    def _make_one(self, *exprs, **kw):
         from repoze.postoffice.filters import BodyRegexpFilter as cut
-        return cut(*exprs)
+        return cut(*exprs, **kw)
 
     def test_matches(self):
         from email.message import Message
@@ -308,6 +413,94 @@ class TestBodyRegexpFilter(unittest.TestCase):
         self.assertEqual(fut(msg),
                          "body_regexp: body matches '^Subject: Auto-Response'")
 
+    def test_reports_earliest_match(self):
+        from email.message import Message
+        msg = Message()
+        msg.set_payload("I am full of happy babies.  All days for Me!")
+        fut = self._make_one('days', 'happy')
+        self.assertEqual(fut(msg), "body_regexp: body matches 'happy'")
+
+    def test_max_bytes(self):
+        from email.message import Message
+        msg = Message()
+        msg.set_payload("I am full of happy babies.  All days for Me!")
+        fut = self._make_one('happy.+days', max_bytes=20)
+        self.assertEqual(fut(msg), None)
+        fut = self._make_one('happy', max_bytes=20)
+        self.assertEqual(fut(msg), "body_regexp: body matches 'happy'")
+
+    def test_max_bytes_splits_multibyte_character(self):
+        from email.mime.text import MIMEText
+        body = u'Caf\xe9 society'.encode('UTF-8')
+        msg = MIMEText(body, 'plain', 'UTF-8')
+        fut = self._make_one(u'Caf\xe9$', max_bytes=5)
+        self.assertEqual(fut(msg),
+                         "body_regexp: body matches u'Caf\\xe9$'")
+        fut = self._make_one(u'Caf$', max_bytes=4)
+        self.assertEqual(fut(msg), "body_regexp: body matches u'Caf$'")
+
+    def test_bad_keyword_argument(self):
+        self.assertRaises(TypeError, self._make_one, 'foo', nonesuch=True)
+
+
+class Test_payload_head(unittest.TestCase):
+
+    def _call_fut(self, part, max_bytes):
+        from repoze.postoffice.filters import _payload_head
+        return _payload_head(part, max_bytes)
+
+    def _make_part(self, body, encoding):
+        from email.mime.text import MIMEText
+        part = MIMEText('')
+        del part['Content-Transfer-Encoding']
+        part['Content-Transfer-Encoding'] = encoding
+        part.set_payload(body)
+        return part
+
+    def test_no_limit(self):
+        import base64
+        part = self._make_part(base64.encodestring('x' * 1000), 'base64')
+        self.assertEqual(self._call_fut(part, None), ('x' * 1000, False))
+
+    def test_base64_decodes_only_head(self):
+        import base64
+        import binascii
+        from repoze.postoffice import filters
+        body = ''.join([chr(i % 256) for i in xrange(10000)])
+        encoded = base64.encodestring(body)
+        part = self._make_part(encoded, 'base64')
+        decoded = []
+        def decode(text):
+            decoded.append(len(text))
+            return binascii.a2b_base64(text)
+        filters._TRANSFER_DECODERS['base64'] = decode
+        try:
+            self.assertEqual(self._call_fut(part, 100), (body[:100], True))
+        finally:
+            filters._TRANSFER_DECODERS['base64'] = binascii.a2b_base64
+        self.assertEqual(decoded, [154])  # Two whole lines
+
+    def test_quoted_printable_decodes_only_head(self):
+        import quopri
+        body = ('Caf\xe9 society, ' * 1000).replace(', ', '\n')
+        part = self._make_part(quopri.encodestring(body), 'quoted-printable')
+        self.assertEqual(self._call_fut(part, 100), (body[:100], True))
+
+    def test_short_encoded_payload(self):
+        import base64
+        part = self._make_part(base64.encodestring('short'), 'base64')
+        self.assertEqual(self._call_fut(part, 100), ('short', False))
+
+    def test_encoded_payload_without_line_breaks(self):
+        import base64
+        body = 'x' * 1000
+        part = self._make_part(base64.b64encode(body), 'base64')
+        self.assertEqual(self._call_fut(part, 100), ('x' * 100, True))
+
+    def test_unencoded(self):
+        part = self._make_part('x' * 1000, '8bit')
+        self.assertEqual(self._call_fut(part, 100), ('x' * 100, True))
+        self.assertEqual(self._call_fut(part, 1000), ('x' * 1000, False))
 
 class TestBodyRegexpFileFilter(unittest.TestCase):
 
@@ -476,3 +669,12 @@ class TestBodyRegexpFileFilter(unittest.TestCase):
         msg.set_payload("Have puppies for lunch!")
         self.assertEqual(fut(msg),
                 "body_regexp: body matches u' (kitties|corndogs|puppies) '")
+
+    def test_max_bytes(self):
+        from email.message import Message
+        from repoze.postoffice.filters import BodyRegexpFileFilter as cut
+        fut = cut(self.path, max_bytes=20)
+        self.assertEqual(fut.max_bytes, 20)
+        msg = Message()
+        msg.set_payload("I am full of happy babies.  All days for Me!")
+        self.assertEqual(fut(msg), None)
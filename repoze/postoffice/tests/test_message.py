@@ -1,3 +1,5 @@
+from __future__ import with_statement
+
 import unittest
 
 class TestMessage(unittest.TestCase):
@@ -96,3 +98,315 @@ class TestMIMEMultipPart(TestMessage):
         from repoze.postoffice.message import MIMEMultipart as target
         return target
 
+
+class TestLazyMaildirMessage(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.repoze.postoffice.tests')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def _write(self, text):
+        import os
+        path = os.path.join(self.tmp, 'message')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def _make_one(self, text=None):
+        from repoze.postoffice.message import LazyMaildirMessage
+        if text is None:
+            text = _SIMPLE
+        with open(self._write(text)) as fp:
+            return LazyMaildirMessage(fp)
+
+    def test_headers_without_body(self):
+        import os
+        message = self._make_one()
+        self.failIf(message.is_body_loaded())
+        os.remove(os.path.join(self.tmp, 'message'))
+        self.assertEqual(message['From'], 'Harry <harry@example.com>')
+        self.assertEqual(message['Subject'], 'Hi there')
+        self.assertEqual(message.get_content_type(), 'text/plain')
+        self.failIf(message.is_body_loaded())
+
+    def test_body_loaded_on_demand(self):
+        message = self._make_one()
+        self.assertEqual(message.get_payload(), 'Hello.\nFrom Harry.\n')
+        self.failUnless(message.is_body_loaded())
+
+    def test_body_loaded_keeps_changed_headers(self):
+        message = self._make_one()
+        message['X-Postoffice-Date'] = '12345'
+        del message['Subject']
+        text = message.as_string()
+        self.failUnless('X-Postoffice-Date: 12345\n' in text, text)
+        self.failIf('Subject' in text, text)
+        # as_string mangles From lines in the body
+        self.failUnless(text.endswith('\n\nHello.\n>From Harry.\n'), text)
+
+    def test_set_payload_before_load(self):
+        import os
+        message = self._make_one()
+        os.remove(os.path.join(self.tmp, 'message'))
+        message.set_payload('Discarded.')
+        self.failUnless(message.is_body_loaded())
+        self.assertEqual(message.get_payload(), 'Discarded.')
+
+    def test_multipart(self):
+        message = self._make_one(_MULTIPART)
+        self.failUnless(message.is_multipart())
+        self.assertEqual(message.preamble, 'Preamble.')
+        self.assertEqual([part.get_payload() for part in message.walk()][1:],
+                         ['Part one.', 'Part two.'])
+
+    def test_headers_only(self):
+        message = self._make_one('From: harry@example.com\n')
+        self.assertEqual(message['From'], 'harry@example.com')
+        self.assertEqual(message.get_payload(), '')
+
+    def test_not_from_file(self):
+        from repoze.postoffice.message import LazyMaildirMessage
+        message = LazyMaildirMessage(_SIMPLE)
+        self.failUnless(message.is_body_loaded())
+        self.assertEqual(message['From'], 'Harry <harry@example.com>')
+        self.assertEqual(message.get_payload(), 'Hello.\nFrom Harry.\n')
+        message = LazyMaildirMessage()
+        self.assertEqual(message.get_payload(), None)
+
+    def test_from_maildir(self):
+        from mailbox import Maildir
+        from repoze.postoffice.message import LazyMaildirMessage
+        maildir = Maildir(self.tmp + '/Maildir', factory=LazyMaildirMessage)
+        key = maildir.add(_MULTIPART)
+        message = maildir.get_message(key)
+        self.failIf(message.is_body_loaded())
+        self.assertEqual(message.get_subdir(), 'new')
+        folder = maildir.add_folder('archive')
+        archived = folder.get_message(folder.add(message))
+        self.assertEqual(archived.as_string(), message.as_string())
+        self.failUnless(archived.is_multipart())
+
+class TestLazyStringMessage(unittest.TestCase):
+
+    def _make_one(self, text=None):
+        from repoze.postoffice.message import LazyStringMessage
+        if text is None:
+            text = _SIMPLE
+        return LazyStringMessage(text)
+
+    def test_headers_without_body(self):
+        message = self._make_one()
+        self.failIf(message.is_body_loaded())
+        self.assertEqual(message['Subject'], 'Hi there')
+        self.failIf(message.is_body_loaded())
+
+    def test_body_loaded_on_demand(self):
+        message = self._make_one()
+        self.assertEqual(message.get_payload(), 'Hello.\nFrom Harry.\n')
+        self.failUnless(message.is_body_loaded())
+
+    def test_write_body(self):
+        from cStringIO import StringIO
+        message = self._make_one()
+        buf = StringIO()
+        message.write_body(buf)
+        self.assertEqual(buf.getvalue(), 'Hello.\nFrom Harry.\n')
+
+    def test_write_headers(self):
+        from cStringIO import StringIO
+        message = self._make_one(
+            'From: harry@example.com\nSubject: Hi\n there\n\nHello.\n')
+        message['To'] = 'sally@example.com'
+        buf = StringIO()
+        message.write_headers(buf)
+        message.write_body(buf)
+        self.assertEqual(buf.getvalue(),
+                         'From: harry@example.com\nSubject: Hi\n there\n'
+                         'To: sally@example.com\n\nHello.\n')
+        self.failIf(message.is_body_loaded())
+
+    def test_write_headers_header_object(self):
+        from cStringIO import StringIO
+        from email.header import Header
+        message = self._make_one()
+        del message['Subject']
+        message['Subject'] = Header(u'Caf\xe9', 'UTF-8')
+        buf = StringIO()
+        message.write_headers(buf)
+        self.failUnless('Subject: =?utf-8?b?Q2Fmw6k=?=\n' in buf.getvalue(),
+                        buf.getvalue())
+
+    def test_no_text(self):
+        from repoze.postoffice.message import LazyStringMessage
+        message = LazyStringMessage()
+        self.failUnless(message.is_body_loaded())
+        self.assertEqual(message.get_payload(), None)
+
+class TestLazyBlobMessage(unittest.TestCase):
+
+    def _make_blob(self, text):
+        from ZODB.blob import Blob
+        blob = Blob()
+        with blob.open('w') as f:
+            f.write(text)
+        return blob
+
+    def _make_one(self, text=None):
+        from repoze.postoffice.message import LazyBlobMessage
+        if text is None:
+            text = _SIMPLE
+        return LazyBlobMessage(self._make_blob(text))
+
+    def test_headers_without_body(self):
+        message = self._make_one()
+        self.failIf(message.is_body_loaded())
+        self.assertEqual(message['Subject'], u'Hi there')
+        self.failIf(message.is_body_loaded())
+
+    def test_decodes_headers(self):
+        message = self._make_one(
+            'Subject: =?utf-8?q?Caf=C3=A9?=\n\nHello.\n')
+        self.assertEqual(message['Subject'], u'Caf\xe9')
+
+    def test_body_loaded_on_demand(self):
+        message = self._make_one()
+        self.assertEqual(message.get_payload(), 'Hello.\nFrom Harry.\n')
+        self.failUnless(message.is_body_loaded())
+
+    def test_multipart_parts_decode_headers(self):
+        from repoze.postoffice.message import Message
+        message = self._make_one(_MULTIPART)
+        parts = message.get_payload()
+        self.assertEqual(message.preamble, 'Preamble.')
+        self.failUnless(isinstance(parts[0], Message))
+
+    def test_open_body(self):
+        message = self._make_one()
+        fp = message.open_body()
+        try:
+            self.assertEqual(fp.read(), 'Hello.\nFrom Harry.\n')
+        finally:
+            fp.close()
+        self.failIf(message.is_body_loaded())
+
+    def test_release(self):
+        message = self._make_one(_MULTIPART)
+        self.failUnless(message.is_multipart())
+        message.release()
+        self.failIf(message.is_body_loaded())
+        self.assertEqual(message.preamble, None)
+        self.assertEqual(len(message.get_payload()), 2)
+
+    def test_release_without_source(self):
+        from repoze.postoffice.message import LazyBlobMessage
+        message = LazyBlobMessage()
+        message.set_payload('Hello.')
+        message.release()
+        self.assertEqual(message.get_payload(), 'Hello.')
+
+    def test_open_body_without_source(self):
+        from repoze.postoffice.message import LazyBlobMessage
+        message = LazyBlobMessage()
+        self.assertRaises(AssertionError, message.open_body)
+
+    def test_detach(self):
+        import os
+        blob = self._make_blob(_SIMPLE)
+        from repoze.postoffice.message import LazyBlobMessage
+        message = LazyBlobMessage(blob)
+        message.detach()
+        self.failIf(message._source is blob)
+        self.failIf(message.is_body_loaded())
+        path = message._source.file.name
+        with blob.open('w') as f:
+            f.write('Subject: Changed\n\nGone.\n')
+        self.assertEqual(message.get_payload(), 'Hello.\nFrom Harry.\n')
+        del message
+        self.failIf(os.path.exists(path))
+
+class TestNoticeTemplate(unittest.TestCase):
+
+    def _make_one(self, text, fields=None, headers=()):
+        from repoze.postoffice.message import NoticeTemplate
+        return NoticeTemplate(text, fields, headers)
+
+    def test_render(self):
+        import base64
+        template = self._make_one(
+            u"Subject: Hello {name}\n"
+            u"X-Static: Caf\xe9\n"
+            u"\n"
+            u"Dear {name},\n{{not a field}}\n",
+            headers=[('X-Extra', 'Yes')])
+        message = template.render(u'Me <me@example.com>',
+                                  u'Ren\xe8 <rene@example.com>',
+                                  {'name': u'Ren\xe8'})
+        self.assertEqual(message['Subject'], u'Hello Ren\xe8')
+        self.assertEqual(message['X-Static'], u'Caf\xe9')
+        self.assertEqual(message['From'], u'Me <me@example.com>')
+        self.assertEqual(message['To'], u'Ren\xe8 <rene@example.com>')
+        self.assertEqual(message['X-Extra'], 'Yes')
+        self.assertEqual(message['Content-Transfer-Encoding'], 'base64')
+        self.assertEqual(message.get_content_charset(), 'utf-8')
+        self.assertEqual(base64.b64decode(message.get_payload()),
+                         'Dear Ren\xc3\xa8,\n{not a field}\n')
+
+    def test_static_headers_encoded_once(self):
+        template = self._make_one(u"Subject: Caf\xe9\nX-Name: {name}\n\n")
+        (subject, encoded, parts), (name, no_encoded, name_parts) = \
+            template._headers
+        self.assertEqual(subject, 'Subject')
+        self.failIf(encoded is None)
+        self.assertEqual(parts, None)
+        self.assertEqual(no_encoded, None)
+
+    def test_str_field_decoded(self):
+        import base64
+        template = self._make_one(u"\n{reason}")
+        message = template.render('me', 'you', {'reason': 'Caf\xc3\xa9'})
+        self.assertEqual(base64.b64decode(message.get_payload()),
+                         'Caf\xc3\xa9')
+
+    def test_header_continuation(self):
+        template = self._make_one(u"Subject: Very\n long\n\nBody")
+        message = template.render('me', 'you', {})
+        self.assertEqual(message['Subject'].replace('\n', ''), 'Very long')
+
+    def test_unknown_field(self):
+        self.assertRaises(ValueError, self._make_one,
+                          u"Subject: {name}\n\n{other}", ('name',))
+
+    def test_no_blank_line(self):
+        self.assertRaises(ValueError, self._make_one, u"Subject: Hello")
+
+    def test_malformed_header(self):
+        self.assertRaises(ValueError, self._make_one, u"Hello there\n\n")
+
+_SIMPLE = """\
+From: Harry <harry@example.com>
+To: Sally <sally@example.com>
+Subject: Hi there
+
+Hello.
+From Harry.
+"""
+
+_MULTIPART = """\
+From: Harry <harry@example.com>
+Content-Type: multipart/mixed; boundary="XXX"
+
+Preamble.
+--XXX
+Content-Type: text/plain
+
+Part one.
+--XXX
+Content-Type: text/plain
+
+Part two.
+--XXX--
+"""
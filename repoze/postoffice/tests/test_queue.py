@@ -1,6 +1,9 @@
+from __future__ import with_statement
+
 import unittest
 
-class TestQueue(unittest.TestCase):
+class _QueueTests(object):
+    # Tests which apply to every kind of queue
     def setUp(self):
         from repoze.postoffice import queue
         self._save_datetime = queue.datetime
@@ -11,10 +14,6 @@ class TestQueue(unittest.TestCase):
         from repoze.postoffice import queue
         queue.datetime = self._save_datetime
 
-    def _make_one(self):
-        from repoze.postoffice.queue import Queue
-        return Queue()
-
     def _set_now(self, now):
         self._dummy_datetime._now = now
 
@@ -25,63 +24,49 @@ class TestQueue(unittest.TestCase):
         self.failUnless(queue)
         queue.add(DummyMessage('two'))
         self.assertEqual(len(queue), 2)
-        self.assertEqual(queue.pop_next(), 'one')
+        self.assertEqual(queue.pop_next().get_payload(), 'one')
         self.assertEqual(len(queue), 1)
-        self.assertEqual(queue.pop_next(), 'two')
+        self.assertEqual(queue.pop_next().get_payload(), 'two')
         self.assertEqual(len(queue), 0)
         self.failIf(queue)
 
-    def test_is_duplicate_false(self):
+    def test_pop_many(self):
         queue = self._make_one()
-        message = DummyMessage('one')
-        self.failIf(queue.is_duplicate(message))
+        for body in ('one', 'two', 'three'):
+            queue.add(DummyMessage(body))
+        popped = queue.pop_many(2)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(_payloads(popped), ['one', 'two'])
+        self.assertEqual(_payloads(queue.pop_many(5)), ['three'])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(_payloads(queue.pop_many(5)), [])
 
-    def test_is_duplicate_bbb_persistence(self):
+    def test_pop_next_empty(self):
         queue = self._make_one()
-        del queue._message_ids
-        message = DummyMessage('one')
-        self.failIf(queue.is_duplicate(message))
+        self.assertRaises(StopIteration, queue.pop_next)
 
-    def test_is_duplicate_true(self):
+    def test_repartition(self):
         queue = self._make_one()
-        message = DummyMessage('one')
-        queue.add(message)
-        self.failUnless(queue.is_duplicate(message))
+        bodies = [str(i) for i in xrange(10)]
+        for body in bodies:
+            queue.add(DummyMessage(body))
+        queue.repartition(4)
+        self.assertEqual(queue.count_partitions(), 4)
+        self.assertEqual(len(queue), 10)
+        queue.repartition(4)
+        self.assertEqual(_payloads(queue.pop_many(10)), bodies)
 
-    def test_is_duplicate_wo_o_orig_to_in_message_ids_entry(self):
-        import time
+    def test_is_duplicate_false(self):
         queue = self._make_one()
         message = DummyMessage('one')
-        timestamp = time.time()
-        queue._message_ids[message['Message-Id']] = timestamp
         self.failIf(queue.is_duplicate(message))
 
-    def test_is_duplicate_same_message_id_same_x_orig_to(self):
-        import time
+    def test_is_duplicate_true(self):
         queue = self._make_one()
         message = DummyMessage('one')
-        timestamp = time.time()
-        queue._message_ids[message['Message-Id']] = (timestamp,
-                                                     'phred@example.com')
+        queue.add(message)
         self.failUnless(queue.is_duplicate(message))
 
-    def test_is_duplicate_same_message_id_different_x_orig_to(self):
-        import time
-        queue = self._make_one()
-        message = DummyMessage('one')
-        timestamp = time.time()
-        queue._message_ids[message['Message-Id']] = (timestamp,
-                                                     'bharney@example.com')
-        self.failIf(queue.is_duplicate(message))
-
-    def test_is_duplicate_past_cutoff(self):
-        import time
-        queue = self._make_one()
-        message = DummyMessage('one')
-        timestamp = time.time() - 30 * 60 * 60
-        queue._message_ids[message['Message-Id']] = (timestamp, None)
-        self.failIf(queue.is_duplicate(message))
-
     def test_bounce_generic_message(self):
         import base64
         from repoze.postoffice.message import Message
@@ -112,6 +97,169 @@ class TestQueue(unittest.TestCase):
         self.failUnless('has bounced' in body, body)
         self.failUnless('Last Tuesday' in body, body)
 
+    def _bounce(self, queue, sender='Chris Rossi <chris@example.com>',
+                **kw):
+        from repoze.postoffice.message import Message
+        bounced = Message()
+        bounced['To'] = 'Submissions <submissions@example.com>'
+        bounced['From'] = sender
+        sent = []
+        result = queue.bounce(bounced, lambda *args: sent.append(args),
+                              'Bouncer <bouncer@example.com>', **kw)
+        return result, sent
+
+    def test_bounce_unlimited(self):
+        queue = self._make_one()
+        for i in xrange(5):
+            self.assertEqual(self._bounce(queue)[0], True)
+        self.assertEqual(queue.get_bounce_limit(), (None, 3600, False))
+        self.assertEqual(queue.count_suppressed_bounces(), 0)
+
+    def test_bounce_limit(self):
+        from datetime import datetime
+        from datetime import timedelta
+        queue = self._make_one()
+        queue.set_bounce_limit(2, 600)
+        self.assertEqual(queue.get_bounce_limit(), (2, 600, False))
+        now = datetime(2010, 5, 12, 2, 42)
+        self._set_now(now)
+        self.assertEqual(self._bounce(queue)[0], True)
+        self.assertEqual(self._bounce(queue)[0], True)
+        result, sent = self._bounce(queue)
+        self.assertEqual(result, False)
+        self.assertEqual(sent, [])
+        self.assertEqual(queue.count_suppressed_bounces(), 1)
+        self.assertEqual(self._bounce(queue, 'other@example.com')[0], True)
+        self.assertEqual(queue.get_throttles(now), [
+            ('Chris Rossi <chris@example.com>', {'X-Postoffice': 'Bounced'},
+             now + timedelta(seconds=600))])
+        # Bounces aren't messages from the user
+        self.assertEqual(queue.get_average_frequency(
+            'Chris Rossi <chris@example.com>', now, timedelta(minutes=10)),
+            0.0)
+        self.assertEqual(queue.get_instantaneous_frequency(
+            'Chris Rossi <chris@example.com>', now), 0.0)
+
+        self._set_now(now + timedelta(seconds=601))
+        self.assertEqual(self._bounce(queue)[0], True)
+        self.assertEqual(queue.count_suppressed_bounces(), 1)
+
+    def test_bounce_limit_digest(self):
+        import base64
+        from datetime import datetime
+        from datetime import timedelta
+        queue = self._make_one()
+        queue.set_bounce_limit(1, 600, digest=True)
+        now = datetime(2010, 5, 12, 2, 42)
+        self._set_now(now)
+        self._bounce(queue, bounce_reason=u'Too big.')
+        self._bounce(queue, bounce_reason=u'Too big.')
+        self._set_now(now + timedelta(seconds=60))
+        self._bounce(queue, bounce_reason=u'Too small.')
+        self._bounce(queue, bounce_reason=u'Too big.')
+        self.assertEqual(queue.count_suppressed_bounces(), 3)
+        sent = []
+        send = lambda *args: sent.append(args)
+        self.assertEqual(queue.send_bounce_digests(send), 0)
+        self.assertEqual(sent, [])
+
+        self.assertEqual(queue.send_bounce_digests(
+            send, now + timedelta(seconds=601)), 1)
+        fromaddr, toaddrs, digest = sent[0]
+        self.assertEqual(fromaddr, 'Bouncer <bouncer@example.com>')
+        self.assertEqual(toaddrs, ['Chris Rossi <chris@example.com>'])
+        self.assertEqual(digest['To'], 'Chris Rossi <chris@example.com>')
+        self.assertEqual(digest['X-Postoffice'], 'Bounced')
+        self.assertEqual(digest['Subject'],
+                         '3 of your messages have bounced.')
+        body = base64.b64decode(digest.get_payload())
+        self.failUnless('\tToo big.\n\tToo small.\n' in body, body)
+        self.assertEqual(queue.send_bounce_digests(
+            send, now + timedelta(seconds=601)), 0)
+
+    def test_bounce_limit_digest_custom_message(self):
+        from datetime import timedelta
+        from repoze.postoffice.message import Message
+        queue = self._make_one()
+        queue.set_bounce_limit(1, digest=True)
+        bounce_message = Message()
+        bounce_message['Subject'] = 'Go away.'
+        self._bounce(queue)
+        self._bounce(queue, bounce_message=bounce_message)
+        digest = queue._bounce_digests['Chris Rossi <chris@example.com>']
+        self.assertEqual(digest.reasons, ('Go away.',))
+
+    def test_bounce_notice_template(self):
+        import base64
+        queue = self._make_one()
+        text = (u"Subject: Undeliverable: {to}\n"
+                u"\n"
+                u"Nope: {reason}\n")
+        queue.set_notice_template('bounce', text)
+        self.assertEqual(queue.get_notice_template('bounce'), text)
+        result, sent = self._bounce(queue, bounce_reason=u'Caf\xe9')
+        fromaddr, toaddrs, notice = sent[0]
+        self.assertEqual(
+            notice['Subject'],
+            'Undeliverable: Submissions <submissions@example.com>')
+        self.assertEqual(notice['X-Postoffice'], 'Bounced')
+        self.assertEqual(base64.b64decode(notice.get_payload()),
+                         'Nope: Caf\xc3\xa9\n')
+
+        queue.set_notice_template('bounce', None)
+        self.assertEqual(queue.get_notice_template('bounce'), None)
+        result, sent = self._bounce(queue)
+        fromaddr, toaddrs, notice = sent[0]
+        self.failUnless(notice['Subject'].startswith('Your message to'))
+
+    def test_notice_template_prepared_once(self):
+        queue = self._make_one()
+        queue.set_notice_template('bounce', u"Subject: One\n\n{reason}\n")
+        self.assertEqual(queue._notice_templates,
+                         {'bounce': u"Subject: One\n\n{reason}\n"})
+        template = queue._get_notice_template('bounce')
+        self.failUnless(queue._get_notice_template('bounce') is template)
+        queue.set_notice_template('bounce', u"Subject: Two\n\n{reason}\n")
+        template = queue._get_notice_template('bounce')
+        self.assertEqual(template.text, u"Subject: Two\n\n{reason}\n")
+        del queue._v_notice_templates
+        self.assertEqual(queue._get_notice_template('bounce').text,
+                         u"Subject: Two\n\n{reason}\n")
+
+    def test_bad_notice_template(self):
+        queue = self._make_one()
+        self.assertRaises(ValueError, queue.set_notice_template, 'bounce',
+                          u"Subject: Oops\n\n{count}\n")
+        self.assertRaises(ValueError, queue.set_notice_template, 'oops',
+                          u"Subject: Oops\n\n")
+        self.assertEqual(queue.get_notice_template('bounce'), None)
+
+    def test_quarantine_notice_template(self):
+        import base64
+        from repoze.postoffice.message import Message
+        message = Message()
+        message['To'] = 'Submissions <submissions@example.com>'
+        message['From'] = 'Chris Rossi <chris@example.com>'
+        queue = self._make_one()
+        queue.set_notice_template('quarantine_notice',
+                                  u"Subject: Oops\n\nSent to {to}.\n")
+        sent = []
+        queue.quarantine(message, (None, None, None),
+                         lambda *args: sent.append(args),
+                         'Oopsy Daisy <error@example.com>')
+        fromaddr, toaddrs, notice = sent[0]
+        self.assertEqual(notice['Subject'], 'Oops')
+        self.assertEqual(base64.b64decode(notice.get_payload()),
+                         'Sent to Submissions <submissions@example.com>.\n')
+
+    def test_bounce_limit_too_low(self):
+        queue = self._make_one()
+        self.assertRaises(ValueError, queue.set_bounce_limit, 0)
+
+    def test_send_bounce_digests_none(self):
+        queue = self._make_one()
+        self.assertEqual(queue.send_bounce_digests(None), 0)
+
     def test_bounce_reason_and_bounce_message(self):
         queue = self._make_one()
         self.assertRaises(ValueError, queue.bounce, None, None, 'x@y.it',
@@ -239,14 +387,13 @@ class TestQueue(unittest.TestCase):
         msgs = list(queue.get_quarantined_messages())
         self.assertEqual(len(msgs), 2)
         msg, error = msgs.pop(0)
-        self.assertEqual(msg, 'Oh nos!')
+        self.assertEqual(msg.get_payload(), 'Oh nos!')
         self.assertEqual(error, ('OMG', 'WTH', '???'))
         msg, error = msgs.pop(0)
-        self.assertEqual(msg, 'Woopsy!')
+        self.assertEqual(msg.get_payload(), 'Woopsy!')
         self.assertEqual(error, ('IRCC', 'FWIW', 'ROTFLMAO'))
-        self.assertEqual(
-            queue.get_quarantined_message(msg['X-Postoffice-Id']), msg
-        )
+        quarantined = queue.get_quarantined_message(msg['X-Postoffice-Id'])
+        self.assertEqual(quarantined.get_payload(), msg.get_payload())
 
     def test_quarantine_notice_missing_fromaddr(self):
         queue = self._make_one()
@@ -280,6 +427,24 @@ class TestQueue(unittest.TestCase):
         body = base64.b64decode(notice.get_payload())
         self.failUnless('System administrators have been informed' in body)
 
+    def test_quarantine_notice_to_outbox(self):
+        from repoze.postoffice.message import Message
+        message = Message()
+        message['To'] = 'Submissions <submissions@example.com>'
+        message['From'] = 'Chris Rossi <chris@example.com>'
+        queue = self._make_one()
+        outbox = queue.get_outbox()
+        self.failUnless(queue.get_outbox() is outbox)
+        queue.quarantine(message, (None, None, None), outbox.send,
+                         'Oopsy Daisy <error@example.com>')
+        self.assertEqual(len(outbox), 1)
+        sent = []
+        outbox.drain(lambda *args: sent.append(args))
+        self.assertEqual(len(outbox), 0)
+        fromaddr, toaddrs, notice = sent[0]
+        self.assertEqual(fromaddr, 'Oopsy Daisy <error@example.com>')
+        self.assertEqual(toaddrs, ['Chris Rossi <chris@example.com>'])
+        self.failUnless(notice['Subject'].startswith('An error has occurred'))
 
     def test_quarantine_notice_unicode_sender(self):
         import base64
@@ -337,6 +502,86 @@ class TestQueue(unittest.TestCase):
         self.failUnless('System administrators have been informed' in body)
         self.failUnless('Last Tuesday' in body)
 
+    def _quarantine_for_find(self, queue):
+        from datetime import datetime
+        for body, sender, error, day in (
+                ('one', 'Harry <harry@example.com>',
+                 (KeyError, KeyError(), None), 1),
+                ('two', 'sally@example.com',
+                 (ValueError, ValueError(), None), 2),
+                ('three', 'HARRY@example.com', ('OMG', 'WTH', '???'), 3),
+                ('four', 'Harry <harry@example.com>',
+                 (KeyError, KeyError(), None), 4)):
+            message = DummyMessage(body)
+            message.replace_header('From', sender)
+            message['Subject'] = body.title()
+            self._set_now(datetime(2010, 5, day, 12, 0))
+            queue.quarantine(message, error)
+
+    def test_find_quarantined_messages(self):
+        from datetime import datetime
+        queue = self._make_one()
+        self._quarantine_for_find(queue)
+        def subjects(**kw):
+            return [summary['subject']
+                    for id, summary in queue.find_quarantined_messages(**kw)]
+        self.assertEqual(subjects(), ['One', 'Two', 'Three', 'Four'])
+        self.assertEqual(subjects(error_type='KeyError'), ['One', 'Four'])
+        self.assertEqual(subjects(error_type='OMG'), ['Three'])
+        self.assertEqual(subjects(error_type='IndexError'), [])
+        self.assertEqual(subjects(sender='harry@example.com'),
+                         ['One', 'Three', 'Four'])
+        self.assertEqual(subjects(sender='Sally <Sally@Example.com>'),
+                         ['Two'])
+        self.assertEqual(subjects(since=datetime(2010, 5, 2, 12, 0)),
+                         ['Two', 'Three', 'Four'])
+        self.assertEqual(subjects(until=datetime(2010, 5, 2, 12, 0)),
+                         ['One'])
+        self.assertEqual(subjects(since=datetime(2010, 5, 2),
+                                  until=datetime(2010, 5, 4)),
+                         ['Two', 'Three'])
+        self.assertEqual(subjects(error_type='KeyError',
+                                  sender='harry@example.com',
+                                  since=datetime(2010, 5, 2)), ['Four'])
+
+    def test_find_quarantined_messages_summary(self):
+        from datetime import datetime
+        queue = self._make_one()
+        self._quarantine_for_find(queue)
+        (id, summary), = queue.find_quarantined_messages(
+            sender='sally@example.com')
+        self.assertEqual(summary, {
+            'from': 'sally@example.com',
+            'to': None,
+            'subject': 'Two',
+            'date': None,
+            'message_id': '12345',
+            'error_type': 'ValueError',
+            'quarantined': datetime(2010, 5, 2, 12, 0),
+        })
+        message = queue.get_quarantined_message(id)
+        self.assertEqual(message.get_payload(), 'two')
+
+    def test_find_quarantined_messages_after_removal(self):
+        queue = self._make_one()
+        self._quarantine_for_find(queue)
+        for id, summary in queue.find_quarantined_messages(
+                error_type='KeyError'):
+            queue.remove_from_quarantine(queue.get_quarantined_message(id))
+        self.assertEqual(queue.find_quarantined_messages(
+            error_type='KeyError'), [])
+        self.assertEqual(len(queue.find_quarantined_messages()), 2)
+        self.assertEqual(queue.count_quarantined_errors(),
+                         {'ValueError': 1, 'OMG': 1})
+
+    def test_count_quarantined_errors(self):
+        queue = self._make_one()
+        self.assertEqual(queue.count_quarantined_errors(), {})
+        self._quarantine_for_find(queue)
+        queue.quarantine(DummyMessage('five'), (None, None, None))
+        self.assertEqual(queue.count_quarantined_errors(),
+                         {'KeyError': 2, 'ValueError': 1, 'OMG': 1})
+
     def test_remove_from_quarantine(self):
         msg = DummyMessage('Oops, my bad.')
         queue = self._make_one()
@@ -349,10 +594,10 @@ class TestQueue(unittest.TestCase):
         msgs = list(queue.get_quarantined_messages())
         self.assertEqual(len(msgs), 2)
         msg, error = msgs.pop(0)
-        self.assertEqual(msg, 'Oh nos!')
+        self.assertEqual(msg.get_payload(), 'Oh nos!')
         self.assertEqual(error, ('OMG', 'WTH', '???'))
         msg, error = msgs.pop(0)
-        self.assertEqual(msg, 'Woopsy!')
+        self.assertEqual(msg.get_payload(), 'Woopsy!')
         self.assertEqual(error, ('IRCC', 'FWIW', 'ROTFLMAO'))
 
     def test_remove_from_quarantine_not_in_quarantine(self):
@@ -489,6 +734,1360 @@ class TestQueue(unittest.TestCase):
         now += timedelta(minutes=6)
         self.failIf(queue.is_throttled(user, now, headers))
 
+    def test_is_throttled_leaves_expired_throttle(self):
+        from datetime import datetime
+        from datetime import timedelta
+        queue = self._make_one()
+        now = datetime(2010, 5, 12, 2, 42)
+        queue.throttle('Harry', now - timedelta(minutes=5))
+        self.failIf(queue.is_throttled('Harry', now))
+        # Expired throttles are only removed by compact
+        self.assertEqual(len(queue._throttles), 1)
+        self.assertEqual(queue.compact(now)[0]['throttles'], 1)
+        self.assertEqual(len(queue._throttles), 0)
+
+    def test_compact(self):
+        from datetime import datetime
+        from datetime import timedelta
+        queue = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        for user, minutes in (('Harry', 0), ('Sally', 30), ('Marie', 120)):
+            message = DummyMessage(user)
+            message.replace_header('From', user)
+            self._set_now(now - timedelta(minutes=minutes))
+            queue.collect_frequency_data(message, window=60)
+        queue.throttle('Jess', now + timedelta(minutes=5))
+        queue.throttle('Marie', now - timedelta(minutes=5))
+
+        # The expired throttle and the first sender
+        reclaimed, start = queue.compact(now, limit=2)
+        self.assertEqual(start, ('senders', 'Harry'))
+        self.assertEqual(reclaimed,
+                         {'senders': 0, 'entries': 0, 'throttles': 1,
+                          'message_ids': 0})
+        reclaimed, start = queue.compact(now, limit=2, start=start)
+        self.assertEqual(start, ('senders', 'Sally'))
+        self.assertEqual(reclaimed,
+                         {'senders': 1, 'entries': 1, 'throttles': 0,
+                          'message_ids': 0})
+        reclaimed, start = queue.compact(now, limit=2, start=start)
+        self.assertEqual(start, None)
+        self.assertEqual(reclaimed,
+                         {'senders': 0, 'entries': 0, 'throttles': 0,
+                          'message_ids': 0})
+        self.assertEqual(list(queue._freq_data.keys()), ['Harry', 'Sally'])
+        self.assertEqual(list(queue._throttles.keys()), [('Jess', ())])
+
+        reclaimed, start = queue.compact(now + timedelta(hours=2))
+        self.assertEqual(start, None)
+        self.assertEqual(reclaimed,
+                         {'senders': 2, 'entries': 2, 'throttles': 1,
+                          'message_ids': 0})
+        self.assertEqual(len(queue._freq_data), 0)
+        self.assertEqual(len(queue._throttles), 0)
+        self.assertEqual(len(queue._throttle_times), 0)
+
+    def test_compact_throttles_in_batches(self):
+        from datetime import datetime
+        from datetime import timedelta
+        queue = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        for i in xrange(5):
+            queue.throttle('user%d' % i, now - timedelta(minutes=i % 2 + 1))
+        reclaimed, start = queue.compact(now, limit=2)
+        self.assertEqual(start, ('throttles', None))
+        self.assertEqual(reclaimed['throttles'], 2)
+        reclaimed, start = queue.compact(now, limit=2, start=start)
+        self.assertEqual(start, ('throttles', None))
+        self.assertEqual(reclaimed['throttles'], 2)
+        reclaimed, start = queue.compact(now, limit=2, start=start)
+        self.assertEqual(start, None)
+        self.assertEqual(reclaimed['throttles'], 1)
+        self.assertEqual(len(queue._throttles), 0)
+        self.assertEqual(len(queue._throttle_times), 0)
+
+    def test_get_throttles(self):
+        from datetime import datetime
+        from datetime import timedelta
+        queue = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        queue.throttle('Harry', now + timedelta(minutes=5))
+        queue.throttle('Sally', now + timedelta(seconds=30), {'A': 'foo'})
+        queue.throttle('Marie', now + timedelta(seconds=10))
+        queue.throttle('Jess', now - timedelta(minutes=5))
+        # Renewing a throttle moves it
+        queue.throttle('Marie', now + timedelta(minutes=10))
+        self.assertEqual(queue.get_throttles(now), [
+            ('Sally', {'A': 'foo'}, now + timedelta(seconds=30)),
+            ('Harry', {}, now + timedelta(minutes=5)),
+            ('Marie', {}, now + timedelta(minutes=10)),
+        ])
+        now += timedelta(minutes=6)
+        self.assertEqual(queue.get_throttles(now), [
+            ('Marie', {}, now + timedelta(minutes=4)),
+        ])
+        self.assertEqual(queue.compact(now), (
+            {'senders': 0, 'entries': 0, 'throttles': 3, 'message_ids': 0},
+            None))
+        self.failUnless(queue.is_throttled('Marie', now))
+
+class TestQueue(_QueueTests, unittest.TestCase):
+
+    def _make_one(self):
+        from repoze.postoffice.queue import Queue
+        return Queue()
+
+    def test_pop_many_releases_messages(self):
+        queue = self._make_one()
+        queue.add(DummyMessage('one'))
+        (key, queued), = queue._partitions[0].items()
+        self.assertEqual(list(queue.pop_many(1)), ['one'])
+        self.assertEqual(queued._v_message, None)
+
+    def test_pop_many_takes_messages_lazily(self):
+        queue = self._make_one()
+        for body in ('one', 'two'):
+            queue.add(DummyMessage(body))
+        first, second = [queued for key, queued in
+                         queue._partitions[0].items()]
+        popped = queue.pop_many(2)
+        self.assertEqual(len(queue), 0)
+        self.failIf(first._v_message is None)
+        self.assertEqual(popped.next(), 'one')
+        self.assertEqual(first._v_message, None)
+        self.failIf(second._v_message is None)
+        self.assertEqual(popped.next(), 'two')
+        self.assertEqual(second._v_message, None)
+
+    def test_pop_many_changes_count_once(self):
+        from repoze.postoffice.queue import Queue
+        queue = Queue(partitions=2)
+        for body in ('one', 'two', 'three'):
+            queue.add(DummyMessage(body))
+        changes = []
+        count = queue._message_count
+        queue._message_count = DummyLength(count(), changes)
+        self.assertEqual(len(list(queue.pop_many(3))), 3)
+        self.assertEqual(changes, [-3])
+        self.assertEqual(len(queue), 0)
+
+    def test_popped_messages_outlive_connection(self):
+        # Popped messages don't read from the blobs of removed wrappers, which
+        # may be gone once the transaction is committed and the database
+        # packed.
+        import os
+        import shutil
+        import tempfile
+        import time
+        import weakref
+        import transaction
+        from ZODB.blob import Blob
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        tmp = tempfile.mkdtemp('.repoze.postoffice.tests')
+        db = DB(FileStorage(os.path.join(tmp, 'Data.fs'),
+                            blob_dir=os.path.join(tmp, 'blobs')))
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            queue = conn.root()['queue'] = self._make_one()
+            for body in ('one', 'two', 'three', 'four'):
+                queue.add(DummyMessage(body))
+            tm.commit()
+            conn.cacheMinimize()
+            conn.close()
+
+            conn = db.open(tm)
+            queue = conn.root()['queue']
+            popped = [queue.pop_next()]
+            popped.extend(queue.pop_many(2))
+            # Until the transaction is committed, the blobs are still read.
+            for message in popped:
+                self.failUnless(isinstance(message._source, Blob))
+            discarded = weakref.ref(queue.pop_next())
+            tm.commit()
+            conn.close()
+            time.sleep(0.01)
+            db.pack()
+            self.assertEqual([message.get_payload() for message in popped],
+                             ['one', 'two', 'three'])
+            self.assertEqual(discarded(), None)
+        finally:
+            db.close()
+            shutil.rmtree(tmp)
+
+    def test_keys_increase_within_millisecond(self):
+        from repoze.postoffice import queue as module
+        save_time, module.time = module.time, lambda: 1234567.0
+        try:
+            queue = self._make_one()
+            for body in ('one', 'two', 'three'):
+                queue.add(DummyMessage(body))
+        finally:
+            module.time = save_time
+        keys = list(queue._partitions[0].keys())
+        self.assertEqual(len(keys), 3)
+        self.failUnless(keys[0] >> 20 >= 1234567000, keys)
+        self.assertEqual([queue.pop_next() for i in xrange(3)],
+                         ['one', 'two', 'three'])
+
+    def test_partitions(self):
+        from repoze.postoffice.queue import Queue
+        queue = Queue(partitions=3)
+        self.assertEqual(queue.count_partitions(), 3)
+        bodies = [str(i) for i in xrange(30)]
+        for body in bodies:
+            queue.add(DummyMessage(body))
+        self.assertEqual(len(queue), 30)
+        for index, messages in enumerate(queue._partitions):
+            for key in messages.keys():
+                self.assertEqual(key % 3, index)
+        self.assertEqual(list(queue.pop_many(10)), bodies[:10])
+        self.assertEqual(len(queue), 20)
+        popped = [[message.get_payload()
+                   for message in queue.pop_many(30, partition=i)]
+                  for i in xrange(3)]
+        self.assertEqual(sorted(sum(popped, [])), sorted(bodies[10:]))
+        for partition in popped:
+            self.assertEqual(partition,
+                             sorted(partition, key=bodies.index))
+        self.failIf(queue)
+
+    def test_pop_next_partition(self):
+        from repoze.postoffice.queue import Queue
+        queue = Queue(partitions=2)
+        queue.add(DummyMessage('one'))
+        index = [bool(messages) for messages in queue._partitions].index(True)
+        self.assertRaises(StopIteration, queue.pop_next, 1 - index)
+        self.assertEqual(queue.pop_next(index), 'one')
+
+    def test_bbb_sequential_message_ids(self):
+        from BTrees.IOBTree import IOBTree
+        from repoze.postoffice.queue import _QueuedMessage
+        queue = self._make_one()
+        del queue._partitions
+        del queue._message_count
+        queue._messages = IOBTree()
+        queue._messages[0] = _QueuedMessage(DummyMessage('one'))
+        queue._messages[1] = _QueuedMessage(DummyMessage('two'))
+        self.assertEqual(len(queue), 2)
+        queue.add(DummyMessage('three'))
+        self.failIf('_messages' in queue.__dict__)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(list(queue.pop_many(3)), ['one', 'two', 'three'])
+
+    def test_len_uses_counter(self):
+        queue = self._make_one()
+        queue.add(DummyMessage('one'))
+        queue.add(DummyMessage('two'))
+        self.assertEqual(queue._message_count(), 2)
+        queue._partitions = None  # Would fail if buckets were counted
+        self.assertEqual(len(queue), 2)
+
+    def test_len_bbb_without_counter(self):
+        queue = self._make_one()
+        queue.add(DummyMessage('one'))
+        queue.add(DummyMessage('two'))
+        del queue._message_count
+        self.assertEqual(len(queue), 2)
+        self.failIf('_message_count' in queue.__dict__)
+        queue.pop_next()
+        self.assertEqual(queue._message_count(), 1)
+        self.assertEqual(len(queue), 1)
+
+    def test_quarantine_index_pairs(self):
+        from BTrees.OOBTree import OOTreeSet
+        queue = self._make_one()
+        for sender in ('harry@example', 'harry@example.com', 'harry@example'):
+            message = DummyMessage(sender)
+            message.replace_header('From', sender)
+            queue.quarantine(message, (KeyError, KeyError(), None))
+        index = queue._get_quarantine_index()
+        self.failUnless(isinstance(index.senders, OOTreeSet))
+        self.assertEqual(list(index.senders), [
+            ('harry@example', 0), ('harry@example', 2),
+            ('harry@example.com', 1)])
+        self.assertEqual(list(index.error_types), [
+            ('KeyError', 0), ('KeyError', 1), ('KeyError', 2)])
+        found = queue.find_quarantined_messages(sender='harry@example')
+        self.assertEqual([id for id, summary in found], ['0', '2'])
+
+    def test_quarantined_messages_not_kept(self):
+        queue = self._make_one()
+        queue.quarantine(DummyMessage('one'), (None, None, None))
+        (queued, error), = queue._quarantine.values()
+        queued.release()
+        (message, error), = queue.get_quarantined_messages()
+        self.assertEqual(message.get_payload(), 'one')
+        again = queue.get_quarantined_message(message['X-Postoffice-Id'])
+        self.failIf(again is message)
+        self.assertEqual(queued._v_message, None)
+        queue.remove_from_quarantine(again)
+        self.assertEqual(queue.count_quarantined_messages(), 0)
+
+    def test_count_quarantined_messages_bbb_without_counter(self):
+        queue = self._make_one()
+        message = DummyMessage('one')
+        queue.quarantine(message, (None, None, None))
+        queue.quarantine(DummyMessage('two'), (None, None, None))
+        del queue._quarantine_count
+        self.assertEqual(queue.count_quarantined_messages(), 2)
+        queue.remove_from_quarantine(message)
+        self.assertEqual(queue._quarantine_count(), 1)
+        self.assertEqual(queue.count_quarantined_messages(), 1)
+
+    def test_find_quarantined_messages_bbb_without_index(self):
+        from datetime import datetime
+        queue = self._make_one()
+        message = DummyMessage('one')
+        message['Date'] = 'Thu, 13 May 2010 02:42:00'
+        queue.quarantine(message, (KeyError, KeyError(), None))
+        queue.quarantine(DummyMessage('two'), (None, None, None))
+        del queue._quarantine_index
+        found = queue.find_quarantined_messages(error_type='KeyError')
+        self.assertEqual([id for id, summary in found], ['0'])
+        self.assertEqual(found[0][1]['quarantined'],
+                         datetime(2010, 5, 13, 2, 42))
+        self.assertEqual(len(queue.find_quarantined_messages(
+            since=datetime(2010, 5, 13))), 1)
+        queue.remove_from_quarantine(message)
+        self.assertEqual(queue.count_quarantined_errors(), {})
+
+    def test_quarantine_bbb_without_index(self):
+        from datetime import datetime
+        queue = self._make_one()
+        queue.quarantine(DummyMessage('one'), (KeyError, KeyError(), None))
+        queue._quarantine_index = None
+        message = DummyMessage('two')
+        message['Date'] = 'Thu, 13 May 2010 02:42:00'
+        queue.quarantine(message, (KeyError, KeyError(), None))
+        self.assertEqual(len(queue.find_quarantined_messages(
+            error_type='KeyError')), 2)
+        queue.remove_from_quarantine(message)
+        self.assertEqual(len(queue.find_quarantined_messages(
+            since=datetime(2010, 5, 1))), 1)
+        self.assertEqual(queue.count_quarantined_errors(), {'KeyError': 1})
+        index = queue._quarantine_index
+        self.assertEqual(len(index.minutes), 1)
+
+    def test_pop_next_releases_message(self):
+        queue = self._make_one()
+        queue.add(DummyMessage('one'))
+        (key, queued), = queue._partitions[0].items()
+        self.assertEqual(queue.pop_next(), 'one')
+        self.assertEqual(queued._v_message, None)
+
+    def test_is_duplicate_bbb_persistence(self):
+        queue = self._make_one()
+        del queue._message_ids
+        message = DummyMessage('one')
+        self.failIf(queue.is_duplicate(message))
+
+    def test_is_duplicate_wo_o_orig_to_in_message_ids_entry(self):
+        import time
+        queue = self._make_one()
+        message = DummyMessage('one')
+        timestamp = time.time()
+        queue._message_ids[message['Message-Id']] = timestamp
+        self.failIf(queue.is_duplicate(message))
+
+    def test_is_duplicate_same_message_id_same_x_orig_to(self):
+        import time
+        queue = self._make_one()
+        message = DummyMessage('one')
+        timestamp = time.time()
+        queue._message_ids[message['Message-Id']] = (timestamp,
+                                                     'phred@example.com')
+        self.failUnless(queue.is_duplicate(message))
+
+    def test_is_duplicate_same_message_id_different_x_orig_to(self):
+        import time
+        queue = self._make_one()
+        message = DummyMessage('one')
+        timestamp = time.time()
+        queue._message_ids[message['Message-Id']] = (timestamp,
+                                                     'bharney@example.com')
+        self.failIf(queue.is_duplicate(message))
+
+    def test_is_duplicate_past_cutoff(self):
+        import time
+        queue = self._make_one()
+        message = DummyMessage('one')
+        timestamp = time.time() - 30 * 60 * 60
+        queue._message_ids[message['Message-Id']] = (timestamp, None)
+        self.failIf(queue.is_duplicate(message))
+
+    def test_is_duplicate_custom_window(self):
+        import time
+        queue = self._make_one()
+        message = DummyMessage('one')
+        timestamp = time.time() - 2 * 60 * 60
+        queue._message_ids[message['Message-Id']] = (timestamp,
+                                                     'phred@example.com')
+        queue._index_message_id(message['Message-Id'], timestamp)
+        self.failUnless(queue.is_duplicate(message))
+        self.failIf(queue.is_duplicate(message, window=60 * 60))
+        # Expired message ids are only forgotten by compact
+        self.failUnless(message['Message-Id'] in queue._message_ids)
+
+    def test_compact_prunes_expired_message_ids_only(self):
+        import time
+        from datetime import datetime
+        queue = self._make_one()
+        now = time.time()
+        queue._message_ids['old'] = (now - 30 * 60 * 60, None)
+        queue._index_message_id('old', now - 30 * 60 * 60)
+        queue._message_ids['new'] = (now - 60, None)
+        queue._index_message_id('new', now - 60)
+        reclaimed, start = queue.compact(datetime.now())
+        self.assertEqual(reclaimed['message_ids'], 1)
+        self.assertEqual(list(queue._message_ids.keys()), ['new'])
+        self.assertEqual(len(queue._message_id_times), 1)
+        reclaimed, start = queue.compact(datetime.now(),
+                                         duplicate_window=30)
+        self.assertEqual(reclaimed['message_ids'], 1)
+        self.assertEqual(len(queue._message_ids), 0)
+        self.assertEqual(len(queue._message_id_times), 0)
+
+    def test_compact_readded_message_id_not_pruned(self):
+        import time
+        from datetime import datetime
+        queue = self._make_one()
+        message = DummyMessage('one')
+        queue._index_message_id(message['Message-Id'],
+                                time.time() - 30 * 60 * 60)
+        queue.add(message)
+        reclaimed, start = queue.compact(datetime.now())
+        self.assertEqual(reclaimed['message_ids'], 0)
+        self.failUnless(queue.is_duplicate(message))
+
+    def test_compact_bbb_builds_message_id_index(self):
+        import time
+        from datetime import datetime
+        queue = self._make_one()
+        queue._message_id_times = None
+        now = time.time()
+        queue._message_ids['old'] = now - 30 * 60 * 60
+        queue._message_ids['new'] = (now - 60, None)
+        # Producers don't build the index
+        queue.add(DummyMessage('one'))
+        self.assertEqual(queue._message_id_times, None)
+        queue.compact(datetime.now())
+        self.assertEqual(sorted(queue._message_ids.keys()),
+                         ['12345', 'new'])
+        self.assertEqual(len(queue._message_id_times), 2)
+
+    def test_compact_bbb_replaces_minute_index(self):
+        import time
+        from datetime import datetime
+        from BTrees.LOBTree import LOBTree
+        queue = self._make_one()
+        queue._message_id_times = LOBTree()
+        queue._message_ids['old'] = (time.time() - 30 * 60 * 60, None)
+        queue.add(DummyMessage('one'))
+        reclaimed, start = queue.compact(datetime.now())
+        self.assertEqual(reclaimed['message_ids'], 1)
+        self.assertEqual(list(queue._message_ids.keys()), ['12345'])
+        self.assertEqual(len(queue._message_id_times), 1)
+
+    def _open_concurrently(self, queue, connections=2):
+        # Stores the queue in a FileStorage database and returns a list of
+        # (transaction manager, queue) pairs, each with its own connection,
+        # as for several processes using the queue at once.
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        tmp = tempfile.mkdtemp('.repoze.postoffice.tests')
+        self.addCleanup(shutil.rmtree, tmp)
+        db = DB(FileStorage(os.path.join(tmp, 'Data.fs'),
+                            blob_dir=os.path.join(tmp, 'blobs')))
+        self.addCleanup(db.close)
+        opened = []
+        for i in xrange(connections):
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            if not opened:
+                conn.root()['queue'] = queue
+                tm.commit()
+            opened.append((tm, conn.root()['queue']))
+        return opened
+
+    def _add(self, queue, name):
+        message = DummyMessage(name)
+        message.replace_header('Message-Id', '<%s@example>' % name)
+        queue.add(message)
+
+    def test_concurrent_producers(self):
+        # Two importer processes add to the queue in overlapping transactions.
+        (tm1, queue1), (tm2, queue2) = self._open_concurrently(
+            self._make_one())
+        for i in xrange(3):
+            for queue, name in ((queue1, 'one'), (queue2, 'two')):
+                message = DummyMessage('%s%d' % (name, i))
+                message.replace_header('Message-Id', '<%s%d@example>' %
+                                       (name, i))
+                self.failIf(queue.is_duplicate(message))
+                queue.add(message)
+            tm1.commit()
+            tm2.commit()
+        queue1._p_jar.sync()
+        self.assertEqual(len(queue1), 6)
+        self.assertEqual(len(queue1._message_ids), 6)
+        self.assertEqual(len(queue1._message_id_times), 6)
+
+    def test_concurrent_producer_and_consumer(self):
+        # A producer and a consumer of the same partition, in overlapping
+        # transactions, whether few or many messages are queued.
+        from repoze.postoffice.queue import _BUCKET_SIZE
+        (producer_tm, producer), (consumer_tm, consumer) = \
+            self._open_concurrently(self._make_one())
+        for i in xrange(10):
+            self._add(producer, 'early%d' % i)
+        producer_tm.commit()
+        consumer._p_jar.sync()
+        popped = []
+        for i in xrange(_BUCKET_SIZE * 3):
+            self._add(producer, 'msg%d' % i)
+            popped.append(consumer.pop_next().get_payload())
+            producer_tm.commit()
+            consumer_tm.commit()
+        for i in xrange(_BUCKET_SIZE * 3):
+            # Drain the queue while still adding to it
+            self._add(producer, 'late%d' % i)
+            popped.extend([message.get_payload()
+                           for message in consumer.pop_many(3)])
+            producer_tm.commit()
+            consumer_tm.commit()
+        consumer._p_jar.sync()
+        popped.extend([message.get_payload()
+                       for message in consumer.pop_many(1000)])
+        consumer_tm.commit()
+        expected = (['early%d' % i for i in xrange(10)] +
+                    ['msg%d' % i for i in xrange(_BUCKET_SIZE * 3)] +
+                    ['late%d' % i for i in xrange(_BUCKET_SIZE * 3)])
+        self.assertEqual(popped, expected)
+        self.assertEqual(len(consumer), 0)
+        self.assertEqual(len(consumer._partitions[0]._buckets), 1)
+
+    def test_concurrent_consumers_different_partitions(self):
+        from repoze.postoffice.queue import Queue
+        (tm1, queue1), (tm2, queue2) = self._open_concurrently(
+            Queue(partitions=2))
+        for i in xrange(20):
+            self._add(queue1, str(i))
+        tm1.commit()
+        queue2._p_jar.sync()
+        popped = []
+        for i in xrange(3):
+            popped.extend(queue1.pop_many(2, partition=0))
+            popped.extend(queue2.pop_many(2, partition=1))
+            tm1.commit()
+            tm2.commit()
+        queue1._p_jar.sync()
+        self.assertEqual(len(popped), 12)
+        self.assertEqual(len(queue1), 8)
+
+    def test_concurrent_consumers_same_message_conflict(self):
+        from ZODB.POSException import ConflictError
+        (tm1, queue1), (tm2, queue2) = self._open_concurrently(
+            self._make_one())
+        self._add(queue1, 'one')
+        self._add(queue1, 'two')
+        tm1.commit()
+        queue2._p_jar.sync()
+        self.assertEqual(queue1.pop_next().get_payload(), 'one')
+        self.assertEqual(queue2.pop_next().get_payload(), 'one')
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+
+    def test_concurrent_producer_adds_to_dropped_bucket(self):
+        # A producer which hasn't seen the bucket it adds to dropped by a
+        # consumer conflicts, rather than losing its message.
+        from ZODB.POSException import ConflictError
+        from repoze.postoffice.queue import _BUCKET_SIZE
+        (tm1, queue1), (tm2, queue2), (tm3, queue3) = \
+            self._open_concurrently(self._make_one(), 3)
+        for i in xrange(_BUCKET_SIZE - 1):
+            self._add(queue1, str(i))
+        tm1.commit()
+        queue2._p_jar.sync()
+        queue3._p_jar.sync()
+        self._add(queue1, 'full')
+        self._add(queue1, 'next bucket')
+        tm1.commit()
+        self.assertEqual(len(list(queue2.pop_many(_BUCKET_SIZE))),
+                         _BUCKET_SIZE - 1)
+        tm2.commit()  # Before its snapshot had the second bucket
+        queue2._p_jar.sync()
+        queue2.pop_next()
+        self.assertEqual(len(queue2._partitions[0]._buckets), 1)
+        self._add(queue3, 'stale')
+        tm2.commit()
+        self.assertRaises(ConflictError, tm3.commit)
+
+    def _collect(self, queue, sender, date):
+        message = DummyMessage(sender)
+        message.replace_header('From', sender)
+        message['Date'] = date
+        queue.collect_frequency_data(message)
+
+    def test_concurrent_frequency_data_same_sender(self):
+        # Two importers count messages from the same sender in overlapping
+        # transactions, in the same minute and in a later one which pushes
+        # an old minute out of its slot.
+        from datetime import datetime
+        (tm1, queue1), (tm2, queue2) = self._open_concurrently(
+            self._make_one())
+        self._collect(queue1, 'harry@example', 'Wed, 13 May 2010 02:00:00')
+        self._collect(queue1, 'harry@example', 'Wed, 13 May 2010 02:42:00')
+        tm1.commit()
+        queue2._p_jar.sync()
+        self._collect(queue1, 'harry@example', 'Wed, 13 May 2010 02:42:10')
+        self._collect(queue2, 'harry@example', 'Wed, 13 May 2010 02:42:20')
+        self._collect(queue2, 'harry@example', 'Wed, 13 May 2010 03:00:00')
+        tm1.commit()
+        tm2.commit()
+        queue1._p_jar.sync()
+        ring, = queue1._freq_data['harry@example'].rings.values()
+        counts = dict([(minute % 1440, count) for minute, count
+                       in zip(ring.minutes, ring.counts) if count])
+        self.assertEqual(counts, {162: 3, 180: 1})
+        self.assertEqual(ring.last, datetime(2010, 5, 13, 3, 0))
+
+    def test_concurrent_frequency_data_new_senders(self):
+        (tm1, queue1), (tm2, queue2) = self._open_concurrently(
+            self._make_one())
+        for i in xrange(3):
+            self._collect(queue1, 'one%d@example' % i,
+                          'Wed, 13 May 2010 02:42:00')
+            self._collect(queue2, 'two%d@example' % i,
+                          'Wed, 13 May 2010 02:42:00')
+        tm1.commit()
+        tm2.commit()
+        queue1._p_jar.sync()
+        self.assertEqual(len(queue1._freq_data), 6)
+
+    def test_throttles_BBB(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from persistent.dict import PersistentDict
+        from repoze.postoffice.queue import _FreqData
+        queue = self._make_one()
+        del queue._throttles
+        del queue._throttle_times
+        now = datetime(2010, 5, 13, 2, 42)
+        freq_data = _FreqData()
+        freq_data.throttles = PersistentDict({
+            (): now + timedelta(minutes=5),
+            (('A', 'foo'),): now - timedelta(minutes=5),
+        })
+        queue._freq_data['Harry'] = freq_data
+        self.failUnless(queue.is_throttled('Harry', now))
+        self.failIf(queue.is_throttled('Harry', now, {'A': 'foo'}))
+        self.failIf('throttles' in freq_data.__dict__)
+        self.assertEqual(queue.get_throttles(now), [
+            ('Harry', {}, now + timedelta(minutes=5)),
+        ])
+
+    def test_throttles_BBB_migrated_by_sender(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from persistent.dict import PersistentDict
+        from repoze.postoffice.queue import _FreqData
+        queue = self._make_one()
+        del queue._throttles
+        del queue._throttle_times
+        now = datetime(2010, 5, 13, 2, 42)
+        for user in ('Harry', 'Sally', 'Marie'):
+            freq_data = _FreqData()
+            freq_data.throttles = PersistentDict({
+                (): now + timedelta(minutes=5)})
+            queue._freq_data[user] = freq_data
+        # Seeing one sender doesn't move every sender's throttles
+        self.failUnless(queue.is_throttled('Sally', now))
+        self.failIf('throttles' in queue._freq_data['Sally'].__dict__)
+        self.failUnless('throttles' in queue._freq_data['Harry'].__dict__)
+        self.assertEqual([user for user, headers, until
+                          in queue.get_throttles(now)],
+                         ['Harry', 'Marie', 'Sally'])
+
+        reclaimed, start = queue.compact(now, limit=1)
+        self.assertEqual(start, ('senders', 'Harry'))
+        self.failUnless(('Harry', ()) in queue._throttles)
+        self.failIf(('Marie', ()) in queue._throttles)
+        while start is not None:
+            reclaimed, start = queue.compact(now, limit=1, start=start)
+        self.failIf(queue._unmigrated_throttles)
+        self.assertEqual(len(queue._throttles), 3)
+        self.failUnless(queue.is_throttled('Marie', now))
+
+    def test_compact_bbb_replaces_throttle_minute_index(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from BTrees.LOBTree import LOBTree
+        from BTrees.OOBTree import OOTreeSet
+        queue = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        queue._throttle_times = LOBTree()
+        queue.throttle('Harry', now - timedelta(minutes=5))
+        queue.throttle('Sally', now + timedelta(minutes=5))
+        self.assertEqual(len(queue._throttle_times), 0)
+        self.assertEqual([user for user, headers, until
+                          in queue.get_throttles(now)], ['Sally'])
+        reclaimed, start = queue.compact(now)
+        self.assertEqual(reclaimed['throttles'], 1)
+        self.failUnless(isinstance(queue._throttle_times, OOTreeSet))
+        self.assertEqual(list(queue._throttle_times.keys()),
+                         [(now + timedelta(minutes=5), ('Sally', ()))])
+        self.assertEqual([user for user, headers, until
+                          in queue.get_throttles(now)], ['Sally'])
+
+class TestSQLiteQueue(_QueueTests, unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        _QueueTests.setUp(self)
+        self.tmp = tempfile.mkdtemp('.repoze.postoffice.tests')
+
+    def tearDown(self):
+        import shutil
+        import transaction
+        transaction.abort()
+        _QueueTests.tearDown(self)
+        shutil.rmtree(self.tmp)
+
+    def _make_one(self, partitions=1):
+        import os
+        from repoze.postoffice.sqlite import SQLiteQueue
+        return SQLiteQueue(os.path.join(self.tmp, 'queue.db'), partitions)
+
+    def test_wal_mode(self):
+        queue = self._make_one()
+        self.assertEqual(len(queue), 0)
+        cursor = queue._read().execute("PRAGMA journal_mode")
+        self.assertEqual(cursor.fetchone()[0], 'wal')
+
+    def _count_committed(self, queue):
+        import sqlite3
+        connection = sqlite3.connect(queue.path)
+        try:
+            cursor = connection.execute("SELECT COUNT(*) FROM messages")
+            return cursor.fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_commit(self):
+        import transaction
+        queue = self._make_one()
+        queue.add(DummyMessage('one'))
+        queue.add(DummyMessage('two'))
+        self.assertEqual(self._count_committed(queue), 0)
+        # Queues using the same database share its transaction
+        consumer = self._make_one()
+        self.assertEqual(len(consumer), 2)
+        transaction.commit()
+        self.assertEqual(self._count_committed(queue), 2)
+        self.assertEqual(len(consumer), 2)
+        self.assertEqual(consumer.pop_next().get_payload(), 'one')
+        transaction.commit()
+        self.assertEqual(_payloads(queue.get_messages()), ['two'])
+
+    def test_abort(self):
+        import transaction
+        queue = self._make_one()
+        queue.add(DummyMessage('one'))
+        transaction.commit()
+        self.assertEqual(queue.pop_next().get_payload(), 'one')
+        queue.add(DummyMessage('two'))
+        transaction.abort()
+        self.assertEqual(_payloads(queue.get_messages()), ['one'])
+
+    def test_stored_in_zodb(self):
+        import transaction
+        from ZODB.DB import DB
+        db = DB(None)
+        try:
+            conn = db.open()
+            conn.root()['queue'] = queue = self._make_one(partitions=2)
+            queue.add(DummyMessage('one'))
+            transaction.commit()
+            conn.close()
+
+            conn = db.open()
+            queue = conn.root()['queue']
+            self.assertEqual(queue.count_partitions(), 2)
+            self.assertEqual(queue.pop_next().get_payload(), 'one')
+            transaction.commit()
+            self.assertEqual(len(queue), 0)
+            conn.close()
+        finally:
+            db.close()
+
+    def test_ghosted_between_writes(self):
+        # The write transaction outlives the queue's volatile attributes, and
+        # is committed by the transaction manager of the queue's connection.
+        import transaction
+        from ZODB.DB import DB
+        db = DB(None)
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            conn.root()['queue'] = queue = self._make_one()
+            tm.commit()
+            queue.add(DummyMessage('one'))
+            queue._p_deactivate()
+            self.assertEqual(queue._p_changed, None)
+            queue.add(DummyMessage('two'))
+            self.assertEqual(len(queue), 2)
+            transaction.commit()
+            self.assertEqual(self._count_committed(queue), 0)
+            tm.commit()
+            self.assertEqual(self._count_committed(queue), 2)
+            conn.close()
+        finally:
+            db.close()
+
+    def test_partitions(self):
+        queue = self._make_one(partitions=3)
+        self.assertEqual(queue.count_partitions(), 3)
+        bodies = [str(i) for i in xrange(30)]
+        for body in bodies:
+            queue.add(DummyMessage(body))
+        self.assertEqual(_payloads(queue.pop_many(10)), bodies[:10])
+        popped = [_payloads(queue.pop_many(30, partition=i))
+                  for i in xrange(3)]
+        self.assertEqual(sorted(sum(popped, [])), sorted(bodies[10:]))
+        for partition in popped:
+            self.assertEqual(partition,
+                             sorted(partition, key=bodies.index))
+        self.failIf(queue)
+
+    def test_repartition_moves_messages(self):
+        queue = self._make_one()
+        for body in ('one', 'two', 'three'):
+            queue.add(DummyMessage(body))
+        queue.repartition(2)
+        self.assertEqual(_payloads(queue.pop_many(5, partition=1)),
+                         ['one', 'three'])
+        self.assertEqual(_payloads(queue.pop_many(5, partition=0)), ['two'])
+
+    def test_is_duplicate_different_x_orig_to(self):
+        queue = self._make_one()
+        message = DummyMessage('one')
+        queue.add(message)
+        message.replace_header('X-Original-To', 'bharney@example.com')
+        self.failIf(queue.is_duplicate(message))
+        del message['X-Original-To']
+        self.failIf(queue.is_duplicate(message))
+
+    def test_is_duplicate_custom_window(self):
+        import time
+        queue = self._make_one()
+        message = DummyMessage('one')
+        queue._write().execute(
+            "INSERT INTO message_ids VALUES (?, ?, ?)",
+            (u'12345', time.time() - 2 * 60 * 60, u'phred@example.com'))
+        self.failUnless(queue.is_duplicate(message))
+        self.failIf(queue.is_duplicate(message, window=60 * 60))
+        # Expired message ids are only forgotten by compact
+        cursor = queue._read().execute("SELECT COUNT(*) FROM message_ids")
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_is_duplicate_doesnt_write(self):
+        import transaction
+        queue = self._make_one()
+        queue.add(DummyMessage('one'))
+        transaction.commit()
+        self.failUnless(queue.is_duplicate(DummyMessage('one')))
+        self.failIf(transaction.get()._resources)
+
+    def test_compact_prunes_message_ids_in_batches(self):
+        import time
+        from datetime import datetime
+        queue = self._make_one()
+        now = time.time()
+        for i, age in enumerate((3, 2, 1)):
+            queue._write().execute(
+                "INSERT INTO message_ids VALUES (?, ?, ?)",
+                (u'old%d' % i, now - age * 24 * 60 * 60, None))
+        queue.add(DummyMessage('new'))
+        reclaimed, start = queue.compact(datetime.now(), limit=2)
+        self.assertEqual(reclaimed['message_ids'], 2)
+        self.assertEqual(start, ('message_ids', None))
+        reclaimed, start = queue.compact(datetime.now(), limit=2,
+                                         start=start)
+        self.assertEqual(reclaimed['message_ids'], 1)
+        self.assertEqual(start, None)
+        cursor = queue._read().execute("SELECT message_id FROM message_ids")
+        self.assertEqual(cursor.fetchall(), [(u'12345',)])
+
+    def test_get_quarantined_message_missing(self):
+        queue = self._make_one()
+        self.assertRaises(KeyError, queue.get_quarantined_message, '0')
+
+class TestShardedQueue(unittest.TestCase):
+
+    def _make_one(self, shards=3, partitions=1):
+        from repoze.postoffice.queue import ShardedQueue
+        return ShardedQueue(shards, partitions)
+
+    def _make_message(self, body, message_id=None, user='Harry'):
+        message = DummyMessage(body)
+        if message_id is None:
+            message_id = '<%s@example>' % body
+        message.replace_header('Message-Id', message_id)
+        message.replace_header('From', user)
+        return message
+
+    def test_add_and_retrieve_messages(self):
+        queue = self._make_one()
+        self.assertEqual(queue.count_shards(), 3)
+        bodies = [str(i) for i in xrange(20)]
+        for body in bodies:
+            queue.add(self._make_message(body))
+        self.assertEqual(len(queue), 20)
+        self.assertEqual(len([shard for shard in queue._shards if shard]), 3)
+        self.assertEqual([message.get_payload()
+                          for message in queue.get_messages()], bodies)
+        self.assertEqual(queue.pop_next(), '0')
+        self.assertEqual(list(queue.pop_many(30)), bodies[1:])
+        self.failIf(queue)
+
+    def test_partitions(self):
+        queue = self._make_one(partitions=2)
+        self.assertEqual(queue.count_partitions(), 2)
+        for i in xrange(10):
+            queue.add(self._make_message(str(i)))
+        queue.repartition(3)
+        self.assertEqual(queue.count_partitions(), 3)
+        popped = sum([list(queue.pop_many(10, partition=i))
+                      for i in xrange(3)], [])
+        self.assertEqual(len(popped), 10)
+        self.failIf(queue)
+
+    def test_is_duplicate(self):
+        queue = self._make_one()
+        message = self._make_message('one')
+        self.failIf(queue.is_duplicate(message))
+        queue.add(message)
+        self.failUnless(queue.is_duplicate(message))
+        self.failIf(queue.is_duplicate(self._make_message('two')))
+
+    def test_unicode_message_id(self):
+        queue = self._make_one()
+        message = self._make_message('one', u'<caf\xe9@example>')
+        queue.add(message)
+        self.failUnless(queue.is_duplicate(message))
+
+    def test_frequency_and_throttle(self):
+        from datetime import datetime
+        from datetime import timedelta
+        now = datetime(2010, 5, 13, 2, 42, 30)
+        queue = self._make_one()
+        for user in ('Harry', 'Sally', 'Marie', 'Jess'):
+            message = self._make_message(user, user=user)
+            message['Date'] = 'Wed, 13 May 2010 02:42:00'
+            queue.collect_frequency_data(message)
+            self.assertAlmostEqual(
+                queue.get_instantaneous_frequency(user, now), 2.0)
+            self.assertAlmostEqual(queue.get_average_frequency(
+                user, now, timedelta(minutes=1)), 1.0)
+        queue.throttle('Harry', now + timedelta(minutes=5))
+        queue.throttle('Sally', now + timedelta(minutes=1))
+        self.failUnless(queue.is_throttled('Harry', now))
+        self.failIf(queue.is_throttled('Marie', now))
+        self.assertEqual(
+            [user for user, headers, until in queue.get_throttles(now)],
+            ['Sally', 'Harry'])
+
+    def test_bounce_limit(self):
+        queue = self._make_one()
+        queue.set_bounce_limit(1)
+        sent = []
+        send = lambda *args: sent.append(args)
+        for user in ('Harry', 'Sally', 'Harry', 'Sally'):
+            queue.bounce(self._make_message(user, user=user), send,
+                         'bouncer@example.com')
+        self.assertEqual([toaddrs for f, toaddrs, m in sent],
+                         [['Harry'], ['Sally']])
+        self.assertEqual(queue.count_suppressed_bounces(), 2)
+        shard = queue._shard('Harry')
+        self.failUnless('Harry' in shard._freq_data)
+        self.failUnless(shard.is_throttled(
+            'Harry', datetime.now(), {'X-Postoffice': 'Bounced'}))
+        self.assertEqual(shard.count_suppressed_bounces(), 1)
+
+    def test_bounce_digest(self):
+        import base64
+        from datetime import timedelta
+        queue = self._make_one()
+        queue.set_bounce_limit(1, 600, digest=True)
+        queue.set_notice_template('bounce_digest',
+                                  u'Subject: {count} bounced\n\nSorry.\n')
+        sent = []
+        send = lambda *args: sent.append(args)
+        for user in ('Harry', 'Sally', 'Harry', 'Harry'):
+            queue.bounce(self._make_message(user, user=user), send,
+                         'bouncer@example.com', u'Too big.')
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(queue.count_suppressed_bounces(), 2)
+        self.assertEqual(queue._bounce_digests, None)
+        self.assertEqual(len(queue._shard('Harry')._bounce_digests), 1)
+
+        later = datetime.now() + timedelta(seconds=601)
+        self.assertEqual(queue.send_bounce_digests(send, later), 1)
+        fromaddr, toaddrs, digest = sent[-1]
+        self.assertEqual(toaddrs, ['Harry'])
+        self.assertEqual(digest['Subject'], '2 bounced')
+        self.assertEqual(base64.b64decode(digest.get_payload()), 'Sorry.\n')
+        self.assertEqual(queue.send_bounce_digests(send, later), 0)
+
+    def test_get_outbox(self):
+        queue = self._make_one()
+        outbox = queue.get_outbox()
+        self.failUnless(queue.get_outbox() is outbox)
+        for shard in queue._shards:
+            self.assertEqual(shard._outbox, None)
+        queue.bounce(self._make_message('one'), outbox.send,
+                     'bouncer@example.com')
+        self.assertEqual(len(outbox), 1)
+        sent = []
+        outbox.drain(lambda *args: sent.append(args))
+        fromaddr, toaddrs, bounce = sent[0]
+        self.assertEqual(toaddrs, ['Harry'])
+        self.assertEqual(bounce['X-Postoffice'], 'Bounced')
+
+    def test_find_quarantined_messages(self):
+        queue = self._make_one()
+        for i in xrange(6):
+            message = self._make_message(str(i), user='user%d' % (i % 2))
+            queue.quarantine(message, (KeyError, KeyError(), None))
+        queue.quarantine(self._make_message('6'), (ValueError, None, None))
+        found = queue.find_quarantined_messages(error_type='KeyError',
+                                                sender='user1')
+        self.assertEqual(len(found), 3)
+        for id, summary in found:
+            message = queue.get_quarantined_message(id)
+            self.assertEqual(message['X-Postoffice-Id'], id)
+            self.assertEqual(summary['from'], 'user1')
+        self.assertEqual(len(queue.find_quarantined_messages()), 7)
+        self.assertEqual(queue.count_quarantined_errors(),
+                         {'KeyError': 6, 'ValueError': 1})
+        queue.remove_from_quarantine(queue.get_quarantined_message(
+            found[0][0]))
+        self.assertEqual(queue.count_quarantined_errors(),
+                         {'KeyError': 5, 'ValueError': 1})
+
+    def test_quarantine_notice_template(self):
+        import base64
+        queue = self._make_one()
+        queue.set_notice_template('quarantine_notice',
+                                  u"Subject: Oops\n\nSent on {date}.\n")
+        message = self._make_message('0')
+        sent = []
+        queue.quarantine(message, ('OMG', 'WTH', '???'),
+                         lambda *args: sent.append(args),
+                         'error@example.com')
+        fromaddr, toaddrs, notice = sent[0]
+        self.assertEqual(notice['Subject'], 'Oops')
+        self.failUnless(base64.b64decode(notice.get_payload()).startswith(
+            'Sent on '))
+        self.failUnless(message['X-Postoffice-Id'])
+        self.assertRaises(ValueError, queue.quarantine, message,
+                          ('OMG', 'WTH', '???'), sent.append)
+
+    def test_compact(self):
+        from datetime import datetime
+        from datetime import timedelta
+        now = datetime(2010, 5, 13, 2, 42)
+        queue = self._make_one(shards=2)
+        for user in ('Harry', 'Sally', 'Marie', 'Jess'):
+            queue.throttle(user, now - timedelta(minutes=5))
+        start = None
+        throttles = 0
+        for i in xrange(10):
+            reclaimed, start = queue.compact(now, 1, start)
+            throttles += reclaimed['throttles']
+            if start is None:
+                break
+        self.assertEqual(throttles, 4)
+
+    def test_quarantine(self):
+        queue = self._make_one()
+        messages = [self._make_message(str(i)) for i in xrange(6)]
+        for message in messages:
+            queue.quarantine(message, ('OMG', 'WTH', '???'))
+        self.assertEqual(queue.count_quarantined_messages(), 6)
+        ids = [message['X-Postoffice-Id'] for message in messages]
+        self.assertEqual(len(set(ids)), 6)
+        quarantined = list(queue.get_quarantined_messages())
+        self.assertEqual(sorted([msg['X-Postoffice-Id']
+                                 for msg, error in quarantined]),
+                         sorted(ids))
+        message = queue.get_quarantined_message(ids[0])
+        self.assertEqual(message.get_payload(), '0')
+        self.assertEqual(message['X-Postoffice-Id'], ids[0])
+        queue.remove_from_quarantine(message)
+        self.assertEqual(queue.count_quarantined_messages(), 5)
+        self.assertRaises(ValueError, queue.remove_from_quarantine, message)
+        message['X-Postoffice-Id'] = 'foo'
+        self.assertRaises(ValueError, queue.remove_from_quarantine, message)
+        queue.requeue_quarantined_messages()
+        self.assertEqual(queue.count_quarantined_messages(), 0)
+        self.assertEqual(len(queue), 5)
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.failures = 0
+
+    def _make_one(self):
+        from repoze.postoffice.queue import Outbox
+        return Outbox()
+
+    def _send(self, fromaddr, toaddrs, message):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('Connection refused')
+        self.sent.append((fromaddr, toaddrs, message.get_payload()))
+
+    def test_send_and_drain(self):
+        outbox = self._make_one()
+        outbox.send('me', ['you'], DummyMessage('one'))
+        outbox.send('me', ['you', 'them'], DummyMessage('two'))
+        self.assertEqual(len(outbox), 2)
+        self.assertEqual(outbox.drain(self._send), (2, 0, 0))
+        self.assertEqual(self.sent, [('me', ['you'], 'one'),
+                                     ('me', ['you', 'them'], 'two')])
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(outbox.drain(self._send), (0, 0, 0))
+
+    def test_send_string(self):
+        outbox = self._make_one()
+        outbox.send('me', ['you'], 'Subject: Hello\n\nHi there')
+        outbox.drain(self._send)
+        self.assertEqual(self.sent, [('me', ['you'], 'Hi there')])
+
+    def test_drain_limit(self):
+        outbox = self._make_one()
+        for body in ('one', 'two', 'three'):
+            outbox.send('me', ['you'], DummyMessage(body))
+        self.assertEqual(outbox.drain(self._send, limit=2), (2, 0, 0))
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox.drain(self._send, limit=2), (1, 0, 0))
+        self.assertEqual([body for f, t, body in self.sent],
+                         ['one', 'two', 'three'])
+
+    def test_drain_not_due(self):
+        from time import time
+        outbox = self._make_one()
+        outbox.send('me', ['you'], DummyMessage('one'))
+        self.assertEqual(outbox.drain(self._send, time() - 60), (0, 0, 0))
+        self.assertEqual(len(outbox), 1)
+
+    def test_drain_retry_with_backoff(self):
+        from time import time
+        outbox = self._make_one()
+        outbox.send('me', ['you'], DummyMessage('one'))
+        now = time() + 1
+        self.failures = 2
+        self.assertEqual(outbox.drain(self._send, now, retry_delay=60),
+                         (0, 1, 0))
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox.drain(self._send, now + 59, retry_delay=60),
+                         (0, 0, 0))
+        self.assertEqual(outbox.drain(self._send, now + 60, retry_delay=60),
+                         (0, 1, 0))
+        # Delay doubles
+        self.assertEqual(outbox.drain(self._send, now + 179, retry_delay=60),
+                         (0, 0, 0))
+        self.assertEqual(outbox.drain(self._send, now + 180, retry_delay=60),
+                         (1, 0, 0))
+        self.assertEqual(self.sent, [('me', ['you'], 'one')])
+        self.assertEqual(len(outbox), 0)
+
+    def test_drain_gives_up(self):
+        from time import time
+        outbox = self._make_one()
+        outbox.send('me', ['you'], DummyMessage('one'))
+        outbox.send('me', ['you'], DummyMessage('two'))
+        now = time() + 1
+        self.failures = 1
+        self.assertEqual(outbox.drain(self._send, now, max_attempts=1),
+                         (1, 0, 1))
+        self.assertEqual(self.sent, [('me', ['you'], 'two')])
+        self.assertEqual(len(outbox), 0)
+
+    def test_drain_logs_failures(self):
+        from time import time
+        outbox = self._make_one()
+        outbox.send('me', ['you', 'them'], DummyMessage('one'))
+        now = time() + 1
+        self.failures = 2
+        log = DummyLog()
+        self.assertEqual(outbox.drain(self._send, now, max_attempts=2,
+                                      retry_delay=60, log=log), (0, 1, 0))
+        self.assertEqual(outbox.drain(self._send, now + 60, max_attempts=2,
+                                      retry_delay=60, log=log), (0, 0, 1))
+        self.assertEqual(log.warnings, [
+            "Unable to send message to you, them, retrying in 60 seconds: "
+            "IOError: Connection refused",
+            "Gave up sending message to you, them after 2 attempts: "
+            "IOError: Connection refused",
+        ])
+
+class TestFreqData(unittest.TestCase):
+
+    def _make_one(self):
+        from repoze.postoffice.queue import _FreqData
+        return _FreqData()
+
+    def _count(self, ring, start, end):
+        from repoze.postoffice.queue import _datetime_as_seconds
+        return ring.count(_datetime_as_seconds(start),
+                          _datetime_as_seconds(end))
+
+    def test_record_and_count(self):
+        from datetime import datetime
+        from datetime import timedelta
+        freq_data = self._make_one()
+        for seconds in (0, 10, 20, 70):
+            freq_data.record(datetime(2010, 5, 13, 2, 42) +
+                             timedelta(seconds=seconds), {})
+        ring, = freq_data.matching({})
+        self.assertEqual(ring.last, datetime(2010, 5, 13, 2, 43, 10))
+        self.assertEqual(sorted(ring.counts)[-2:], [1, 3])
+        self.assertAlmostEqual(self._count(
+            ring, datetime(2010, 5, 13, 2, 42), datetime(2010, 5, 13, 2, 44)),
+            4.0)
+        # Half of the first minute
+        self.assertAlmostEqual(self._count(
+            ring, datetime(2010, 5, 13, 2, 42, 30),
+            datetime(2010, 5, 13, 2, 43)), 1.5)
+        # The current minute only counts up to its end
+        self.assertAlmostEqual(self._count(
+            ring, datetime(2010, 5, 13, 2, 43),
+            datetime(2010, 5, 13, 2, 43, 30)), 1.0)
+
+    def test_ring_wraps(self):
+        from datetime import datetime
+        from datetime import timedelta
+        freq_data = self._make_one()
+        start = datetime(2010, 5, 13, 2, 0)
+        for minute in xrange(10):
+            freq_data.record(start + timedelta(minutes=minute), {}, window=5)
+        ring, = freq_data.matching({})
+        self.assertEqual(len(ring.counts), 5)
+        self.assertAlmostEqual(self._count(
+            ring, start, start + timedelta(minutes=10)), 5.0)
+        # Too old to be counted
+        freq_data.record(start, {}, window=5)
+        self.assertAlmostEqual(self._count(
+            ring, start, start + timedelta(minutes=10)), 5.0)
+
+    def test_ring_grows(self):
+        from datetime import datetime
+        from datetime import timedelta
+        freq_data = self._make_one()
+        start = datetime(2010, 5, 13, 2, 0)
+        for minute in xrange(3):
+            freq_data.record(start + timedelta(minutes=minute), {}, window=3)
+        freq_data.record(start + timedelta(minutes=3), {}, window=10)
+        ring, = freq_data.matching({})
+        self.assertEqual(len(ring.counts), 10)
+        self.assertAlmostEqual(self._count(
+            ring, start, start + timedelta(minutes=10)), 4.0)
+
+    def test_matching(self):
+        from datetime import datetime
+        freq_data = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        freq_data.record(now, {'A': 'foo', 'B': 'bar'})
+        freq_data.record(now, {'A': 'foo', 'B': 'baz'})
+        self.assertEqual(len(freq_data.rings), 2)
+        self.assertEqual(len(freq_data.matching({})), 2)
+        self.assertEqual(len(freq_data.matching({'A': 'foo'})), 2)
+        self.assertEqual(len(freq_data.matching({'B': 'baz'})), 1)
+        self.assertEqual(len(freq_data.matching({'A': 'bar'})), 0)
+        self.assertEqual(len(freq_data.matching({'A': 'foo', 'C': 'x'})), 0)
+        ring, = freq_data.matching({'B': 'bar', 'A': 'foo'})
+        self.assertEqual(ring.headers, {'A': 'foo', 'B': 'bar'})
+
+    def test_record_changes_only_ring(self):
+        import transaction
+        from datetime import datetime
+        from ZODB.DB import DB
+        db = DB(None)
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            conn.root()['freq_data'] = freq_data = self._make_one()
+            now = datetime(2010, 5, 13, 2, 42)
+            freq_data.record(now, {'A': 'foo'})
+            freq_data.record(now, {'A': 'bar'})
+            tm.commit()
+            freq_data.record(now, {'A': 'foo'})
+            ring, = freq_data.matching({'A': 'foo'})
+            self.failUnless(ring._p_changed)
+            self.failIf(freq_data._p_changed)
+            tm.commit()
+            conn.close()
+        finally:
+            db.close()
+
+    def test_forgets_stale_headers(self):
+        from datetime import datetime
+        from datetime import timedelta
+        freq_data = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        freq_data.record(now, {'A': 'foo'}, window=10)
+        freq_data.record(now + timedelta(minutes=20), {'A': 'bar'},
+                         window=10)
+        # Stale rings are only forgotten by compact
+        self.assertEqual(len(freq_data.rings), 2)
+        self.assertEqual(freq_data.compact(now + timedelta(minutes=20)), 1)
+        self.assertEqual(freq_data.rings.keys(), [(('A', 'bar'),)])
+        self.assertEqual(freq_data.index,
+                         {('A', 'bar'): set([(('A', 'bar'),)])})
+        self.assertEqual(freq_data.matching({'A': 'foo'}), [])
+
+    def test_forgets_stale_headers_by_own_window(self):
+        from datetime import datetime
+        from datetime import timedelta
+        freq_data = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        freq_data.record(now, {'A': 'foo'}, window=60)
+        freq_data.record(now + timedelta(minutes=20), {'A': 'bar'},
+                         window=10)
+        self.assertEqual(freq_data.compact(now + timedelta(minutes=20)), 0)
+        self.assertEqual(len(freq_data.matching({'A': 'foo'})), 1)
+
+    def test_matching_excludes_bounces(self):
+        from datetime import datetime
+        freq_data = self._make_one()
+        now = datetime(2010, 5, 13, 2, 42)
+        freq_data.record(now, {})
+        freq_data.record(now, {'X-Postoffice': 'Bounced'})
+        ring, = freq_data.matching({})
+        self.assertEqual(ring.headers, {})
+        ring, = freq_data.matching({'X-Postoffice': 'Bounced'})
+        self.assertEqual(ring.headers, {'X-Postoffice': 'Bounced'})
+
+    def test_bbb_list_of_times(self):
+        from datetime import datetime
+        freq_data = self._make_one()
+        del freq_data.rings
+        freq_data.data = [(datetime(2010, 5, 13, 2, 42), {'A': 'foo'}),
+                          (datetime(2010, 5, 13, 2, 43), {'A': 'foo'})]
+        ring, = freq_data.matching({'A': 'foo'})
+        self.failIf('data' in freq_data.__dict__)
+        self.assertEqual(ring.last, datetime(2010, 5, 13, 2, 43))
+        self.assertEqual(sum(ring.counts), 2)
+
 class TestQueuedMessage(unittest.TestCase):
     def test_it(self):
         from repoze.postoffice.queue import _QueuedMessage
@@ -498,6 +2097,54 @@ class TestQueuedMessage(unittest.TestCase):
         queued._v_message = None
         self.assertEqual(queued.get().get_payload(), 'foobar')
 
+    def test_open(self):
+        from repoze.postoffice.queue import _QueuedMessage
+        queued = _QueuedMessage(DummyMessage('foobar'))
+        message = queued.open()
+        self.failIf(message is queued.get())
+        self.failIf(message.is_body_loaded())
+        self.assertEqual(message['From'], 'Harry')
+        self.assertEqual(message.get_payload(), 'foobar')
+
+    def test_release(self):
+        from repoze.postoffice.queue import _QueuedMessage
+        message = DummyMessage('foobar')
+        queued = _QueuedMessage(message)
+        queued.release()
+        self.assertEqual(queued._v_message, None)
+        retrieved = queued.get()
+        self.failIf(retrieved is message)
+        self.failIf(retrieved.is_body_loaded())
+        self.failUnless(queued.get() is retrieved)
+
+    def test_lazy_message_body_copied(self):
+        import os
+        import shutil
+        import tempfile
+        from repoze.postoffice.message import LazyMaildirMessage
+        from repoze.postoffice.queue import _QueuedMessage
+        tmp = tempfile.mkdtemp('.repoze.postoffice.tests')
+        try:
+            path = os.path.join(tmp, 'message')
+            with open(path, 'w') as f:
+                f.write(_MULTIPART)
+            with open(path) as fp:
+                message = LazyMaildirMessage(fp)
+            message['X-Postoffice-Date'] = '12345'
+            queued = _QueuedMessage(message)
+            self.failIf(message.is_body_loaded())
+            os.remove(path)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(queued._v_message, None)
+        expected = _MULTIPART.replace(
+            '\n\n', '\nX-Postoffice-Date: 12345\n\n', 1)
+        self.assertEqual(queued._blob_file.open().read(), expected)
+        retrieved = queued.get()
+        self.assertEqual(retrieved['X-Postoffice-Date'], '12345')
+        self.assertEqual([part.get_payload() for part in retrieved.walk()][1:],
+                         ['Part one.', 'Part two.'])
+
 class Test_open_queue(unittest.TestCase):
     def _monkey_patch(self, queues):
         from repoze.postoffice import queue as module
@@ -536,6 +2183,27 @@ class Test_open_queue(unittest.TestCase):
         self.failUnless(self.db.closed)
 
 
+class Test_compile_notice_template(unittest.TestCase):
+
+    def _call_fut(self, kind, text):
+        from repoze.postoffice.queue import compile_notice_template
+        return compile_notice_template(kind, text)
+
+    def test_bounce_digest(self):
+        template = self._call_fut('bounce_digest',
+                                  u"Subject: {count} bounced\n\n{reasons}")
+        message = template.render('me', 'you', {'count': 3, 'reasons': 'x'})
+        self.assertEqual(message['Subject'], '3 bounced')
+        self.assertEqual(message['X-Postoffice'], 'Bounced')
+
+    def test_unknown_field(self):
+        self.assertRaises(ValueError, self._call_fut, 'quarantine_notice',
+                          u"Subject: Oops\n\n{reason}")
+
+    def test_unknown_kind(self):
+        self.assertRaises(ValueError, self._call_fut, 'postcard',
+                          u"Subject: Hi\n\nHello.")
+
 class Test_find_queue(unittest.TestCase):
     def test_it(self):
         from repoze.postoffice.queue import find_queue
@@ -543,6 +2211,25 @@ class Test_find_queue(unittest.TestCase):
         self.assertEqual(find_queue(db.root(), 'one'), 'foo')
 
 
+_MULTIPART = """\
+From: Harry <harry@example.com>
+Content-Type: multipart/mixed; boundary="XXX"
+
+Preamble.
+--XXX
+Content-Type: text/plain
+
+Part one.
+--XXX
+Content-Type: text/plain
+
+Part two.
+--XXX--
+"""
+
+def _payloads(messages):
+    return [message.get_payload() for message in messages]
+
 from repoze.postoffice.message import Message
 class DummyMessage(Message):
     def __init__(self, body=None):
@@ -555,6 +2242,25 @@ class DummyMessage(Message):
     def __eq__(self, other):
         return self.get_payload().__eq__(other)
 
+class DummyLength(object):
+    def __init__(self, value, changes):
+        self.value = value
+        self.changes = changes
+
+    def __call__(self):
+        return self.value
+
+    def change(self, delta):
+        self.changes.append(delta)
+        self.value += delta
+
+class DummyLog(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
 class DummyDB(object):
     def __init__(self, dbroot, queues):
         self.dbroot = dbroot
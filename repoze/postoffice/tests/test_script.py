@@ -0,0 +1,214 @@
+import unittest
+
+class TestConsoleScriptDaemon(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.postoffice import script
+        self._saved = (script.PostOffice, script.make_watcher,
+                       script._handle_signals)
+        self.state = {'reload': False, 'running': True}
+        self.post_offices = []
+        self.watchers = []
+        self.actions = []
+        self.maildir = 'test/Maildir'
+        self.bad_config = False
+        self.import_error = False
+
+        def make_post_office(config):
+            po = DummyPostOffice(config, self)
+            self.post_offices.append(po)
+            return po
+        def make_watcher(paths, poll_interval):
+            watcher = DummyWatcher(paths, self)
+            self.watchers.append(watcher)
+            return watcher
+        script.PostOffice = make_post_office
+        script.make_watcher = make_watcher
+        script._handle_signals = lambda: self.state
+
+    def tearDown(self):
+        from repoze.postoffice import script
+        (script.PostOffice, script.make_watcher,
+         script._handle_signals) = self._saved
+
+    def _make_one(self, *args):
+        from repoze.postoffice.script import ConsoleScript
+        console = ConsoleScript(['-C', 'postoffice.ini', '--daemon'] +
+                                list(args))
+        console.log = self.log = DummyLogger()
+        return console
+
+    def _stop(self):
+        self.state['running'] = False
+
+    def _reload(self):
+        self.state['reload'] = True
+
+    def test_stop(self):
+        self.actions = [self._stop]
+        self._make_one()()
+        po, = self.post_offices
+        self.assertEqual(po.reconciled, 1)
+        # Imports again once the watcher has been made
+        self.assertEqual(po.imported, [(1, None), (1, None)])
+        watcher, = self.watchers
+        self.assertEqual(watcher.paths, ['test/Maildir/new',
+                                         'test/Maildir/cur'])
+        self.failUnless(watcher.closed)
+        self.failUnless(po.sender.closed)
+
+    def test_compacts_while_idle(self):
+        self.actions = [False, False, self._stop]
+        self._make_one()()
+        po, = self.post_offices
+        self.assertEqual(po.compacted, 2)
+        self.assertEqual(len(po.imported), 2)
+
+    def test_import_after_wake(self):
+        self.actions = [True, self._stop]
+        self._make_one()()
+        po, = self.post_offices
+        self.assertEqual(len(po.imported), 3)
+        self.assertEqual(po.compacted, 0)
+
+    def test_reload(self):
+        self.actions = [self._reload, self._stop]
+        self._make_one()()
+        old, new = self.post_offices
+        self.failUnless(old.sender.closed)
+        self.assertEqual(len(old.imported), 2)
+        self.assertEqual(new.reconciled, 1)
+        self.assertEqual(len(new.imported), 1)
+        self.failUnless(new.sender.closed)
+        # Maildir is unchanged, so the watcher is kept
+        watcher, = self.watchers
+        self.failUnless(watcher.closed)
+
+    def test_reload_new_maildir(self):
+        def reload():
+            self._reload()
+            self.maildir = 'other/Maildir'
+        self.actions = [reload, self._stop]
+        self._make_one()()
+        old, new = self.post_offices
+        first, second = self.watchers
+        self.failUnless(first.closed)
+        self.assertEqual(second.paths, ['other/Maildir/new',
+                                        'other/Maildir/cur'])
+        self.failUnless(second.closed)
+        self.failUnless(old.sender.closed)
+        self.failUnless(new.sender.closed)
+
+    def test_reload_fails(self):
+        def reload():
+            self._reload()
+            self.bad_config = True
+        self.actions = [reload, self._stop]
+        self._make_one()()
+        po, bad = self.post_offices
+        self.assertEqual(self.log.exceptions,
+                         ['Unable to reload configuration.'])
+        self.assertEqual(bad.imported, [])
+        self.assertEqual(len(po.imported), 3)
+        self.failUnless(po.sender.closed)
+
+    def test_pool(self):
+        self.actions = [self._reload, self._stop]
+        self._make_one('--workers', '3')()
+        old, new = self.post_offices
+        pool = old.pools[0]
+        self.assertEqual(pool.workers, 3)
+        self.assertEqual(old.imported, [(3, pool), (3, pool)])
+        self.failUnless(pool.closed)
+        self.failUnless(pool.joined)
+        # Workers are made again for the new configuration
+        pool, = new.pools
+        self.assertEqual(new.imported, [(3, pool)])
+        self.failUnless(pool.closed)
+
+    def test_import_error(self):
+        self.import_error = True
+        self.actions = [self._stop]
+        self._make_one()()
+        po, = self.post_offices
+        self.assertEqual(self.log.exceptions,
+                         ['Error importing messages.'] * 2)
+        self.assertEqual(len(po.imported), 2)
+        self.failUnless(po.sender.closed)
+
+class DummyPostOffice(object):
+    def __init__(self, config, test):
+        self.config = config
+        self.test = test
+        self.maildir = test.maildir
+        self.reconciled = 0
+        self.imported = []
+        self.compacted = 0
+        self.pools = []
+        self.sender = DummySender()
+
+    def reconcile_queues(self, log):
+        if self.test.bad_config:
+            raise ValueError('Bad configuration.')
+        self.reconciled += 1
+
+    def make_pool(self, workers):
+        pool = DummyPool(workers)
+        self.pools.append(pool)
+        return pool
+
+    def import_messages(self, log, workers, pool):
+        self.imported.append((workers, pool))
+        if self.test.import_error:
+            raise IOError('Maildir is missing.')
+
+    def compact_some(self, log):
+        self.compacted += 1
+
+class DummyLogger(object):
+    def __init__(self):
+        self.infos = []
+        self.exceptions = []
+
+    def info(self, msg):
+        self.infos.append(msg)
+
+    def exception(self, msg):
+        self.exceptions.append(msg)
+
+class DummySender(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class DummyPool(object):
+    closed = joined = False
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def close(self):
+        self.closed = True
+
+    def join(self):
+        self.joined = True
+
+class DummyWatcher(object):
+    closed = False
+
+    def __init__(self, paths, test):
+        self.paths = paths
+        self.test = test
+
+    def wait(self, timeout):
+        # Each action is either a signal, which interrupts the wait, or
+        # whether a message arrives before the timeout.
+        action = self.test.actions.pop(0)
+        if callable(action):
+            action()
+            return True
+        return action
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,227 @@
+import unittest
+
+class TestSMTPSender(unittest.TestCase):
+
+    def setUp(self):
+        self.smtplib = DummySMTPLib()
+        self.now = 0
+
+    def _make_one(self, pool_size=1, max_idle=60):
+        from repoze.postoffice.smtp import SMTPSender
+        return SMTPSender('mail.example.com', 2525, 5, pool_size, max_idle,
+                          smtplib=self.smtplib, clock=lambda: self.now)
+
+    def test_send_string(self):
+        sender = self._make_one()
+        sender('me', ['you', 'them'], 'Hello')
+        conn, = self.smtplib.connections
+        self.assertEqual(conn.args, ('mail.example.com', 2525, 5))
+        self.assertEqual(conn.log, [('sendmail', 'me', ['you', 'them'],
+                                     'Hello')])
+
+    def test_send_message(self):
+        from email.message import Message
+        message = Message()
+        message['Subject'] = 'Hello'
+        message.set_payload('Hi there')
+        sender = self._make_one()
+        sender('me', ['you'], message)
+        conn, = self.smtplib.connections
+        self.assertEqual(conn.log, [('sendmail', 'me', ['you'],
+                                     message.as_string())])
+
+    def test_connection_reused(self):
+        sender = self._make_one()
+        sender('me', ['you'], 'One')
+        sender('me', ['them'], 'Two')
+        conn, = self.smtplib.connections
+        self.assertEqual(conn.log, [
+            ('sendmail', 'me', ['you'], 'One'),
+            ('rset',),
+            ('sendmail', 'me', ['them'], 'Two'),
+        ])
+
+    def test_stale_connection_replaced(self):
+        import smtplib
+        sender = self._make_one()
+        sender('me', ['you'], 'One')
+        first = self.smtplib.connections[0]
+        first.fail_rset = smtplib.SMTPServerDisconnected
+        sender('me', ['them'], 'Two')
+        self.assertEqual(len(self.smtplib.connections), 2)
+        self.failUnless(first.closed)
+        second = self.smtplib.connections[1]
+        self.assertEqual(second.log, [('sendmail', 'me', ['them'], 'Two')])
+
+    def test_closing_connection_replaced(self):
+        sender = self._make_one()
+        sender('me', ['you'], 'One')
+        first = self.smtplib.connections[0]
+        first.rset_reply = (421, 'Service not available, closing channel')
+        sender('me', ['them'], 'Two')
+        self.assertEqual(len(self.smtplib.connections), 2)
+        self.failUnless(first.closed)
+        self.assertEqual(first.log, [('sendmail', 'me', ['you'], 'One'),
+                                     ('rset',)])
+        second = self.smtplib.connections[1]
+        self.assertEqual(second.log, [('sendmail', 'me', ['them'], 'Two')])
+
+    def test_idle_connection_replaced(self):
+        sender = self._make_one(max_idle=60)
+        sender('me', ['you'], 'One')
+        self.now = 61
+        sender('me', ['them'], 'Two')
+        first, second = self.smtplib.connections
+        self.assertEqual(first.log, [('sendmail', 'me', ['you'], 'One'),
+                                     ('quit',)])
+        self.assertEqual(second.log, [('sendmail', 'me', ['them'], 'Two')])
+
+    def test_pool_size(self):
+        sender = self._make_one(pool_size=1)
+        mta1 = sender._checkout()
+        mta2 = sender._checkout()
+        self.failIf(mta1 is mta2)
+        sender._checkin(mta1)
+        sender._checkin(mta2)
+        self.assertEqual(mta1.log, [])
+        self.assertEqual(mta2.log, [('quit',)])
+        self.assertEqual(sender._idle, [(mta1, 0)])
+
+    def test_pool_size_zero(self):
+        sender = self._make_one(pool_size=0)
+        sender('me', ['you'], 'One')
+        sender('me', ['them'], 'Two')
+        first, second = self.smtplib.connections
+        self.assertEqual(first.log, [('sendmail', 'me', ['you'], 'One'),
+                                     ('quit',)])
+
+    def test_refused_keeps_connection(self):
+        import smtplib
+        sender = self._make_one()
+        sender('me', ['you'], 'One')
+        conn, = self.smtplib.connections
+        conn.fail_sendmail = smtplib.SMTPRecipientsRefused({})
+        self.assertRaises(smtplib.SMTPRecipientsRefused,
+                          sender, 'me', ['nobody'], 'Two')
+        self.failIf(conn.closed)
+        conn.fail_sendmail = None
+        sender('me', ['them'], 'Three')
+        self.assertEqual(len(self.smtplib.connections), 1)
+
+    def test_disconnect_drops_connection(self):
+        import smtplib
+        sender = self._make_one()
+        sender('me', ['you'], 'One')
+        conn, = self.smtplib.connections
+        conn.fail_sendmail = smtplib.SMTPServerDisconnected()
+        self.assertRaises(smtplib.SMTPServerDisconnected,
+                          sender, 'me', ['them'], 'Two')
+        self.failUnless(conn.closed)
+        self.assertEqual(sender._idle, [])
+        sender('me', ['them'], 'Two')
+        self.assertEqual(len(self.smtplib.connections), 2)
+
+    def test_close(self):
+        import smtplib
+        sender = self._make_one(pool_size=2)
+        mta1 = sender._checkout()
+        mta2 = sender._checkout()
+        mta2.fail_quit = smtplib.SMTPServerDisconnected
+        sender._checkin(mta1)
+        sender._checkin(mta2)
+        sender.close()
+        self.assertEqual(sender._idle, [])
+        self.assertEqual(mta1.log, [('quit',)])
+        self.failUnless(mta2.closed)
+
+
+class TestSMTPSenderWithServer(unittest.TestCase):
+
+    def setUp(self):
+        import asyncore
+        import threading
+        self.server = server = DummySMTPServer()
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.05})
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.port = server.socket.getsockname()[1]
+
+    def tearDown(self):
+        import asyncore
+        asyncore.close_all()
+        self.thread.join(5)
+
+    def _make_one(self):
+        from repoze.postoffice.smtp import SMTPSender
+        return SMTPSender('127.0.0.1', self.port, timeout=5)
+
+    def test_connection_reused(self):
+        sender = self._make_one()
+        try:
+            sender('me@example.com', ['you@example.com'], 'Subject: One\n\n1')
+            sender('me@example.com', ['them@example.com'],
+                   'Subject: Two\n\n2')
+        finally:
+            sender.close()
+        self.assertEqual(self.server.accepted, 1)
+        self.assertEqual(self.server.received, [
+            ('me@example.com', ['you@example.com'], 'Subject: One\n\n1'),
+            ('me@example.com', ['them@example.com'], 'Subject: Two\n\n2'),
+        ])
+
+
+import smtpd
+
+class DummySMTPServer(smtpd.SMTPServer):
+    """
+    Stands in for an MTA on an ephemeral port on the loopback interface.
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.accepted = 0
+        self.received = []
+
+    def handle_accept(self):
+        self.accepted += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((mailfrom, rcpttos, data))
+
+class DummySMTPLib(object):
+    def __init__(self):
+        self.connections = []
+
+    def SMTP(self, host, port, timeout):
+        conn = DummySMTP((host, port, timeout))
+        self.connections.append(conn)
+        return conn
+
+class DummySMTP(object):
+    fail_rset = fail_sendmail = fail_quit = None
+    rset_reply = (250, 'OK')
+    closed = False
+
+    def __init__(self, args):
+        self.args = args
+        self.log = []
+
+    def sendmail(self, fromaddr, toaddrs, message):
+        if self.fail_sendmail is not None:
+            raise self.fail_sendmail
+        self.log.append(('sendmail', fromaddr, toaddrs, message))
+
+    def rset(self):
+        if self.fail_rset is not None:
+            raise self.fail_rset
+        self.log.append(('rset',))
+        return self.rset_reply
+
+    def quit(self):
+        if self.fail_quit is not None:
+            raise self.fail_quit
+        self.log.append(('quit',))
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,120 @@
+import unittest
+
+class TestPollingWatcher(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.repoze.postoffice.tests')
+        self.new = os.path.join(self.tmp, 'new')
+        os.mkdir(self.new)
+        self.clock = DummyClock()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def _make_one(self, paths=None):
+        from repoze.postoffice.watch import PollingWatcher
+        if paths is None:
+            paths = [self.new]
+        return PollingWatcher(paths, 0.5, self.clock.sleep, self.clock.time)
+
+    def _touch(self):
+        import os
+        # Fake the passage of time, rather than relying on mtime resolution
+        mtime = os.stat(self.new).st_mtime + 10
+        os.utime(self.new, (mtime, mtime))
+
+    def test_timeout_without_change(self):
+        watcher = self._make_one()
+        self.failIf(watcher.wait(2))
+        self.assertEqual(self.clock.slept, [0.5, 0.5, 0.5, 0.5])
+
+    def test_change_before_wait(self):
+        watcher = self._make_one()
+        self._touch()
+        self.failUnless(watcher.wait(2))
+        self.assertEqual(self.clock.slept, [])
+        self.failIf(watcher.wait(0))
+
+    def test_change_while_waiting(self):
+        watcher = self._make_one()
+        self.clock.on_sleep = self._touch
+        self.failUnless(watcher.wait())
+        self.assertEqual(self.clock.slept, [0.5])
+
+    def test_missing_directory(self):
+        import os
+        missing = os.path.join(self.tmp, 'cur')
+        watcher = self._make_one([self.new, missing])
+        self.failIf(watcher.wait(0))
+        os.mkdir(missing)
+        self.failUnless(watcher.wait(0))
+
+
+class TestInotifyWatcher(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.repoze.postoffice.tests')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def _make_one(self):
+        from repoze.postoffice.watch import InotifyWatcher
+        return InotifyWatcher([self.tmp])
+
+    def test_it(self):
+        import os
+        from repoze.postoffice.watch import pyinotify
+        if pyinotify is None: #pragma NO COVER
+            return
+        watcher = self._make_one()
+        try:
+            self.failIf(watcher.wait(0))
+            open(os.path.join(self.tmp, 'message'), 'w').close()
+            self.failUnless(watcher.wait(1))
+            self.failIf(watcher.wait(0))
+        finally:
+            watcher.close()
+
+
+class Test_make_watcher(unittest.TestCase):
+
+    def test_polling_fallback(self):
+        from repoze.postoffice import watch
+        save_pyinotify, watch.pyinotify = watch.pyinotify, None
+        try:
+            watcher = watch.make_watcher(['foo'], 3)
+        finally:
+            watch.pyinotify = save_pyinotify
+        self.failUnless(isinstance(watcher, watch.PollingWatcher))
+        self.assertEqual(watcher.poll_interval, 3)
+
+
+class Test_maildir_paths(unittest.TestCase):
+
+    def test_it(self):
+        from repoze.postoffice.watch import maildir_paths
+        self.assertEqual(maildir_paths('/var/mail/Maildir'),
+                         ['/var/mail/Maildir/new', '/var/mail/Maildir/cur'])
+
+
+class DummyClock(object):
+    on_sleep = None
+
+    def __init__(self):
+        self.now = 0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+        if self.on_sleep is not None:
+            self.on_sleep()
@@ -0,0 +1,119 @@
+"""
+Watchers which wait for new messages to be delivered to a Maildir.  Where the
+optional `pyinotify` package is installed, the kernel notifies us of new
+deliveries as they happen.  Otherwise the Maildir is polled.
+"""
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError: #pragma NO COVER
+    pyinotify = None
+
+
+def make_watcher(paths, poll_interval=1.0):
+    """
+    Returns the best available watcher for the given directories.
+    """
+    if pyinotify is not None:
+        return InotifyWatcher(paths)
+    return PollingWatcher(paths, poll_interval)
+
+def maildir_paths(maildir):
+    """
+    Returns the directories of a Maildir into which messages are delivered.
+    """
+    return [os.path.join(maildir, 'new'), os.path.join(maildir, 'cur')]
+
+
+class PollingWatcher(object):
+    """
+    Detects changes to a set of directories by polling their modification
+    times.
+    """
+    def __init__(self, paths, poll_interval=1.0,
+                 sleep=time.sleep, clock=time.time):
+        # sleep and clock passed in for unittesting
+        self.paths = paths
+        self.poll_interval = poll_interval
+        self._sleep = sleep
+        self._clock = clock
+        self._mtimes = self._stat()
+
+    def _stat(self):
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def wait(self, timeout=None):
+        """
+        Blocks until one of the watched directories changes, or until
+        'timeout' seconds have passed.  Returns boolean indicating whether a
+        change was seen.  Changes made since the last call to `wait` are
+        reported immediately.
+        """
+        if timeout is not None:
+            deadline = self._clock() + timeout
+        while True:
+            mtimes = self._stat()
+            if mtimes != self._mtimes:
+                self._mtimes = mtimes
+                return True
+            if timeout is None:
+                delay = self.poll_interval
+            else:
+                delay = min(self.poll_interval, deadline - self._clock())
+                if delay <= 0:
+                    return False
+            self._sleep(delay)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Detects new files in a set of directories using inotify.
+    """
+    mask = 0
+    if pyinotify is not None: #pragma NO COVER
+        mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._manager, _IgnoreEvents())
+        self._manager.add_watch(paths, self.mask)
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a file is created in or moved into one of the watched
+        directories, or until 'timeout' seconds have passed.  Returns boolean
+        indicating whether a change was seen.  Changes made since the last
+        call to `wait` are reported immediately.
+        """
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        notifier = self._notifier
+        if not notifier.check_events(timeout):
+            return False
+        notifier.read_events()
+        notifier.process_events()
+        return True
+
+    def close(self):
+        self._notifier.stop()
+
+
+if pyinotify is not None: #pragma NO COVER
+    class _IgnoreEvents(pyinotify.ProcessEvent):
+        """
+        We only care that something happened, not what.
+        """
+        def process_default(self, event):
+            pass
@@ -48,6 +48,7 @@ setup(name='repoze.postoffice',
       zip_safe=False,
       tests_require = [],
       install_requires=INSTALL_REQUIRES,
+      extras_require={'inotify': ['pyinotify']},
       test_suite="repoze.postoffice",
       entry_points = """\
         [console_scripts]